@@ -0,0 +1,72 @@
+# microbenchmark dos formatos de mensagem
+# compara JSON (como era), JSON + zlib, binário (codec.py) e binário + zlib nas mensagens
+# mais comuns: tempo pra montar o quadro, tempo pra ler e tamanho em bytes
+#
+# uso: python3 bench/bench_codec.py [--iterations 20000]
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+import protocol
+
+FORMATS = [
+    ("json", protocol.JSON_CODEC),
+    ("json+zlib", protocol.codec_for(protocol.FEATURE_ZLIB)),
+    ("binário", protocol.codec_for(protocol.FEATURE_BINARY)),
+    ("binário+zlib", protocol.codec_for(protocol.FEATURE_BINARY | protocol.FEATURE_ZLIB)),
+]
+
+
+def samples():
+    # (nome, mensagem, é lote?)
+    return [
+        ("chat_message", {"type": "chat_message", "sender": "maria", "message": "oi, tudo bem? bora almoçar?"}, False),
+        ("group_message", {"type": "group_message", "group": "redes-2024", "sender": "joao", "message": "alguém fez o lab 3?"}, False),
+        ("send_message", {"command": "send_message", "message": "to chegando"}, False),
+        ("status", {"status": "success", "message": "Conversa privada com 'maria' iniciada. Use /menu para sair."}, False),
+        ("presence", {"type": "presence", "user": "maria", "online": True}, False),
+        ("directory (50)", {"type": "directory", "users": [{"username": f"user{i:04d}", "online": i % 3 == 0} for i in range(50)],
+                            "next_cursor": "user0049"}, False),
+        ("offline_batch (200)", {"type": "offline_batch", "cursor": 200, "more": True,
+                                 "messages": [{"sender": f"user{i % 7}", "message": f"mensagem número {i} enquanto você tava fora"} for i in range(200)]}, False),
+        ("lote de 20 DMs", [{"type": "chat_message", "sender": "maria", "message": f"msg {i}"} for i in range(20)], True),
+    ]
+
+
+def bench(codec, message, batch, iterations):
+    encode = codec.encode_batch if batch else codec.encode
+    start = time.perf_counter()
+    for _ in range(iterations):
+        frame = encode(message)
+    encode_us = 1e6 * (time.perf_counter() - start) / iterations
+
+    decoder = protocol.FrameDecoder()
+    start = time.perf_counter()
+    for _ in range(iterations):
+        decoder.feed(frame)
+        decoded = decoder.messages()
+    decode_us = 1e6 * (time.perf_counter() - start) / iterations
+    # confere que volta igual
+    assert decoded == (message if batch else [message]), "ida e volta não bateu"
+    return len(frame), encode_us, decode_us
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    for name, message, batch in samples():
+        # mensagem grande roda menos vezes, senão demora demais
+        iterations = max(100, args.iterations // 50) if len(protocol.encode(message)) > 2000 else args.iterations
+        print(f"--- {name}")
+        for label, codec in FORMATS:
+            size, encode_us, decode_us = bench(codec, message, batch, iterations)
+            print(f"{label:<14}| {size:>7} bytes | encode {encode_us:>8.2f} µs | decode {decode_us:>8.2f} µs")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# benchmark de escrita de mensagens offline
+# compara um commit por mensagem (como era antes) com o GroupCommitWriter
+# (várias threads mandando ao mesmo tempo, um commit por janela)
+#
+# uso: python3 bench/bench_db_writes.py [--messages 5000] [--threads 8] [--synchronous FULL]
+import argparse
+import os
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from database import Database
+
+
+def run_threads(threads, target):
+    workers = [threading.Thread(target=target, args=(i,)) for i in range(threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    return time.perf_counter() - start
+
+
+def bench_old(path, messages, threads, synchronous):
+    # uma conexão compartilhada (com lock, senão o sqlite reclama) e commit por insert
+    conn = sqlite3.connect(path, check_same_thread=False)
+    conn.execute(f"PRAGMA synchronous={synchronous}")
+    conn.execute("CREATE TABLE offline_messages (id INTEGER PRIMARY KEY AUTOINCREMENT, sender TEXT, receiver TEXT, message TEXT)")
+    lock = threading.Lock()
+    per_thread = messages // threads
+
+    def worker(i):
+        for n in range(per_thread):
+            with lock:
+                conn.execute("INSERT INTO offline_messages (sender, receiver, message) VALUES (?, ?, ?)", (f"s{i}", f"r{n % 100}", "oi"))
+                conn.commit()
+
+    elapsed = run_threads(threads, worker)
+    conn.close()
+    return per_thread * threads, elapsed, per_thread * threads
+
+
+def bench_new(path, messages, threads, synchronous, window):
+    db = Database(path, synchronous=synchronous, commit_window=window)
+    per_thread = messages // threads
+
+    def worker(i):
+        # cada "handler" manda suas msgs e só espera a última ficar durável
+        futures = [db.save_message(f"s{i}", f"r{n % 100}", "oi") for n in range(per_thread)]
+        for f in futures:
+            f.result()
+
+    elapsed = run_threads(threads, worker)
+    commits = db.writer.commits
+    db.close()
+    return per_thread * threads, elapsed, commits
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--synchronous", default="FULL", choices=["OFF", "NORMAL", "FULL"])
+    parser.add_argument("--window", type=float, default=0.005)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        total, elapsed, commits = bench_old(os.path.join(tmp, "old.db"), args.messages, args.threads, args.synchronous)
+        print(f"commit por msg  | {total / elapsed:>10.0f} msgs/s | {commits} commits")
+        total, elapsed, commits = bench_new(os.path.join(tmp, "new.db"), args.messages, args.threads, args.synchronous, args.window)
+        print(f"group commit    | {total / elapsed:>10.0f} msgs/s | {commits} commits")
+
+
+if __name__ == "__main__":
+    main()
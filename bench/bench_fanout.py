@@ -0,0 +1,118 @@
+# benchmark do fan-out de grupo
+# compara o jeito antigo (SELECT dos membros + json.dumps por membro a cada msg)
+# com o FanoutEngine (membros em cache + quadro montado uma vez só)
+#
+# uso: python3 bench/bench_fanout.py [--messages 200] [--sizes 10,1000,10000]
+#
+# a "entrega" termina quando o quadro entra na fila de saída do destinatário
+# (é o que o servidor faz; o socket em si é problema do writer de cada sessão)
+import argparse
+import json
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+import protocol
+from database import Database
+from group import GroupManager
+from fanout import FanoutEngine
+from session import OutboundQueue
+
+
+class FakeSession:
+    # sessão sem socket: só a fila de saída de verdade + hora da entrega
+    def __init__(self):
+        self.queue = OutboundQueue(high_watermark=1 << 30)
+        self.delivered_at = 0.0
+
+    def send(self, data, spill=None):
+        self.queue.put(data, spill)
+        self.delivered_at = time.perf_counter()
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def setup(db, size):
+    # cria o grupo com 'size' membros direto no banco
+    db.conn.executemany("INSERT INTO users (username, password_hash) VALUES (?, 'x')", [(f"u{i}",) for i in range(size)])
+    db.conn.execute("INSERT INTO groups (name) VALUES ('bench')")
+    db.conn.executemany("INSERT INTO group_members (group_name, username) VALUES ('bench', ?)", [(f"u{i}",) for i in range(size)])
+    db.conn.commit()
+    db.reload_group('bench')  # inseriu direto no sqlite: põe o grupo no índice em memória
+    return {f"u{i}": FakeSession() for i in range(size)}
+
+
+def run_old(db, users_online, messages):
+    # como era antes: consulta o banco e serializa de novo pra cada membro
+    latencies, elapsed = [], 0.0
+    for n in range(messages):
+        start = time.perf_counter()
+        for member in db.get_group_members('bench'):
+            if member != 'u0' and member in users_online:
+                payload = json.dumps({"type": "group_message", "group": "bench", "sender": "u0", "message": f"msg {n}"}).encode('utf-8')
+                users_online[member].send(payload)
+        elapsed += time.perf_counter() - start
+        collect(users_online, start, latencies)
+    return elapsed, latencies
+
+
+def run_new(group_manager, fanout, users_online, messages):
+    latencies, elapsed = [], 0.0
+    for n in range(messages):
+        start = time.perf_counter()
+        frame = protocol.encode({"type": "group_message", "group": "bench", "sender": "u0", "message": f"msg {n}"})
+        targets = [users_online[m] for m in group_manager.get_members('bench') if m != 'u0' and m in users_online]
+        fanout.deliver(targets, frame)
+        elapsed += time.perf_counter() - start
+        collect(users_online, start, latencies)
+    return elapsed, latencies
+
+
+def collect(users_online, start, latencies):
+    # anota a latência de cada destinatário e esvazia as filas como o writer faria
+    # (fora do tempo medido)
+    for session in users_online.values():
+        if session.delivered_at >= start:
+            latencies.append(session.delivered_at - start)
+        session.queue.take_all()
+
+
+def report(name, size, messages, elapsed, latencies):
+    print(f"{name:>8} | {size:>6} membros | {messages / elapsed:>10.1f} msgs/s | "
+          f"{messages * (size - 1) / elapsed:>12.0f} entregas/s | p99 {percentile(latencies, 99) * 1000:8.3f} ms")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=200)
+    parser.add_argument("--sizes", default="10,1000,10000")
+    parser.add_argument("--workers", type=int, default=4)
+    parser.add_argument("--threshold", type=int, default=1000)
+    args = parser.parse_args()
+
+    for size in [int(s) for s in args.sizes.split(",")]:
+        # menos msgs nos grupos enormes, senão o modo antigo demora demais
+        messages = max(5, min(args.messages, args.messages * 1000 // size))
+        with tempfile.TemporaryDirectory() as tmp:
+            db = Database(os.path.join(tmp, "bench.db"))
+            users_online = setup(db, size)
+
+            elapsed, latencies = run_old(db, users_online, messages)
+            report("antigo", size, messages, elapsed, latencies)
+
+            group_manager = GroupManager(db)
+            fanout = FanoutEngine(workers=args.workers, parallel_threshold=args.threshold)
+            elapsed, latencies = run_new(group_manager, fanout, users_online, messages)
+            report("fanout", size, messages, elapsed, latencies)
+            fanout.shutdown()
+            db.close()
+
+
+if __name__ == "__main__":
+    main()
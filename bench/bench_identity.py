@@ -0,0 +1,106 @@
+# benchmark do índice de identidades (identity.py)
+# compara as checagens de antes (SELECT por pergunta) com o índice em memória
+# (filtro de Bloom + conjuntos, e o modo só com o filtro na frente do banco),
+# e a subida lendo as tabelas vs lendo o snapshot
+#
+# uso: python3 bench/bench_identity.py [--users 200000] [--groups 2000] [--group-size 50] [--lookups 100000]
+import argparse
+import os
+import random
+import sqlite3
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from database import Database
+from identity import IdentityIndex
+
+
+def populate(path, users, groups, group_size):
+    # cria o banco pelo Database (tabelas de verdade) e enche direto no sqlite
+    Database(path).close()
+    conn = sqlite3.connect(path)
+    conn.executemany("INSERT INTO users (username, password_hash) VALUES (?, 'x')", ((f"user{i}",) for i in range(users)))
+    conn.executemany("INSERT INTO groups (name) VALUES (?)", ((f"group{g}",) for g in range(groups)))
+    conn.executemany("INSERT INTO group_members (group_name, username) VALUES (?, ?)",
+                     ((f"group{g}", f"user{(g * group_size + n) % users}") for g in range(groups) for n in range(group_size)))
+    conn.commit()
+    conn.close()
+
+
+def rate(name, count, elapsed):
+    print(f"{name:>40} | {count / elapsed:>12.0f} /s | {elapsed / count * 1e6:8.2f} µs cada")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=200000)
+    parser.add_argument("--groups", type=int, default=2000)
+    parser.add_argument("--group-size", type=int, default=50)
+    parser.add_argument("--lookups", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, "bench.db")
+        snapshot = os.path.join(tmp, "bench.db.identity")
+        start = time.perf_counter()
+        populate(path, args.users, args.groups, args.group_size)
+        print(f"banco com {args.users} users, {args.groups} grupos x {args.group_size} membros "
+              f"({time.perf_counter() - start:.1f}s pra montar)")
+
+        # subida
+        print("\nsubida:")
+        for attempt in ("tabelas (sem snapshot)", "tabelas + grava snapshot", "snapshot"):
+            index = IdentityIndex()
+            conn = sqlite3.connect(path)
+            start = time.perf_counter()
+            index.load(conn, snapshot if attempt != "tabelas (sem snapshot)" else None)
+            elapsed = time.perf_counter() - start
+            conn.close()
+            print(f"{attempt:>40} | {elapsed:8.3f} s | fonte: {index.source}")
+        print(f"{'tamanho do snapshot':>40} | {os.path.getsize(snapshot) / 1e6:8.1f} MB")
+
+        # consultas: metade de nomes que existem, metade que não
+        conn = sqlite3.connect(path)
+        rng = random.Random(1)
+        hits = [f"user{rng.randrange(args.users)}" for _ in range(args.lookups)]
+        misses = [f"ghost{rng.randrange(10 ** 9)}" for _ in range(args.lookups)]
+        groups = [f"group{rng.randrange(args.groups)}" for _ in range(args.lookups // 10)]
+
+        # modo só com o filtro: os "talvez" vão pro banco
+        sql_exists = lambda name: conn.execute("SELECT 1 FROM users WHERE username=?", (name,)).fetchone() is not None
+        for attempt in ("só filtro: tabelas + grava snapshot", "só filtro: snapshot"):
+            bloom_index = IdentityIndex(keep_users=False, user_lookup=sql_exists)
+            start = time.perf_counter()
+            bloom_index.load(conn, snapshot + ".bloom")
+            print(f"{attempt:>40} | {time.perf_counter() - start:8.3f} s | fonte: {bloom_index.source}")
+
+        print("\nconsultas:")
+        for label, names in (("existe", hits), ("não existe", misses)):
+            for kind, check in (("SQL", sql_exists), ("índice", index.user_exists), ("índice só filtro", bloom_index.user_exists)):
+                start = time.perf_counter()
+                for name in names:
+                    check(name)
+                rate(f"{kind} user_exists ({label})", len(names), time.perf_counter() - start)
+
+        bloom = bloom_index.user_filter
+        false_positives = sum(1 for name in misses if name in bloom)
+        print(f"{'falsos positivos do filtro':>40} | {false_positives / len(misses) * 100:8.2f} %")
+        print(f"{'memória do filtro de users':>40} | {len(bloom.bits) / 1e6:8.1f} MB")
+
+        start = time.perf_counter()
+        for group_name in groups:
+            [row[0] for row in conn.execute("SELECT username FROM group_members WHERE group_name=?", (group_name,))]
+        rate("SQL membros do grupo", len(groups), time.perf_counter() - start)
+
+        start = time.perf_counter()
+        for group_name in groups:
+            index.get_members(group_name)
+        rate("índice membros do grupo", len(groups), time.perf_counter() - start)
+        conn.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,88 @@
+# benchmark das msgs offline particionadas (Database com offline_shards)
+# compara o arquivo único (tabela no banco principal, um writer pra tudo) com
+# 1, 4 e 8 shards (um arquivo e uma thread writer por shard)
+#
+# uso: python3 bench/bench_shards.py [--messages 40000] [--threads 16] [--burst 20] [--shards 0,1,4,8] [--synchronous FULL]
+#
+# cada thread faz o papel de um handler: manda 'burst' msgs offline pra destinatários
+# sorteados e espera a última ficar gravada (como quem avisa "fulano tá offline"),
+# enquanto as outras threads fazem o mesmo. no meio, uma thread escreve o histórico
+# no banco principal (append_history) pra mostrar que ele deixa de disputar o writer
+import argparse
+import os
+import random
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+from database import Database
+
+
+def run(path, shards, args):
+    db = Database(path, synchronous=args.synchronous, commit_window=args.window, identity_snapshot=None, offline_shards=shards)
+    per_thread = args.messages // args.threads
+    waits = []
+    waits_lock = threading.Lock()
+    stop = threading.Event()
+    history = [0]
+
+    def handler(i):
+        rng = random.Random(i)
+        mine = []
+        for start in range(0, per_thread, args.burst):
+            sent = time.perf_counter()
+            futures = [db.save_message(f"s{i}", f"user{rng.randrange(args.users)}", "oi " * 10)
+                       for _ in range(min(args.burst, per_thread - start))]
+            futures[-1].result()
+            mine.append(time.perf_counter() - sent)
+        with waits_lock:
+            waits.extend(mine)
+
+    def chatter():
+        # histórico no banco principal, sem parar enquanto os handlers trabalham
+        while not stop.is_set():
+            db.append_history("dm:a\x1fb", "a", "oi").result()
+            history[0] += 1
+
+    side = threading.Thread(target=chatter)
+    side.start()
+    workers = [threading.Thread(target=handler, args=(i,)) for i in range(args.threads)]
+    start = time.perf_counter()
+    for w in workers:
+        w.start()
+    for w in workers:
+        w.join()
+    elapsed = time.perf_counter() - start
+    stop.set()
+    side.join()
+
+    commits = sum(shard.writer.commits for shard in db.shards) or db.writer.commits
+    db.close()
+    waits.sort()
+    label = "arquivo único" if shards == 0 else f"{shards} shard(s)"
+    print(f"{label:>14} | {per_thread * args.threads / elapsed:>9.0f} msgs/s | {commits:>6} commits | "
+          f"espera p50 {waits[len(waits) // 2] * 1000:6.1f} ms | p99 {waits[int(len(waits) * 0.99)] * 1000:6.1f} ms | "
+          f"histórico {history[0] / elapsed:6.0f}/s")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--messages", type=int, default=40000)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--burst", type=int, default=20, help="msgs por handler antes de esperar o commit")
+    parser.add_argument("--users", type=int, default=10000, help="destinatários diferentes")
+    parser.add_argument("--shards", default="0,1,4,8", help="layouts testados (0 = arquivo único)")
+    parser.add_argument("--synchronous", default="FULL", choices=["OFF", "NORMAL", "FULL"])
+    parser.add_argument("--window", type=float, default=0.005)
+    args = parser.parse_args()
+
+    for shards in [int(n) for n in args.shards.split(",")]:
+        with tempfile.TemporaryDirectory() as tmp:
+            run(os.path.join(tmp, "bench.db"), shards, args)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,150 @@
+# benchmark das escritas no socket
+# compara o writer antigo (um sendall por quadro) com o writer que junta a fila
+# e manda tudo num sendmsg, com e sem flush delay
+#
+# uso: python3 bench/bench_writes.py [--bursts 200] [--burst 50] [--size 100] [--delays-us 0,200,1000]
+#
+# o servidor de verdade manda rajadas (fan-out de grupo, lote offline, respostas
+# pipelined); aqui um produtor enfileira 'burst' quadros de uma vez, espera
+# 'pause-ms' e repete, e do outro lado de uma conexão TCP local uma thread lê e
+# anota a latência de cada quadro (da entrada na fila até chegar)
+import argparse
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'server'))
+
+import protocol
+from session import OutboundQueue, SocketSession, send_frames
+
+
+class CountingSocket:
+    # socket de verdade, mas contando as chamadas de escrita (cada uma é um syscall)
+    def __init__(self, sock):
+        self.sock = sock
+        self.calls = 0
+
+    def sendall(self, data):
+        self.calls += 1
+        self.sock.sendall(data)
+
+    def sendmsg(self, buffers):
+        self.calls += 1
+        return self.sock.sendmsg(buffers)
+
+    def shutdown(self, how):
+        self.sock.shutdown(how)
+
+    def close(self):
+        self.sock.close()
+
+
+class OldSession(SocketSession):
+    # o writer como era: tira um quadro da fila e faz um sendall pra ele
+    def _writer(self):
+        while True:
+            frames = self.queue.get_batch(max_frames=1)
+            if frames is None:
+                break
+            try:
+                self.sock.sendall(frames[0])
+            except OSError:
+                break
+
+
+def tcp_pair():
+    listener = socket.create_server(('127.0.0.1', 0))
+    client = socket.create_connection(listener.getsockname())
+    server, _ = listener.accept()
+    listener.close()
+    for sock in (client, server):
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    return server, client
+
+
+def receive(sock, expected, latencies):
+    decoder = protocol.FrameDecoder()
+    while len(latencies) < expected:
+        chunk = sock.recv(protocol.RECV_SIZE)
+        if not chunk:
+            return
+        decoder.feed(chunk)
+        now = time.perf_counter()
+        for message in decoder.messages():
+            latencies.append(now - message['t'])
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def run(name, make_session, args):
+    server_sock, client_sock = tcp_pair()
+    counting = CountingSocket(server_sock)
+    session = make_session(counting)
+    expected = args.bursts * args.burst
+    latencies = []
+    reader = threading.Thread(target=receive, args=(client_sock, expected, latencies))
+    reader.start()
+
+    padding = 'x' * args.size
+    sent_bytes = 0
+    start = time.perf_counter()
+    for _ in range(args.bursts):
+        for _ in range(args.burst):
+            frame = protocol.encode({"type": "chat_message", "sender": "bench", "message": padding,
+                                     "t": time.perf_counter()})
+            sent_bytes += len(frame)
+            session.send(frame)
+        if args.pause_ms:
+            time.sleep(args.pause_ms / 1000)
+    reader.join()
+    elapsed = time.perf_counter() - start
+    session.close()
+    client_sock.close()
+
+    print(f"{name:>18} | {expected / elapsed:>9.0f} quadros/s | {sent_bytes / elapsed / 1e6:6.1f} MB/s | "
+          f"{counting.calls:>6} escritas | {expected / counting.calls:6.1f} quadros/escrita | "
+          f"p50 {percentile(latencies, 50) * 1e6:7.0f} µs | p99 {percentile(latencies, 99) * 1e6:7.0f} µs")
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--bursts", type=int, default=200, help="quantas rajadas")
+    parser.add_argument("--burst", type=int, default=50, help="quadros por rajada")
+    parser.add_argument("--size", type=int, default=100, help="bytes de texto em cada msg")
+    parser.add_argument("--pause-ms", type=float, default=1, help="pausa entre rajadas")
+    parser.add_argument("--delays-us", default="0,200,1000", help="flush delays testados no writer novo")
+    args = parser.parse_args()
+
+    addr = ('127.0.0.1', 0)
+    new_queue = lambda: OutboundQueue(high_watermark=1 << 30)
+    run("sendall/quadro", lambda sock: OldSession(sock, addr, new_queue()), args)
+    if not hasattr(socket.socket, 'sendmsg'):
+        print("sem sendmsg neste sistema: o writer novo cai no sendall de um buffer só")
+    for delay in [float(d) for d in args.delays_us.split(",")]:
+        run(f"sendmsg {delay:.0f}µs", lambda sock: SocketSession(sock, addr, new_queue(), flush_delay=delay / 1e6), args)
+
+    # sendmsg com mais quadros que o IOV_MAX e socket enchendo (envio parcial)
+    server_sock, client_sock = tcp_pair()
+    frames = [os.urandom(n % 3000 + 1) for n in range(5000)]
+    received = bytearray()
+    def drain():
+        while len(received) < sum(map(len, frames)):
+            received.extend(client_sock.recv(1 << 16))
+    reader = threading.Thread(target=drain)
+    reader.start()
+    calls = send_frames(server_sock, frames)
+    reader.join()
+    assert bytes(received) == b''.join(frames), "send_frames embaralhou os bytes"
+    print(f"envio parcial ok: {len(frames)} quadros, {len(received)} bytes em {calls} sendmsg")
+    server_sock.close()
+    client_sock.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,368 @@
+# gerador de carga: N usuários simulados conversando com um servidor de verdade
+# (mesmo protocolo do client.py, sem o menu de terminal)
+#
+# 1. todo mundo registra e loga (mede a latência do login)
+# 2. monta os grupos (o primeiro membro cria e adiciona os outros)
+# 3. durante --duration segundos cada user manda DMs e msgs de grupo no ritmo pedido
+# 4. uma parte dos users sai, recebe DMs offline e volta (mede a entrega no reconnect)
+#
+# cada msg leva no texto a hora em que foi mandada, então a latência é de ponta a
+# ponta: do send do remetente até o quadro chegar no destinatário
+#
+# uso: python3 bench/loadgen.py --start-server --users 50 --duration 10 --output resultado.json
+#      python3 bench/loadgen.py --port 12345 --users 200 --dm-rate 2 --group-rate 0.5
+import argparse
+import asyncio
+import json
+import os
+import random
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..')
+sys.path.insert(0, os.path.join(ROOT, 'server'))
+
+import protocol
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p / 100))]
+
+
+def summary(values):
+    # latências em ms
+    return {
+        "count": len(values),
+        "p50_ms": _ms(percentile(values, 50)),
+        "p95_ms": _ms(percentile(values, 95)),
+        "p99_ms": _ms(percentile(values, 99)),
+        "max_ms": _ms(max(values) if values else None),
+    }
+
+
+def _ms(value):
+    return None if value is None else round(value * 1000, 3)
+
+
+class Stats:
+    def __init__(self):
+        self.login = []
+        self.dm = []
+        self.group = []
+        self.offline = []
+        self.sent_dm = 0
+        self.sent_group = 0
+        self.errors = 0
+
+
+class SimUser:
+    # um usuário simulado: conexão, leitura em background e envio
+    def __init__(self, name, args, stats):
+        self.name = name
+        self.args = args
+        self.stats = stats
+        self.codec = protocol.JSON_CODEC
+        self.replies = asyncio.Queue()  # respostas de status (login, select_chat...)
+        self.offline_expected = 0
+        self.offline_done = None
+        self.reconnected_at = None  # hora em que voltou (a latência offline conta daqui)
+        self.reader_task = None
+
+    async def connect(self):
+        self.reader, self.writer = await asyncio.open_connection(self.args.host, self.args.port)
+        self.decoder = protocol.FrameDecoder()
+        features = {"json": 0, "binary": protocol.FEATURE_BINARY,
+                    "binary+zlib": protocol.FEATURE_BINARY | protocol.FEATURE_ZLIB}[self.args.codec]
+        self.writer.write(protocol.hello(protocol.PROTOCOL_VERSION, features))
+        while (greeting := self.decoder.read_handshake()) is None:
+            chunk = await self.reader.read(protocol.RECV_SIZE)
+            if not chunk:
+                raise ConnectionError("servidor fechou no cumprimento")
+            self.decoder.feed(chunk)
+        self.codec = protocol.codec_for(greeting[1])
+        self.reader_task = asyncio.create_task(self.read_loop())
+
+    def send(self, data):
+        self.writer.write(self.codec.encode(data))
+
+    async def request(self, data):
+        # manda e espera a resposta de status (o servidor responde na ordem)
+        self.send(data)
+        return await asyncio.wait_for(self.replies.get(), self.args.timeout)
+
+    async def read_loop(self):
+        try:
+            while True:
+                for message in self.decoder.messages():
+                    self.handle(message)
+                chunk = await self.reader.read(protocol.RECV_SIZE)
+                if not chunk:
+                    return
+                self.decoder.feed(chunk)
+        except (ConnectionError, protocol.ProtocolError):
+            return
+
+    def handle(self, message):
+        now = time.time()
+        kind = message.get('type')
+        if kind == 'chat_message':
+            self.stats.dm.append(now - sent_at(message['message']))
+        elif kind == 'group_message':
+            self.stats.group.append(now - sent_at(message['message']))
+        elif kind == 'offline_batch':
+            # a msg ficou guardada o tempo que ele tava fora; o que interessa é
+            # quanto demora pra chegar depois que ele volta
+            self.stats.offline.extend([now - self.reconnected_at] * len(message['messages']))
+            self.offline_expected -= len(message['messages'])
+            self.send({"command": "ack_offline", "cursor": message['cursor']})
+            if self.offline_expected <= 0 and self.offline_done is not None:
+                self.offline_done.set()
+        elif 'status' in message:
+            if message['status'] == 'error':
+                self.stats.errors += 1
+            # avisos soltos (ex: "fulano tá offline") não são resposta de nada
+            if not (message['status'] == 'info' and 'offline' in message.get('message', '')):
+                self.replies.put_nowait(message)
+
+    async def login(self):
+        await self.request({"command": "register", "username": self.name, "password": "senha"})
+        start = time.perf_counter()
+        reply = await self.request({"command": "login", "username": self.name, "password": "senha"})
+        self.stats.login.append(time.perf_counter() - start)
+        if reply.get('status') != 'success':
+            raise RuntimeError(f"login de {self.name} falhou: {reply.get('message')}")
+
+    async def close(self):
+        self.writer.close()
+        try:
+            await self.writer.wait_closed()
+        except ConnectionError:
+            pass
+        if self.reader_task:
+            self.reader_task.cancel()
+
+
+def message_text(size):
+    # "hora|enchimento" com 'size' bytes no total (no mínimo a hora)
+    stamp = f"{time.time():.6f}|"
+    return stamp + "x" * max(0, size - len(stamp))
+
+
+def sent_at(text):
+    return float(text.split('|', 1)[0])
+
+
+async def run_sender(user, others, groups, args, stats, deadline):
+    # manda no ritmo pedido (processo de Poisson, pra não ficar todo mundo sincronizado)
+    rate = args.dm_rate + (args.group_rate if groups else 0)
+    if rate <= 0:
+        return
+    while True:
+        wait = random.expovariate(rate)
+        if time.monotonic() + wait >= deadline:
+            break
+        await asyncio.sleep(wait)
+        if groups and random.random() < args.group_rate / rate:
+            user.send({"command": "select_chat", "target_group": random.choice(groups)})
+            user.send({"command": "send_message", "message": message_text(args.message_size)})
+            stats.sent_group += 1
+        else:
+            user.send({"command": "select_chat", "target_user": random.choice(others)})
+            user.send({"command": "send_message", "message": message_text(args.message_size)})
+            stats.sent_dm += 1
+        # as respostas do select_chat não interessam aqui
+        while not user.replies.empty():
+            user.replies.get_nowait()
+
+
+async def gather_limited(coros, limit):
+    # roda as corrotinas com no máximo 'limit' ao mesmo tempo (login é caro no servidor)
+    semaphore = asyncio.Semaphore(limit)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+    return await asyncio.gather(*(run(c) for c in coros))
+
+
+async def run(args):
+    stats = Stats()
+    names = [f"{args.prefix}{i}" for i in range(args.users)]
+    users = {name: SimUser(name, args, stats) for name in names}
+
+    # 1. conecta e loga
+    start = time.perf_counter()
+    await gather_limited([u.connect() for u in users.values()], args.concurrency)
+    await gather_limited([u.login() for u in users.values()], args.concurrency)
+    login_elapsed = time.perf_counter() - start
+    print(f"[loadgen] {len(users)} users logados em {login_elapsed:.2f}s")
+
+    # 2. grupos: membros em sequência (grupo i = users i*size .. i*size+size-1, dando a volta)
+    groups = {}
+    for g in range(args.groups):
+        members = [names[(g * args.group_size + k) % len(names)] for k in range(min(args.group_size, len(names)))]
+        group_name = f"{args.prefix}grupo{g}"
+        owner = users[members[0]]
+        await owner.request({"command": "create_group", "group_name": group_name})
+        for member in members[1:]:
+            await owner.request({"command": "add_member_to_group", "group_name": group_name, "user_to_add": member})
+        for member in members:
+            groups.setdefault(member, []).append(group_name)
+    for user in users.values():
+        while not user.replies.empty():
+            user.replies.get_nowait()
+
+    # 3. carga
+    print(f"[loadgen] mandando msgs por {args.duration}s...")
+    deadline = time.monotonic() + args.duration
+    start = time.perf_counter()
+    await asyncio.gather(*(run_sender(u, [n for n in names if n != u.name] or [u.name], groups.get(u.name, []), args, stats, deadline)
+                           for u in users.values()))
+    send_elapsed = time.perf_counter() - start
+    await asyncio.sleep(args.drain)  # espera as últimas entregas
+    load_elapsed = time.perf_counter() - start
+    sent = stats.sent_dm + stats.sent_group
+    delivered_dm, delivered_group = len(stats.dm), len(stats.group)
+    dm_latency, group_latency = summary(stats.dm), summary(stats.group)
+
+    # 4. offline: uns saem, os outros mandam DM pra eles, eles voltam
+    offline_result = None
+    leaving = names[:min(args.offline_users, len(names) - 1)]
+    if leaving:
+        for name in leaving:
+            await users[name].close()
+        await asyncio.sleep(0.2)
+        senders = [users[n] for n in names if n not in leaving]
+        for name in leaving:
+            for n in range(args.offline_messages):
+                sender = senders[n % len(senders)]
+                sender.send({"command": "select_chat", "target_user": name})
+                sender.send({"command": "send_message", "message": message_text(args.message_size)})
+        await asyncio.sleep(args.drain)
+
+        start = time.perf_counter()
+        returning = []
+        for name in leaving:
+            user = SimUser(name, args, stats)
+            user.offline_expected = args.offline_messages
+            user.offline_done = asyncio.Event()
+            user.reconnected_at = time.time()
+            returning.append(user)
+        await gather_limited([u.connect() for u in returning], args.concurrency)
+        for user in returning:
+            await user.request({"command": "login", "username": user.name, "password": "senha"})
+        try:
+            await asyncio.wait_for(asyncio.gather(*(u.offline_done.wait() for u in returning)), args.timeout)
+        except asyncio.TimeoutError:
+            print("[loadgen] nem todas as msgs offline chegaram a tempo")
+        reconnect_elapsed = time.perf_counter() - start
+        offline_result = {
+            "users": len(leaving),
+            "expected": len(leaving) * args.offline_messages,
+            "delivered": len(stats.offline),
+            "reconnect_to_last_ms": _ms(reconnect_elapsed),
+            "latency": summary(stats.offline),
+        }
+        for name, user in zip(leaving, returning):
+            users[name] = user
+
+    for user in users.values():
+        await user.close()
+
+    return {
+        "timestamp": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "config": {k: v for k, v in vars(args).items() if k not in ("output",)},
+        "login": dict(summary(stats.login), logins_per_s=round(len(stats.login) / login_elapsed, 1)),
+        "throughput": {
+            "seconds": round(send_elapsed, 3),
+            "sent": sent,
+            "sent_per_s": round(sent / send_elapsed, 1),
+            "delivered_dm": delivered_dm,
+            "delivered_group": delivered_group,
+            "delivered_per_s": round((delivered_dm + delivered_group) / load_elapsed, 1),
+        },
+        "dm_latency": dm_latency,
+        "group_latency": group_latency,
+        "offline": offline_result,
+        "errors": stats.errors,
+    }
+
+
+def start_server(args, tmp):
+    # sobe um servidor local num banco novo e espera ele aceitar conexões
+    command = [sys.executable, os.path.join(ROOT, 'server', 'main.py'), "--host", "127.0.0.1", "--port", str(args.port),
+               "--db", os.path.join(tmp, "loadgen.db"), "--pbkdf2-iterations", str(args.pbkdf2_iterations)]
+    # o loadgen mede capacidade, não os limites de taxa: desliga todos (--server-args ainda pode religar)
+    command += ["--rate-commands", "0", "--rate-dm", "0", "--rate-fanout", "0", "--rate-group", "0"]
+    command += args.server_args.split()
+    process = subprocess.Popen(command, cwd=tmp, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    for _ in range(100):
+        try:
+            socket.create_connection(("127.0.0.1", args.port), timeout=0.5).close()
+            return process
+        except OSError:
+            time.sleep(0.1)
+    process.kill()
+    raise RuntimeError("servidor não subiu")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="gerador de carga do chat")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--start-server", action="store_true", help="sobe um servidor local (banco temporário) só pro teste")
+    parser.add_argument("--server-args", default="", help="argumentos extras pro main.py (com --start-server), ex: '--mode async'")
+    parser.add_argument("--pbkdf2-iterations", type=int, default=1000, help="iterações do servidor subido com --start-server")
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--prefix", default="lg", help="prefixo dos nomes dos users simulados")
+    parser.add_argument("--concurrency", type=int, default=32, help="quantos logins ao mesmo tempo")
+    parser.add_argument("--groups", type=int, default=5)
+    parser.add_argument("--group-size", type=int, default=10)
+    parser.add_argument("--duration", type=float, default=10.0, help="segundos de carga")
+    parser.add_argument("--dm-rate", type=float, default=1.0, help="DMs por segundo por user")
+    parser.add_argument("--group-rate", type=float, default=0.2, help="msgs de grupo por segundo por user")
+    parser.add_argument("--message-size", type=int, default=64, help="bytes no texto de cada msg")
+    parser.add_argument("--codec", choices=["json", "binary", "binary+zlib"], default="json")
+    parser.add_argument("--offline-users", type=int, default=5, help="quantos users saem e voltam pra medir a entrega offline")
+    parser.add_argument("--offline-messages", type=int, default=50, help="DMs que cada um recebe enquanto tá fora")
+    parser.add_argument("--drain", type=float, default=1.0, help="segundos esperando as últimas entregas")
+    parser.add_argument("--timeout", type=float, default=30.0)
+    parser.add_argument("--output", default=None, help="arquivo JSON com o resultado")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        process = start_server(args, tmp) if args.start_server else None
+        try:
+            result = asyncio.run(run(args))
+        finally:
+            if process:
+                process.terminate()
+                process.wait()
+
+    t = result["throughput"]
+    print(f"login        | {result['login']['logins_per_s']:>8} logins/s | p50 {result['login']['p50_ms']} ms | p99 {result['login']['p99_ms']} ms")
+    print(f"vazão        | {t['sent_per_s']:>8} msgs/s mandadas | {t['delivered_per_s']} entregas/s")
+    for key in ("dm_latency", "group_latency"):
+        s = result[key]
+        print(f"{key:<13}| {s['count']:>8} entregas | p50 {s['p50_ms']} ms | p95 {s['p95_ms']} ms | p99 {s['p99_ms']} ms")
+    if result["offline"]:
+        o = result["offline"]
+        print(f"offline      | {o['delivered']}/{o['expected']} msgs | tudo entregue {o['reconnect_to_last_ms']} ms depois de reconectar"
+              f" | p50 {o['latency']['p50_ms']} ms | p99 {o['latency']['p99_ms']} ms")
+    if result["errors"]:
+        print(f"erros        | {result['errors']}")
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(result, f, indent=2)
+        print(f"[loadgen] resultado salvo em {args.output}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+# cache local do cliente (um arquivo sqlite por servidor e user): o diretório de users,
+# os grupos do user com os membros e as msgs das conversas
+#
+# cada coisa guarda até onde já tem (cursor): o rowid do último user e da última entrada
+# em grupo que o servidor mandou e o último seq de cada conversa. ao (re)conectar, a
+# ChatClient manda os cursores no 'sync' e recebe só o que veio depois (ver
+# ChatServer.sync), então voltar de uma queda custa o que mudou, não tudo de novo.
+#
+# as msgs de uma conversa ficam num trecho contínuo de seqs (o sync continua do cursor;
+# uma página do 'history' pode deixar um buraco, que o próximo sync fecha). o histórico
+# só sai daqui quando a página pedida tá inteira no cache, sem buraco
+import json
+import os
+import sqlite3
+
+HISTORY_PAGE = 50  # o tamanho de página padrão do servidor
+
+
+def cache_path(cache_dir, host, port, username):
+    # nome em hex: qualquer username vira um nome de arquivo válido
+    return os.path.join(cache_dir, f"{host}_{port}_{username.encode('utf-8').hex()}.db")
+
+
+def conversation_key(target):
+    # {"target_user": x} ou {"target_group": x} -> ('user', x) / ('group', x)
+    if target.get('target_user'):
+        return 'user', target['target_user']
+    if target.get('target_group'):
+        return 'group', target['target_group']
+    return None
+
+
+class LocalCache:
+    def __init__(self, path):
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self.path = path
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        with self.conn:
+            self.conn.execute("CREATE TABLE IF NOT EXISTS state (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+            self.conn.execute("CREATE TABLE IF NOT EXISTS users (username TEXT PRIMARY KEY) WITHOUT ROWID")
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS members (
+                    group_name TEXT NOT NULL,
+                    username TEXT NOT NULL,
+                    PRIMARY KEY (group_name, username)
+                ) WITHOUT ROWID
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS conversations (
+                    kind TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    cursor INTEGER NOT NULL,
+                    PRIMARY KEY (kind, target)
+                ) WITHOUT ROWID
+            """)
+            self.conn.execute("""
+                CREATE TABLE IF NOT EXISTS messages (
+                    kind TEXT NOT NULL,
+                    target TEXT NOT NULL,
+                    seq INTEGER NOT NULL,
+                    sender TEXT NOT NULL,
+                    message TEXT NOT NULL,
+                    created_at REAL NOT NULL,
+                    file TEXT,
+                    PRIMARY KEY (kind, target, seq)
+                ) WITHOUT ROWID
+            """)
+
+    def close(self):
+        self.conn.close()
+
+    # sync
+
+    def state(self, name):
+        row = self.conn.execute("SELECT value FROM state WHERE name=?", (name,)).fetchone()
+        return row[0] if row else 0
+
+    def sync_request(self):
+        # os cursores que vão no comando 'sync'
+        conversations = [{"target_user" if kind == 'user' else "target_group": target, "seq": cursor}
+                         for kind, target, cursor in self.conn.execute("SELECT kind, target, cursor FROM conversations")]
+        return {"users_cursor": self.state('users_cursor'), "members_cursor": self.state('members_cursor'),
+                "conversations": conversations}
+
+    def apply(self, reply):
+        # grava uma resposta do 'sync' numa transação só: as msgs e o cursor que as
+        # cobre entram juntos (se cair no meio, o próximo sync pede de novo do mesmo ponto)
+        counts = {"users": len(reply['users']), "members": 0, "messages": 0}
+        with self.conn:
+            self.conn.executemany("INSERT OR IGNORE INTO users (username) VALUES (?)", ((name,) for name in reply['users']))
+            for entry in reply['members']:
+                if entry['full']:
+                    self.conn.execute("DELETE FROM members WHERE group_name=?", (entry['group'],))
+                self.conn.executemany("INSERT OR IGNORE INTO members (group_name, username) VALUES (?, ?)",
+                                      ((entry['group'], name) for name in entry['members']))
+                counts['members'] += len(entry['members'])
+            for entry in reply['conversations']:
+                kind, target = conversation_key(entry)
+                self._insert_messages(kind, target, entry['messages'])
+                self._set_cursor(kind, target, entry['cursor'])
+                counts['messages'] += len(entry['messages'])
+            self.conn.executemany("INSERT OR REPLACE INTO state (name, value) VALUES (?, ?)",
+                                  (('users_cursor', reply['users_cursor']), ('members_cursor', reply['members_cursor'])))
+        return counts
+
+    def _insert_messages(self, kind, target, messages):
+        self.conn.executemany(
+            "INSERT OR IGNORE INTO messages (kind, target, seq, sender, message, created_at, file) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            ((kind, target, m['seq'], m['sender'], m['message'], m['time'], json.dumps(m['file']) if m.get('file') else None)
+             for m in messages)
+        )
+
+    def _set_cursor(self, kind, target, cursor):
+        self.conn.execute(
+            "INSERT INTO conversations (kind, target, cursor) VALUES (?, ?, ?) "
+            "ON CONFLICT (kind, target) DO UPDATE SET cursor = MAX(cursor, excluded.cursor)",
+            (kind, target, cursor)
+        )
+
+    def store_page(self, kind, target, messages, latest=False):
+        # página que veio do 'history': entra no cache. o cursor só anda se ela encosta no
+        # que já tinha (senão ficaria um buraco que o sync não ia mais pedir); a última página
+        # de uma conversa que o cache ainda não tem vira o começo dela
+        if not messages:
+            return
+        seqs = [m['seq'] for m in messages]
+        with self.conn:
+            self._insert_messages(kind, target, messages)
+            row = self.conn.execute("SELECT cursor FROM conversations WHERE kind=? AND target=?", (kind, target)).fetchone()
+            if (row is None and latest) or (row is not None and min(seqs) <= row[0] + 1):
+                self._set_cursor(kind, target, max(seqs))
+
+    # leituras
+
+    def history(self, kind, target, before, limit=HISTORY_PAGE):
+        # a página antes de 'before' como o 'history' do servidor responderia, ou None se
+        # o cache não tem ela inteira
+        rows = self.conn.execute(
+            "SELECT seq, sender, message, created_at, file FROM messages WHERE kind=? AND target=? AND seq<? "
+            "ORDER BY seq DESC LIMIT ?",
+            (kind, target, before, limit)
+        ).fetchall()
+        # inteira = começa logo antes de 'before', sem buraco, e vai até o limite ou até a primeira msg
+        if before > 1 and (not rows or rows[0][0] != before - 1 or rows[0][0] - rows[-1][0] != len(rows) - 1):
+            return None
+        if rows and len(rows) < limit and rows[-1][0] != 1:
+            return None
+        rows.reverse()
+        messages = []
+        for seq, sender, message, created_at, file in rows:
+            item = {"seq": seq, "sender": sender, "message": message, "time": created_at}
+            if file:
+                item["file"] = json.loads(file)
+            messages.append(item)
+        first = messages[0]['seq'] if messages else 1
+        return {"type": "history", "conversation": {"type": kind, "target": target}, "messages": messages,
+                "next_cursor": first if first > 1 else None, "cached": True}
+
+    def users(self, prefix='', after='', limit=50):
+        # uma página do diretório em ordem alfabética, como o list_users (sem o online)
+        query = "SELECT username FROM users WHERE username > ?"
+        params = [after]
+        if prefix:
+            query += " AND substr(username, 1, ?) = ?"
+            params += [len(prefix), prefix]
+        rows = self.conn.execute(query + " ORDER BY username LIMIT ?", params + [limit]).fetchall()
+        return [row[0] for row in rows]
+
+    def groups(self, username):
+        # grupos do user com quantos membros cada um tem
+        return self.conn.execute(
+            "SELECT m.group_name, (SELECT COUNT(*) FROM members WHERE group_name = m.group_name) "
+            "FROM members m WHERE m.username=? ORDER BY m.group_name",
+            (username,)
+        ).fetchall()
+
+    def members(self, group_name):
+        return [row[0] for row in self.conn.execute("SELECT username FROM members WHERE group_name=? ORDER BY username", (group_name,))]
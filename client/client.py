@@ -1,93 +1,287 @@
-import socket
-import threading
-import json
+# cliente de terminal do chatinho: só menus e prints
+# a conversa com o servidor (conexão, req_id, reconexão) fica na ChatClient (chat_client.py),
+# que roda num event loop numa thread separada; o menu chama ela com call()
+import argparse
+import asyncio
 import os
+import threading
+import time
+
+from chat_client import ChatClient, ChatError, load_config
 
 # Variável global para controlar se o app está rodando
 running = True
 
-# Envia um dicionário como JSON para o servidor
-# Se der erro, avisa e encerra o programa
-def send_json(sock, data):
-    global running
+# Onde fica guardado o token do último login (pra voltar sem digitar senha)
+SESSION_FILE = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.chatinho_sessao')
+
+# Onde fica o cache local (users, grupos e msgs que já vieram), um arquivo por user
+CACHE_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '.chatinho_cache')
+
+# event loop da ChatClient (roda numa thread daemon, ver main())
+loop = None
+
+# anexos que já apareceram na tela (id -> referência), pro /baixar achar o nome
+seen_files = {}
+
+def load_session():
+    try:
+        with open(SESSION_FILE) as f:
+            return f.read().strip() or None
+    except OSError:
+        return None
+
+def save_session(token):
     try:
-        sock.send(json.dumps(data).encode('utf-8'))
-    except (ConnectionResetError, BrokenPipeError):
-        if running:
-            print("\n[CHATINHO | XABLAU] Opa, deu ruim! Não rolou enviar, conexão sumiu no rolê.")
-        running = False
-
-# Fica ouvindo mensagens do servidor e mostra na tela
-# Roda em uma thread separada
-def receive_messages(sock):
+        with open(SESSION_FILE, 'w') as f:
+            f.write(token)
+    except OSError:
+        pass
+
+# Roda uma chamada da ChatClient no event loop dela e espera o resultado
+# Erro do servidor vira mensagem na tela e o resultado fica None
+def call(coro):
+    try:
+        return asyncio.run_coroutine_threadsafe(coro, loop).result()
+    except ChatError as e:
+        show_message(e.response)
+    except asyncio.TimeoutError:
+        print("[CHATINHO | XABLAU] O servidor não respondeu, tenta de novo!")
+    except ConnectionError:
+        print("[CHATINHO | XABLAU] Opa, deu ruim! Tá sem conexão agora, espera voltar e tenta de novo.")
+    except OSError as e:
+        print(f"[CHATINHO | XABLAU] Problema com o arquivo: {e}")
+    return None
+
+# Texto de um anexo: nome, tamanho e como baixar
+def describe_file(ref):
+    seen_files[ref['id']] = ref
+    return f"[anexo] {ref['name']} ({ref['size']} bytes) - /baixar {ref['id'][:12]}"
+
+# Mostra na tela uma mensagem que veio do servidor
+def show_message(response):
+    if response.get('file'):
+        response = dict(response, message=describe_file(response['file']))
+    # Se for mensagem privada
+    if response.get('type') == 'chat_message':
+        print(f"\n[CHATINHO | Papinho a Dois de {response['sender']}]: {response['message']}")
+    # Se for mensagem de grupo
+    elif response.get('type') == 'group_message':
+        print(f"\n[CHATINHO | {response['group']} | {response['sender']}]: {response['message']}")
+    # Se alguém que a gente acompanha entrou ou saiu
+    elif response.get('type') == 'presence':
+        print(f"\n[CHATINHO | {response['user']} {'chegou no rolê' if response['online'] else 'vazou'}]")
+    # Foto de quem tá online na conversa que acabou de abrir
+    elif response.get('type') == 'presence_snapshot':
+        if response['online']:
+            print(f"\n[CHATINHO | ONLINE] {', '.join(response['online'])}")
+        if response['offline']:
+            print(f"[CHATINHO | OFFLINE] {', '.join(response['offline'])}")
+    # Números do servidor (comando 'stats', só pra admin)
+    elif response.get('type') == 'stats':
+        print("\n[CHATINHO | NÚMEROS DO SERVIDOR]")
+        for name, value in sorted(response['stats'].items()):
+            if isinstance(value, dict):
+                value = f"{value['count']}x, média {value['avg'] * 1000:.2f} ms" if 'seconds' in name else f"{value['count']}x, média {value['avg']:.1f}"
+            print(f"  {name}: {value}")
+    # A conexão caiu e a biblioteca tá tentando voltar sozinha
+    elif response.get('type') == 'disconnected':
+        print("\n[CHATINHO | XABLAU] Caiu a conexão! Tentando voltar...")
+        if response.get('error'):
+            print(f"[CHATINHO | XABLAU] Motivo: {response['error']}")
+    elif response.get('type') == 'reconnected':
+        if response['logged_in']:
+            print("\n[CHATINHO | INFO] Voltamos! Pode continuar o papo.")
+            if response.get('synced'):
+                show_synced(response['synced'])
+        else:
+            print(f"\n[CHATINHO | XABLAU] Reconectou, mas a sessão venceu ({response.get('message')}). Sai e entra de novo.")
+    # Se for outra resposta (erro, sucesso, info)
+    else:
+        status = response.get('status', 'info')
+        message = response.get('message', '')
+
+        if status == 'error':
+            print(f"\n[CHATINHO | XABLAU] {message} - OPS!")
+        elif status == 'success':
+            print(f"\n[CHATINHO | SUCESSO] {message} - UHUL!)")
+        else:
+            print(f"\n[CHATINHO | INFO] {message}")
+
+# Quanto o sync trouxe pro cache local
+def show_synced(synced):
+    if any(synced.values()):
+        print(f"[CHATINHO | INFO] Cache em dia: {synced['messages']} msgs, {synced['users']} usuários e {synced['members']} membros de grupo novos.")
+
+# Fica ouvindo os eventos que chegam do servidor e mostra na tela
+# (msgs, presença, avisos; as respostas dos pedidos vão direto pra quem pediu)
+async def print_events(client):
     global running
+    async for event in client:
+        show_message(event)
+    running = False
+
+# Mostra a galera e os grupos de página em página
+# Dá pra filtrar pelo começo do nome e ver só quem tá online
+# Com o cache ligado, a lista sai dele (sem rede); só quem tá online pergunta pro servidor
+def browse_directory(client):
+    prefix = input("\n[CHATINHO] Filtrar pelo começo do nome? (Enter = todo mundo)\nR: ").strip()
+    online_only = input("[CHATINHO] Só quem tá online? (s/N)\nR: ").strip().lower() == 's'
+
+    if client.cache is not None and not online_only:
+        browse_cache(client, prefix)
+        return
+
+    print("\n--- USUÁRIOS ---")
+    cursor = None
     while running:
-        try:
-            data_raw = sock.recv(4096)
-            if not data_raw:
-                if running:
-                    print("\n[CHATINHO | INFO] Ih, o servidor foi tomar um café e te deixou falando sozinho.")
-                break
-
-            response = json.loads(data_raw.decode('utf-8'))
-
-            # Se for mensagem privada
-            if response.get('type') == 'chat_message':
-                print(f"\n[CHATINHO | Papinho a Dois de {response['sender']}]: {response['message']}")
-            # Se for mensagem de grupo
-            elif response.get('type') == 'group_message':
-                print(f"\n[CHATINHO | {response['group']} | {response['sender']}]: {response['message']}")
-            # Se for outra resposta (erro, sucesso, info)
-            else:
-                status = response.get('status', 'info')
-                message = response.get('message', '')
-
-                if status == 'error':
-                    print(f"\n[CHATINHO | XABLAU] {message} - OPS!")
-                elif status == 'success':
-                    print(f"\n[CHATINHO | SUCESSO] {message} - UHUL!)")
-                else:
-                    print(f"\n[CHATINHO | INFO] {message}")
-
-        except (ConnectionResetError, json.JSONDecodeError):
-            if running:
-                print("\n[CHATINHO | XABLAU] O servidor bugou, chama o suporte!")
+        page = call(client.list_users(prefix, online_only, cursor))
+        if page is None:
+            return
+        for u in page['users']:
+            print(f"- {u['username']} {'(online)' if u['online'] else '(offline)'}")
+        if not page['users'] and cursor is None:
+            print("Ninguém por aqui.")
+        cursor = page.get('next_cursor')
+        if not cursor or input("[CHATINHO] Enter pra próxima página, 'q' pra parar: ").strip().lower() == 'q':
             break
-        except Exception as e:
-            if running and e:
-                print(f"\n[CHATINHO | XABLAU] Erro inesperado: {e} (bug sinistro!)")
+
+    print("\n--- MEUS GRUPOS ---")
+    cursor = None
+    while running:
+        page = call(client.list_groups(cursor))
+        if page is None:
+            return
+        for g in page['groups']:
+            print(f"- {g}")
+        if not page['groups'] and cursor is None:
+            print("Você não está em nenhum grupo.")
+        cursor = page.get('next_cursor')
+        if not cursor or input("[CHATINHO] Enter pra próxima página, 'q' pra parar: ").strip().lower() == 'q':
             break
 
-    print("\n[CHATINHO] Ouvinte cansou, sessão encerrada!")
-    running = False
+# A mesma coisa, lendo do cache local
+def browse_cache(client, prefix):
+    # antes, só o que mudou (se a conexão tiver caída, mostra o que já tem)
+    call(client.sync())
+    print("\n--- USUÁRIOS (do cache) ---")
+    cursor = None
+    while running:
+        page = call(client.cached_users(prefix, cursor))
+        if page is None:
+            return
+        for username in page['users']:
+            print(f"- {username}")
+        if not page['users'] and cursor is None:
+            print("Ninguém por aqui.")
+        cursor = page.get('next_cursor')
+        if not cursor or input("[CHATINHO] Enter pra próxima página, 'q' pra parar: ").strip().lower() == 'q':
+            break
+
+    print("\n--- MEUS GRUPOS (do cache) ---")
+    groups = call(client.cached_groups()) or []
+    for group_name, count in groups:
+        print(f"- {group_name} ({count} membros)")
+    if not groups:
+        print("Você não está em nenhum grupo.")
+
+# Mostra uma página do histórico (ou da busca), da mais velha pra mais nova
+def show_history(page, chat_type, chat_name):
+    messages = sorted(page['messages'], key=lambda m: m['seq'])
+    for m in messages:
+        when = time.strftime('%d/%m %H:%M', time.localtime(m['time']))
+        where = chat_name if chat_type == 'group' else 'Papinho a Dois'
+        text = describe_file(m['file']) if m.get('file') else m['message']
+        print(f"[{when} | {where} | {m['sender']}]: {text}")
 
 # Modo de conversa (papinho a dois ou grupo)
 # Envia mensagens até o usuário digitar /menu
 # Sai do chat e volta pro menu
-def start_chat_mode(sock, chat_type=None, chat_name=None):
+def start_chat_mode(client, chat_type=None, chat_name=None):
     if chat_type == 'group':
         print(f"\n[CHATINHO] Você entrou no grupão '{chat_name}'. Solta o papo aí!")
         print("[CHATINHO] Digite '/menu' se cansar do papo e quiser voltar pro menu.")
     else:
         print("\n[CHATINHO] Você entrou no modo Papinho a Dois. Manda ver!")
         print("[CHATINHO] Digite '/menu' se cansar do papo e quiser voltar pro menu.")
+    print("[CHATINHO] '/historico' mostra as msgs anteriores (de novo = mais antigas), '/busca palavra' procura na conversa.")
+    print("[CHATINHO] '/arquivo caminho' manda um arquivo, '/baixar id' baixa um anexo pra pasta atual.")
+    # o alvo vai explícito nos pedidos, então tudo continua certo mesmo depois de uma reconexão
+    target = {"target_group": chat_name} if chat_type == 'group' else {"target_user": chat_name}
+    history_cursor = None
     while running:
         msg = input()
         if not running:
              break
 
+        if msg == '/historico':
+            page = call(client.history(history_cursor, **target))
+            if page is not None:
+                show_history(page, chat_type, chat_name)
+                history_cursor = page.get('next_cursor')
+                if history_cursor is None:
+                    print("[CHATINHO] Esse é o começo da conversa.")
+            continue
+
+        if msg.startswith('/busca '):
+            page = call(client.search(msg[len('/busca '):], **target))
+            if page is not None:
+                show_history(page, chat_type, chat_name)
+                if not page['messages']:
+                    print("[CHATINHO] Nada encontrado.")
+            continue
+
+        if msg.startswith('/arquivo '):
+            path = os.path.expanduser(msg[len('/arquivo '):].strip())
+            if not os.path.isfile(path):
+                print("[CHATINHO | XABLAU] Arquivo não encontrado.")
+                continue
+            print("[CHATINHO] Mandando... (se cair no meio, manda de novo que continua de onde parou)")
+            ref = call(client.send_file(path, **target))
+            if ref is not None:
+                print(f"[CHATINHO | SUCESSO] {ref['name']} foi! ({ref['size']} bytes)")
+            continue
+
+        if msg.startswith('/baixar '):
+            prefix = msg[len('/baixar '):].strip()
+            ref = next((ref for file_id, ref in seen_files.items() if file_id.startswith(prefix)), None)
+            if ref is None or not prefix:
+                print("[CHATINHO | XABLAU] Anexo desconhecido (veja o id na msg ou no /historico).")
+                continue
+            path = os.path.basename(ref['name']) or ref['id']
+            if call(client.download(ref, path)) is not None:
+                print(f"[CHATINHO | SUCESSO] Salvo em {os.path.abspath(path)}")
+            continue
+
         if msg == '/menu':
-            send_json(sock, {"command": "leave_chat"})
+            call(client.leave_chat())
+            # para de acompanhar quem entra e sai dessa conversa
+            if chat_type == 'group':
+                call(client.unsubscribe(groups=[chat_name]))
+            else:
+                call(client.unsubscribe(users=[chat_name]))
             print("[CHATINHO] Voltando pro menu, sem ressentimentos...")
             break
 
         if msg:
-            send_json(sock, {"command": "send_message", "message": msg})
+            # send_dm/send_group reabrem a conversa no servidor se a conexão tiver caído no meio
+            if chat_type == 'group':
+                call(client.send_group(chat_name, msg))
+            else:
+                call(client.send_dm(chat_name, msg))
+
+# Abre uma conversa no servidor; devolve se deu certo
+def enter_chat(client, target_user=None, target_group=None):
+    response = call(client.select_chat(target_user, target_group))
+    if response is None:
+        return False
+    show_message(response)
+    return True
 
 # Mostra o menu principal e trata as opções do usuário
 # Aceita letras maiúsculas ou minúsculas
 # Chama as funções de acordo com a escolha
-def main_menu(sock):
+def main_menu(client):
     global running
     while running:
         print("\n     CHATINHO - MENU PRINCIPAL ")
@@ -97,6 +291,7 @@ def main_menu(sock):
         print("D. Criar um grupão")
         print("E. Chamar mais gente pro grupão")
         print("F. Meter o pé")
+        print("G. Números do servidor (só admin)")
 
         choice = input("[CHATINHO] E aí, qual vai ser?\nR: ").strip().upper()
 
@@ -104,61 +299,87 @@ def main_menu(sock):
             break
 
         if choice == 'A':
-            send_json(sock, {"command": "list_all"})
+            browse_directory(client)
 
         elif choice == 'B':
             target_user = input("\n[CHATINHO] Com quem vai ser o Papinho a Dois?\nR: ")
-            if target_user:
-                send_json(sock, {"command": "select_chat", "target_user": target_user})
-                start_chat_mode(sock, chat_type='user', chat_name=target_user)
+            # só entra no modo conversa se o servidor aceitar
+            if target_user and enter_chat(client, target_user=target_user):
+                # acompanha se a pessoa tá online enquanto conversa
+                presence = call(client.subscribe(users=[target_user]))
+                if presence:
+                    show_message(presence)
+                start_chat_mode(client, chat_type='user', chat_name=target_user)
 
         elif choice == 'C':
             target_group = input("\n[CHATINHO] Qual grupão vai receber o papo?\nR: ")
-            if target_group:
-                send_json(sock, {"command": "select_chat", "target_group": target_group})
-                start_chat_mode(sock, chat_type='group', chat_name=target_group)
+            if target_group and enter_chat(client, target_group=target_group):
+                presence = call(client.subscribe(groups=[target_group]))
+                if presence:
+                    show_message(presence)
+                start_chat_mode(client, chat_type='group', chat_name=target_group)
 
         elif choice == 'D':
             group_name = input("\n[CHATINHO] Nome do novo grupão?\nR: ")
             if group_name:
-                send_json(sock, {"command": "create_group", "group_name": group_name})
+                response = call(client.create_group(group_name))
+                if response:
+                    show_message(response)
 
         elif choice == 'E':
             group_name = input("\n[CHATINHO] Qual grupão?\nR: ")
             user_to_add = input(f"\n[CHATINHO] Quem vai entrar no grupão '{group_name}'?\nR: ")
             if group_name and user_to_add:
-                send_json(sock, {
-                    "command": "add_member_to_group",
-                    "group_name": group_name,
-                    "user_to_add": user_to_add
-                })
+                response = call(client.add_member(group_name, user_to_add))
+                if response:
+                    show_message(response)
 
         elif choice == 'F':
             running = False
-            sock.close()
             print("[CHATINHO] Falou, até a próxima!")
             break
+        elif choice == 'G':
+            response = call(client.stats())
+            if response:
+                show_message(response)
+
         else:
             print("[CHATINHO | XABLAU] Opção inválida, tenta de novo!")
 
 # Função principal do cliente
 # Conecta no servidor, faz login/cadastro e inicia o menu
-# Cria a thread para receber mensagens
+# Sobe o event loop da ChatClient e a tarefa que mostra os eventos
 # Encerra tudo ao sair
 
 def main():
-    global running
-    host = '0.tcp.sa.ngrok.io'
-    port = 19918
-
-    client_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    global running, loop
+    parser = argparse.ArgumentParser(description="Cliente de terminal do chatinho")
+    parser.add_argument("--config", default=None, help="arquivo com host/port (padrão: client/chatinho.json)")
+    parser.add_argument("--host", default=None)
+    parser.add_argument("--port", type=int, default=None)
+    parser.add_argument("--cache-dir", default=CACHE_DIR, help="pasta do cache local (users, grupos e msgs)")
+    parser.add_argument("--no-cache", action="store_true", help="não guarda nada em disco: toda conexão começa do zero")
+    args = parser.parse_args()
+
+    config = load_config(args.config)
+    host = args.host or config['host']
+    port = args.port or config['port']
+
+    loop = asyncio.new_event_loop()
+    threading.Thread(target=loop.run_forever, name="chat-client", daemon=True).start()
+
+    # a ChatClient nasce dentro do loop dela
+    async def open_client():
+        client = ChatClient(host, port, cache_dir=None if args.no_cache else args.cache_dir)
+        await client.connect()
+        return client
 
     try:
-        client_socket.connect((host, port))
+        client = asyncio.run_coroutine_threadsafe(open_client(), loop).result()
         print(f"[CHATINHO] Conectado! O rolê tá em {host}:{port}")
-    except ConnectionRefusedError:
+    except OSError:
         print(f"[CHATINHO | XABLAU] Não deu pra conectar em {host}:{port}.")
-        print("[CHATINHO] Vê se o servidor tá de pé ou se o endereço tá certo.")
+        print("[CHATINHO] Vê se o servidor tá de pé ou se o endereço tá certo (client/chatinho.json, --host/--port).")
         return
 
     # Loop de autenticação (login ou cadastro)
@@ -166,54 +387,48 @@ def main():
         print("\n   CHATINHO | TELA INICIAL ")
         print("1. Login ")
         print("2. Cadastro")
-        action = input("[CHATINHO] Qual vai ser? (1 ou 2): ")
-
-        username = input("[CHATINHO] Codinome: ")
-        password = input("[CHATINHO] Senha secreta: ")
-
-        if action == '1':
-            auth_command = 'login'
-        elif action == '2':
-            auth_command = 'register'
+        saved_token = load_session()
+        if saved_token:
+            print("3. Voltar pra última sessão (sem senha)")
+        action = input("[CHATINHO] Qual vai ser? (1, 2 ou 3): " if saved_token else "[CHATINHO] Qual vai ser? (1 ou 2): ")
+
+        if action == '3' and saved_token:
+            response = call(client.resume(saved_token))
+        elif action in ('1', '2'):
+            username = input("[CHATINHO] Codinome: ")
+            password = input("[CHATINHO] Senha secreta: ")
+            if action == '1':
+                response = call(client.login(username, password))
+            else:
+                response = call(client.register(username, password))
+                if response is not None:
+                    print(f"\n[CHATINHO | SUCCESS] {response['message']}")
+                continue
         else:
             print("[CHATINHO | XABLAU] Ação inválida, só vale 1 ou 2!")
             continue
 
-        send_json(client_socket, {
-            "command": auth_command,
-            "username": username,
-            "password": password
-        })
-
-        try:
-            response_raw = client_socket.recv(1024)
-            if not response_raw:
-                print("[CHATINHO | XABLAU] O servidor sumiu do mapa.")
-                return
-
-            response = json.loads(response_raw.decode('utf-8'))
-            print(f"\n[CHATINHO | {response['status'].upper()}] {response['message']}")
-
-            if response['status'] == 'success' and auth_command == 'login':
-                break
-
-        except (json.JSONDecodeError, ConnectionResetError):
-             print("[CHATINHO | XABLAU] Bugou na autenticação, tenta de novo!")
-             return
+        if response is not None:
+            print(f"\n[CHATINHO | SUCCESS] {response['message']}")
+            # guarda o token novo pra próxima vez
+            if response.get('token'):
+                save_session(response['token'])
+            # traz pro cache só o que mudou desde a última vez
+            synced = call(client.sync())
+            if synced:
+                show_synced(synced)
+            break
 
-    # Cria a thread para receber mensagens do servidor
-    receiver_thread = threading.Thread(target=receive_messages, args=(client_socket,))
-    receiver_thread.daemon = True
-    receiver_thread.start()
+    # Mostra o que chega do servidor enquanto o menu espera o input()
+    asyncio.run_coroutine_threadsafe(print_events(client), loop)
 
     try:
-        main_menu(client_socket)
+        main_menu(client)
     except KeyboardInterrupt:
         print("\n[CHATINHO] Saiu no sapatinho (Ctrl+C)...")
 
     running = False
-    client_socket.close()
-    receiver_thread.join(timeout=1)
+    asyncio.run_coroutine_threadsafe(client.close(), loop).result(timeout=1)
     print("[CHATINHO] Fim de papo, até mais!")
     os._exit(0)
 
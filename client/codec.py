@@ -0,0 +1 @@
+../server/codec.py
\ No newline at end of file
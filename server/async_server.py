@@ -0,0 +1,110 @@
+import asyncio
+import json
+import os
+import socket
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import protocol
+from server import ChatServer, CONCURRENT_COMMANDS
+from session import AsyncSession
+
+class AsyncChatServer(ChatServer):
+    # mesmo servidor (mesmos comandos, mesmo banco), mas em vez de uma thread
+    # por cliente usa um event loop por núcleo, todos aceitando no mesmo socket
+    def __init__(self, host='0.0.0.0', port=12345, backlog=128, loops=None, db_workers=None, **options):
+        super().__init__(host, port, backlog, **options)
+        self.loops = loops or os.cpu_count() or 1
+        # o sqlite bloqueia, então os comandos rodam num pool fora do loop
+        self.executor = ThreadPoolExecutor(max_workers=db_workers or 4 * self.loops, thread_name_prefix="db")
+        # login/registro esperam o PBKDF2; ficam num pool separado pra uma
+        # avalanche de logins não ocupar as threads de quem já tá conversando
+        self.auth_executor = ThreadPoolExecutor(max_workers=self.user_manager.max_pending, thread_name_prefix="auth")
+
+    def start(self):
+        self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self.listen()
+        self.server_socket.setblocking(False)
+        print(f"[Servidor] Escutando em {self.host}:{self.port} ({self.loops} event loop(s))")
+
+        # o primeiro loop roda na thread principal, os outros em threads próprias
+        for i in range(1, self.loops):
+            thread = threading.Thread(target=asyncio.run, args=(self.serve(),), name=f"loop-{i}")
+            thread.daemon = True
+            thread.start()
+        asyncio.run(self.serve())
+
+    async def serve(self):
+        # cada loop registra o mesmo socket de escuta; quem acordar primeiro aceita
+        server = await asyncio.start_server(self.handle_connection, sock=self.server_socket, backlog=self.backlog)
+        async with server:
+            await server.serve_forever()
+
+    async def read_messages(self, reader, decoder):
+        # versão async do protocol.read_messages
+        while True:
+            for message in decoder.messages():
+                yield message
+            chunk = await reader.read(protocol.RECV_SIZE)
+            if not chunk:
+                return
+            decoder.feed(chunk)
+
+    async def handle_connection(self, reader, writer):
+        loop = asyncio.get_running_loop()
+        addr = writer.get_extra_info('peername')
+        print(f"[Nova Conexão] Conexão de {addr} estabelecida.")
+        session = self.open_session(AsyncSession(loop, writer, addr, self.new_queue(),
+                                                       self.flush_delay, self.flush_bytes))
+        username = None
+        try:
+            # cumprimento 'CR' + versão (+ recursos), igual ao modo thread
+            decoder = protocol.FrameDecoder(on_receive=self.count_bytes_in)
+            while (greeting := decoder.read_handshake()) is None:
+                chunk = await reader.read(protocol.RECV_SIZE)
+                if not chunk:
+                    print(f"[{addr}] Cliente desconectou antes de autenticar.")
+                    return
+                decoder.feed(chunk)
+            self.start_session(session, *protocol.negotiate(*greeting))
+
+            messages = self.read_messages(reader, decoder)
+
+            # loop login/registro (mesma regra do modo thread)
+            async for auth_data in messages:
+                if self.heartbeat(session, auth_data):
+                    continue
+                username = await loop.run_in_executor(self.auth_executor, self.handle_auth, session, auth_data)
+                if username:
+                    break
+            else:
+                print(f"[{addr}] Cliente desconectou antes de autenticar.")
+                return
+
+            await loop.run_in_executor(self.executor, self.deliver_offline, session, username)
+
+            # loop menu: os comandos que mudam estado rodam um de cada vez, na ordem
+            # (select_chat antes dos send_message que vêm depois dele); os de leitura
+            # (CONCURRENT_COMMANDS) vão em paralelo, até max_inflight por conexão
+            inflight = asyncio.Semaphore(self.max_inflight)
+            pending = set()
+            async for data in messages:
+                if self.heartbeat(session, data):
+                    continue
+                if data.get('command') in CONCURRENT_COMMANDS:
+                    await inflight.acquire()
+                    task = loop.run_in_executor(self.executor, self.handle_concurrent, session, username, data)
+                    pending.add(task)
+                    task.add_done_callback(lambda t: (pending.discard(t), inflight.release()))
+                else:
+                    await loop.run_in_executor(self.executor, self.handle_command, session, username, data)
+            if pending:
+                await asyncio.wait(pending)
+
+        except (ConnectionResetError, json.JSONDecodeError, UnicodeDecodeError, protocol.ProtocolError) as e:
+            print(f"[Aviso] Conexão com '{username or addr}' foi perdida. Causa: {e}")
+        except Exception as e:
+            print(f"[ERRO] Ocorreu um erro com o cliente '{username or addr}': {e}")
+        finally:
+            # a faxina também mexe no banco (avisos de presença), então vai pro executor
+            await loop.run_in_executor(self.executor, self.disconnect, session, username)
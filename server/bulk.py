@@ -0,0 +1,263 @@
+# importação/exportação em massa de users, grupos e membros (ferramenta de admin)
+#
+# uso (com o servidor parado):
+#   python3 server/bulk.py import --db chat.db --users users.jsonl --groups grupos.csv --members membros.csv
+#   python3 server/bulk.py export --db chat.db --users users.jsonl --groups grupos.csv --members membros.csv
+#
+# formato pela extensão (.csv com cabeçalho, qualquer outra = JSONL, um objeto por linha):
+#   users:   username + password_hash (sal:hash[:iterações], o formato do banco)
+#            ou password (texto puro: o hash é feito aqui, em vários processos)
+#   groups:  name
+#   members: group + username (só entra se o grupo e o user existirem)
+#
+# - lê e escreve em streaming: a memória não depende do tamanho do arquivo
+# - grava em lotes grandes (executemany, uma transação por lote) pela thread writer do
+#   Database; enquanto um lote grava, o próximo já tá sendo lido e hasheado
+# - o índice (username, group_name) dos membros é refeito uma vez só, no fim
+# - cada lote grava junto, na mesma transação, até onde o arquivo já foi (tabela
+#   bulk_progress): se parar no meio, rodar de novo continua dali (--restart recomeça)
+# - quem já existe é ignorado (INSERT OR IGNORE), então repetir não duplica nada
+import argparse
+import csv
+import itertools
+import json
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+from database import Database, MEMBERS_BY_USER_INDEX, group_conversation
+from user import DEFAULT_ITERATIONS, hash_password, parse_hash
+
+# campos de cada tipo, o INSERT da importação e o SELECT da exportação
+KINDS = {
+    'users': (
+        ('username', 'password_hash'),
+        "INSERT OR IGNORE INTO users (username, password_hash) VALUES (?, ?)",
+        "SELECT username, password_hash FROM users ORDER BY username",
+    ),
+    'groups': (
+        ('name',),
+        "INSERT OR IGNORE INTO groups (name) VALUES (?)",
+        "SELECT name FROM groups ORDER BY name",
+    ),
+    'members': (
+        ('group', 'username'),
+        # cursor na última msg do grupo, igual ao Database.add_group_member
+        "INSERT OR IGNORE INTO group_members (group_name, username, last_seq) "
+        "SELECT ?1, ?2, COALESCE((SELECT seq FROM messages WHERE conversation=?3 ORDER BY seq DESC LIMIT 1), 0) "
+        "WHERE EXISTS (SELECT 1 FROM groups WHERE name=?1) AND EXISTS (SELECT 1 FROM users WHERE username=?2)",
+        "SELECT group_name, username FROM group_members ORDER BY group_name, username",
+    ),
+}
+ORDER = ('users', 'groups', 'members')  # membros por último: precisam dos outros dois
+
+
+def read_rows(path):
+    # cada registro do arquivo como dict (None = linha que não deu pra ler)
+    with open(path, newline='', encoding='utf-8') as f:
+        if path.endswith('.csv'):
+            yield from csv.DictReader(f)
+            return
+        for line in f:
+            if not line.strip():
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                yield None
+
+
+class RowWriter:
+    def __init__(self, path, fields):
+        self.fields = fields
+        self.file = open(path, 'w', newline='', encoding='utf-8')
+        self.csv = csv.writer(self.file) if path.endswith('.csv') else None
+        if self.csv:
+            self.csv.writerow(fields)
+
+    def write(self, row):
+        if self.csv:
+            self.csv.writerow(row)
+        else:
+            self.file.write(json.dumps(dict(zip(self.fields, row)), ensure_ascii=False) + '\n')
+
+    def close(self):
+        self.file.close()
+
+
+def text(item, key):
+    value = item.get(key) if isinstance(item, dict) else None
+    return value if isinstance(value, str) and value else None
+
+
+def valid_hash(value):
+    try:
+        parse_hash(value)
+        return True
+    except ValueError:
+        return False
+
+
+def convert(kind, chunk, pool, workers, iterations):
+    # registros do arquivo -> parâmetros do INSERT (os inválidos ficam de fora)
+    if kind == 'groups':
+        return [(name,) for name in map(lambda item: text(item, 'name'), chunk) if name]
+    if kind == 'members':
+        pairs = [(text(item, 'group'), text(item, 'username')) for item in chunk]
+        return [(group, username, group_conversation(group)) for group, username in pairs if group and username]
+
+    rows, passwords = [], []
+    for item in chunk:
+        username, stored, password = text(item, 'username'), text(item, 'password_hash'), text(item, 'password')
+        if not username:
+            continue
+        if stored and valid_hash(stored):
+            rows.append((username, stored))
+        elif password and not stored:
+            rows.append((username, None))
+            passwords.append(password)
+    if passwords:
+        # o PBKDF2 é o que pesa: vai em paralelo nos processos, em pedaços
+        hashes = iter(pool.map(hash_password, passwords, itertools.repeat(iterations),
+                               chunksize=max(1, len(passwords) // (4 * workers))))
+        rows = [(username, stored or next(hashes)) for username, stored in rows]
+    return rows
+
+
+def save_batch(conn, sql, params, source, position):
+    # roda na thread writer: o lote e o progresso entram no mesmo commit
+    before = conn.total_changes
+    conn.executemany(sql, params)
+    inserted = conn.total_changes - before
+    conn.execute("INSERT OR REPLACE INTO bulk_progress (source, position) VALUES (?, ?)", (source, position))
+    return inserted
+
+
+class Progress:
+    # linhas por segundo de tempos em tempos e no fim
+    def __init__(self, label, start_at=0, counts=True):
+        self.label = label
+        self.counts = counts  # mostra gravadas/ignoradas (só na importação)
+        self.rows = start_at
+        self.start_at = start_at
+        self.inserted = 0
+        self.skipped = 0
+        self.started = self.last = time.perf_counter()
+
+    def add(self, rows, inserted=0, skipped=0, force=False):
+        self.rows += rows
+        self.inserted += inserted
+        self.skipped += skipped
+        now = time.perf_counter()
+        if force or now - self.last >= 2:
+            self.last = now
+            elapsed = max(now - self.started, 1e-9)
+            counts = f", {self.inserted} gravadas, {self.skipped} ignoradas" if self.counts else ""
+            print(f"[bulk] {self.label}: {self.rows} linhas ({(self.rows - self.start_at) / elapsed:.0f}/s){counts}", flush=True)
+
+
+def finish(progress, future, rows):
+    # espera o lote gravar; ignoradas = inválidas + as que já existiam
+    inserted = future.result()
+    progress.add(rows, inserted, rows - inserted)
+
+
+def import_file(db, kind, path, pool, workers, batch_size, iterations, restart):
+    _, sql, _ = KINDS[kind]
+    source = f"{kind}:{os.path.abspath(path)}"
+    done = 0
+    if not restart:
+        row = db.conn.execute("SELECT position FROM bulk_progress WHERE source=?", (source,)).fetchone()
+        done = row[0] if row else 0
+    if done:
+        print(f"[bulk] {kind}: continuando depois da linha {done}")
+    progress = Progress(f"{kind} ({os.path.basename(path)})", done)
+
+    records = itertools.islice(read_rows(path), done, None)
+    position = done
+    pending = None  # lote que tá gravando: no máximo um, pro writer não acumular memória
+    while chunk := list(itertools.islice(records, batch_size)):
+        position += len(chunk)
+        params = convert(kind, chunk, pool, workers, iterations)
+        if pending is not None:
+            finish(progress, *pending)
+        future = db.write(lambda conn, params=params, position=position: save_batch(conn, sql, params, source, position))
+        pending = (future, len(chunk))
+    if pending is not None:
+        finish(progress, *pending)
+    progress.add(0, force=True)
+
+
+def export_file(db, kind, path):
+    fields, _, select = KINDS[kind]
+    progress = Progress(f"{kind} -> {os.path.basename(path)}", counts=False)
+    out = RowWriter(path, fields)
+    try:
+        count = 0
+        for row in db.conn.execute(select):  # o cursor vai lendo aos poucos
+            out.write(row)
+            count += 1
+            if count == 10000:
+                progress.add(count)
+                count = 0
+        progress.add(count, force=True)
+    finally:
+        out.close()
+
+
+def run_import(db, files, args):
+    db.write("CREATE TABLE IF NOT EXISTS bulk_progress (source TEXT PRIMARY KEY, position INTEGER NOT NULL)").result()
+    if 'members' in files:
+        # índice secundário refeito uma vez no fim é bem mais rápido que atualizado linha a linha
+        # (se parar no meio, o Database cria de novo na próxima subida)
+        db.write("DROP INDEX IF EXISTS idx_group_members_user").result()
+    workers = args.workers or os.cpu_count() or 1
+    with ProcessPoolExecutor(workers) as pool:
+        for kind in ORDER:
+            if kind in files:
+                import_file(db, kind, files[kind], pool, workers, args.batch, args.iterations, args.restart)
+    if 'members' in files:
+        start = time.perf_counter()
+        db.write(MEMBERS_BY_USER_INDEX).result()
+        print(f"[bulk] índice dos membros refeito em {time.perf_counter() - start:.2f}s")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Importa/exporta users, grupos e membros em massa (JSONL ou CSV)")
+    parser.add_argument("action", choices=["import", "export"])
+    parser.add_argument("--db", default="chat.db", help="arquivo do banco")
+    parser.add_argument("--users", help="arquivo de users (username + password_hash ou password)")
+    parser.add_argument("--groups", help="arquivo de grupos (name)")
+    parser.add_argument("--members", help="arquivo de membros (group + username)")
+    parser.add_argument("--batch", type=int, default=50000, help="linhas por transação")
+    parser.add_argument("--workers", type=int, default=None, help="processos pro PBKDF2 (padrão: nº de núcleos)")
+    parser.add_argument("--iterations", type=int, default=DEFAULT_ITERATIONS, help="iterações do PBKDF2 pras senhas em texto")
+    parser.add_argument("--restart", action="store_true", help="ignora o progresso salvo e lê os arquivos do começo")
+    parser.add_argument("--synchronous", choices=["OFF", "NORMAL", "FULL"], default="NORMAL", help="PRAGMA synchronous do sqlite")
+    args = parser.parse_args()
+
+    files = {kind: getattr(args, kind) for kind in ORDER if getattr(args, kind)}
+    if not files:
+        parser.error("diga pelo menos um arquivo (--users, --groups ou --members)")
+
+    # sem snapshot do índice: ele foi carregado antes da importação e ficaria velho
+    # (o servidor relê tudo na próxima subida, porque o banco mudou)
+    db = Database(args.db, synchronous=args.synchronous, cache_size_kb=65536, identity_snapshot=None)
+    start = time.perf_counter()
+    try:
+        if args.action == "import":
+            run_import(db, files, args)
+        else:
+            for kind in ORDER:
+                if kind in files:
+                    export_file(db, kind, files[kind])
+        print(f"[bulk] pronto em {time.perf_counter() - start:.1f}s")
+    except KeyboardInterrupt:
+        print("[bulk] interrompido; rode de novo pra continuar de onde parou", file=sys.stderr)
+    finally:
+        db.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,290 @@
+# modo cluster: vários processos servidor (cada um com seus sockets) trabalhando juntos
+#
+#   cliente -> [nó 0] \
+#   cliente -> [nó 1] --- broker (socket unix) --- quem tá online em qual nó
+#   cliente -> [nó 2] /
+#
+# - os nós escutam na mesma porta (SO_REUSEPORT) e o kernel distribui as conexões
+# - o banco (chat.db) é o mesmo arquivo pra todos (WAL aguenta vários processos)
+# - o broker guarda quem tá logado em qual nó e repassa as entregas: msg pra quem
+#   tá em outro nó vai pelo broker até o nó dono do socket dele
+#
+# o "barramento" (bus) é plugável: qualquer classe com start/send/close que chame
+# on_message com os dicts que chegam serve (ex: uma versão em cima de redis).
+# a padrão é a UnixSocketBus, que conversa com o BusBroker daqui de baixo
+import itertools
+import os
+import socket
+import threading
+from concurrent.futures import Future
+
+import protocol
+
+CLAIM_TIMEOUT = 5  # segundos esperando o broker responder um login
+
+
+class Bus:
+    # interface do barramento
+    def start(self, node_id, on_message):
+        raise NotImplementedError
+
+    def send(self, message):
+        # manda um dict pro broker (ele decide pra qual nó vai)
+        raise NotImplementedError
+
+    def close(self):
+        pass
+
+
+class UnixSocketBus(Bus):
+    # conexão do nó com o broker local, com os mesmos quadros do protocolo do chat
+    def __init__(self, path):
+        self.path = path
+        self.sock = None
+        self.lock = threading.Lock()
+
+    def start(self, node_id, on_message):
+        self.sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.sock.connect(self.path)
+        self.on_message = on_message
+        self.send({"op": "hello", "node": node_id})
+        thread = threading.Thread(target=self._reader, name="bus", daemon=True)
+        thread.start()
+
+    def send(self, message):
+        frame = protocol.encode(message)
+        with self.lock:
+            self.sock.sendall(frame)
+
+    def _reader(self):
+        try:
+            for message in protocol.read_messages(self.sock, protocol.FrameDecoder()):
+                self.on_message(message)
+        except (OSError, protocol.ProtocolError) as e:
+            print(f"[Cluster] Conexão com o broker caiu: {e}")
+            return
+        print("[Cluster] Broker fechou a conexão.")
+
+    def close(self):
+        try:
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class BusBroker:
+    # processo central: sabe em qual nó cada user tá e repassa as mensagens
+    # é pequeno de propósito (poucos nós, uma thread por nó)
+    def __init__(self, path):
+        self.path = path
+        self.nodes = {}   # id do nó -> (socket, lock de escrita)
+        self.owners = {}  # user -> id do nó onde ele tá logado
+        self.lock = threading.Lock()
+
+    def start(self):
+        if os.path.exists(self.path):
+            os.unlink(self.path)  # sobra de uma execução anterior
+        self.server_socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.server_socket.bind(self.path)
+        self.server_socket.listen()
+        thread = threading.Thread(target=self._accept_loop, name="broker", daemon=True)
+        thread.start()
+        print(f"[Cluster] Broker escutando em {self.path}")
+
+    def _accept_loop(self):
+        while True:
+            try:
+                sock, _ = self.server_socket.accept()
+            except OSError:
+                return
+            threading.Thread(target=self._handle_node, args=(sock,), daemon=True).start()
+
+    def _send(self, node_id, message):
+        node = self.nodes.get(node_id)
+        if node is None:
+            return False
+        sock, lock = node
+        try:
+            with lock:
+                sock.sendall(protocol.encode(message))
+        except OSError:
+            return False
+        return True
+
+    def _broadcast(self, message, skip=None):
+        for node_id in list(self.nodes):
+            if node_id != skip:
+                self._send(node_id, message)
+
+    def _handle_node(self, sock):
+        node_id = None
+        try:
+            for message in protocol.read_messages(sock, protocol.FrameDecoder()):
+                op = message.get('op')
+                if op == 'hello':
+                    node_id = message['node']
+                    with self.lock:
+                        self.nodes[node_id] = (sock, threading.Lock())
+                        snapshot = dict(self.owners)
+                    # nó novo recebe a foto de quem já tá online no cluster
+                    self._send(node_id, {"op": "snapshot", "owners": snapshot})
+                    print(f"[Cluster] Nó {node_id} entrou.")
+                elif op == 'claim':
+                    # login: só passa se ninguém tiver esse user em nenhum nó
+                    user = message['user']
+                    with self.lock:
+                        ok = user not in self.owners
+                        if ok:
+                            self.owners[user] = node_id
+                    self._send(node_id, {"op": "claimed", "req": message['req'], "ok": ok})
+                    if ok:
+                        self._broadcast({"op": "presence", "user": user, "node": node_id, "online": True}, skip=node_id)
+                elif op == 'release':
+                    self._release(node_id, [message['user']])
+                elif op == 'deliver':
+                    self._send(message['to'], message)
+                elif op == 'broadcast':
+                    self._broadcast(message, skip=node_id)
+        except (OSError, protocol.ProtocolError) as e:
+            print(f"[Cluster] Erro com o nó {node_id}: {e}")
+        finally:
+            # nó caiu: todo mundo que tava nele fica offline
+            if node_id is not None:
+                with self.lock:
+                    self.nodes.pop(node_id, None)
+                    users = [user for user, owner in self.owners.items() if owner == node_id]
+                self._release(node_id, users)
+                print(f"[Cluster] Nó {node_id} saiu ({len(users)} user(s) desconectado(s)).")
+            sock.close()
+
+    def _release(self, node_id, users):
+        for user in users:
+            with self.lock:
+                if self.owners.get(user) != node_id:
+                    continue
+                del self.owners[user]
+            self._broadcast({"op": "presence", "user": user, "node": node_id, "online": False}, skip=node_id)
+
+    def close(self):
+        self.server_socket.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+
+class ClusterRouter:
+    # o lado do nó: cópia local de "quem tá em qual nó" (mantida pelos avisos
+    # do broker) e o envio das entregas pros outros nós
+    def __init__(self, bus, node_id):
+        self.bus = bus
+        self.node_id = node_id
+        self.owners = {}  # user -> nó (inclui os deste nó)
+        self.lock = threading.Lock()
+        self.pending = {}  # pedidos de login esperando resposta do broker
+        self.request_ids = itertools.count(1)
+        self.server = None
+
+    def start(self, server):
+        self.server = server
+        self.bus.start(self.node_id, self.on_message)
+
+    # presença do cluster inteiro (o servidor usa pra saber quem tá online)
+
+    def locate(self, username):
+        # em qual nó o user tá (None = offline)
+        with self.lock:
+            return self.owners.get(username)
+
+    def __contains__(self, username):
+        return self.locate(username) is not None
+
+    def __iter__(self):
+        with self.lock:
+            return iter(list(self.owners))
+
+    def __len__(self):
+        return len(self.owners)
+
+    def claim(self, username):
+        # pede pro broker o "direito" de logar esse user aqui; False se já tá em outro lugar
+        req = next(self.request_ids)
+        future = Future()
+        self.pending[req] = future
+        try:
+            self.bus.send({"op": "claim", "user": username, "req": req})
+            ok = future.result(timeout=CLAIM_TIMEOUT)
+        except Exception as e:
+            print(f"[Cluster] Broker não respondeu o login de '{username}': {e}")
+            ok = False
+            # o claim pode ter passado no broker e a resposta só não chegou a tempo: sem
+            # isso o user ficaria preso nesse nó. o broker lê tudo de um nó em ordem, então
+            # o release vem depois do claim, e só solta se o dono for mesmo esse nó
+            try:
+                self.bus.send({"op": "release", "user": username})
+            except OSError:
+                pass  # barramento caiu: o broker já solta tudo desse nó
+        finally:
+            self.pending.pop(req, None)
+        if ok:
+            with self.lock:
+                self.owners[username] = self.node_id
+        return ok
+
+    def release(self, username):
+        with self.lock:
+            if self.owners.get(username) == self.node_id:
+                del self.owners[username]
+        self.bus.send({"op": "release", "user": username})
+
+    # entregas pra outros nós
+
+    def route(self, usernames, data):
+        # manda a mesma mensagem pros users dessa lista, um pacote por nó
+        by_node = {}
+        with self.lock:
+            for username in usernames:
+                node = self.owners.get(username)
+                if node is not None and node != self.node_id:
+                    by_node.setdefault(node, []).append(username)
+        for node, users in by_node.items():
+            self.bus.send({"op": "deliver", "to": node, "users": users, "data": data})
+        return sum(len(users) for users in by_node.values())
+
+    def invalidate_group(self, group_name):
+        # um grupo mudou aqui: os outros nós releem ele do banco pro índice em memória
+        self.bus.send({"op": "broadcast", "kind": "invalidate_group", "group": group_name})
+
+    def user_registered(self, username):
+        # user novo: os outros nós põem ele no índice deles
+        self.bus.send({"op": "broadcast", "kind": "new_user", "user": username})
+
+    # o que chega do broker (roda na thread do barramento)
+
+    def on_message(self, message):
+        op = message.get('op')
+        if op == 'claimed':
+            future = self.pending.get(message['req'])
+            if future is not None:
+                future.set_result(message['ok'])
+        elif op == 'deliver':
+            self.server.deliver_routed(message['users'], message['data'])
+        elif op == 'presence':
+            user = message['user']
+            with self.lock:
+                if message['online']:
+                    self.owners[user] = message['node']
+                elif self.owners.get(user) == message['node']:
+                    del self.owners[user]
+            # avisa quem acompanha esse user neste nó
+            self.server.notify_presence(None, user, message['online'])
+        elif op == 'snapshot':
+            with self.lock:
+                self.owners.update(message['owners'])
+        elif op == 'broadcast' and message.get('kind') == 'invalidate_group':
+            self.server.db.reload_group(message['group'])
+        elif op == 'broadcast' and message.get('kind') == 'new_user':
+            # o nó que cadastrou já gravou
+            self.server.db.identity.add_user(message['user'], committed=True)
+
+    def close(self):
+        self.bus.close()
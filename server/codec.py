@@ -0,0 +1,207 @@
+# formato binário compacto, alternativa ao JSON (negociado no cumprimento, ver protocol.py)
+# só usa a biblioteca padrão. a ideia é não mandar de novo em toda mensagem
+# as mesmas chaves ("type", "sender"...) e os mesmos valores ("group_message"...):
+#
+# - as mensagens mais comuns têm um "opcode" (1 byte) e os campos vão em ordem fixa, sem chave
+# - o resto vai no formato genérico: cada valor com 1 byte de tipo, chaves e
+#   valores conhecidos viram números pequenos (índices nas tabelas abaixo)
+#
+# as tabelas só podem CRESCER no fim (mudar a ordem quebra quem já usa)
+import struct
+
+KEYS = [
+    "type", "command", "status", "message", "sender", "group", "user", "online",
+    "cursor", "more", "messages", "users", "groups", "username", "password", "token",
+    "token_ttl", "target_user", "target_group", "group_name", "user_to_add", "prefix",
+    "online_only", "limit", "next_cursor", "retry_after", "stats", "offline",
+    "seq", "time", "before", "after", "query", "conversation", "req_id", "throttled",
+    "file", "id", "name", "size", "sha256", "transfer", "offset", "chunk_size",
+    "users_cursor", "members_cursor", "conversations", "members", "full",
+]
+SYMBOLS = [
+    "chat_message", "group_message", "presence", "presence_snapshot", "offline_batch",
+    "directory", "group_list", "success", "error", "info", "register", "login", "resume",
+    "list_all", "list_users", "list_groups", "send_message", "select_chat", "create_group",
+    "add_member_to_group", "leave_chat", "ack_offline", "queue_stats", "subscribe", "unsubscribe",
+    "stats", "history", "search", "search_results", "ping", "pong",
+    "group_batch", "ack_group",
+    "upload_file", "upload_ready", "upload_done", "download_file", "download_ready",
+    "sync",
+]
+# (chave que identifica, valor, campos na ordem) -> opcode = posição + 1
+SCHEMAS = [
+    ("type", "chat_message", ("sender", "message")),
+    ("type", "group_message", ("group", "sender", "message")),
+    ("type", "presence", ("user", "online")),
+    ("command", "send_message", ("message",)),
+    ("status", "success", ("message",)),
+    ("status", "error", ("message",)),
+    ("status", "info", ("message",)),
+]
+
+KEY_IDS = {key: i for i, key in enumerate(KEYS)}
+SYMBOL_IDS = {symbol: i for i, symbol in enumerate(SYMBOLS)}
+SCHEMA_IDS = {(key, value): (i + 1, fields) for i, (key, value, fields) in enumerate(SCHEMAS)}
+DISCRIMINATORS = ("type", "command", "status")
+
+# tipos dos valores no formato genérico
+T_NONE, T_FALSE, T_TRUE, T_INT, T_STR, T_SYM, T_LIST, T_DICT, T_FLOAT = range(9)
+DOUBLE = struct.Struct('!d')
+
+
+class CodecError(ValueError):
+    pass
+
+
+def _varint(out, n):
+    while n >= 0x80:
+        out.append((n & 0x7F) | 0x80)
+        n >>= 7
+    out.append(n)
+
+
+def _write(out, value):
+    t = type(value)
+    if t is str:
+        symbol = SYMBOL_IDS.get(value)
+        if symbol is not None:
+            out.append(T_SYM)
+            _varint(out, symbol)
+        else:
+            raw = value.encode('utf-8')
+            out.append(T_STR)
+            _varint(out, len(raw))
+            out += raw
+    elif value is None:
+        out.append(T_NONE)
+    elif t is bool:
+        out.append(T_TRUE if value else T_FALSE)
+    elif t is int:
+        out.append(T_INT)
+        # zigzag: negativos pequenos também viram números pequenos
+        _varint(out, value << 1 if value >= 0 else ((-value) << 1) - 1)
+    elif t is dict:
+        out.append(T_DICT)
+        _varint(out, len(value))
+        for key, item in value.items():
+            key_id = KEY_IDS.get(key)
+            if key_id is not None:
+                _varint(out, key_id + 1)
+            else:
+                raw = key.encode('utf-8')
+                out.append(0)
+                _varint(out, len(raw))
+                out += raw
+            _write(out, item)
+    elif t is list or t is tuple:
+        out.append(T_LIST)
+        _varint(out, len(value))
+        for item in value:
+            _write(out, item)
+    elif t is float:
+        out.append(T_FLOAT)
+        out += DOUBLE.pack(value)
+    else:
+        raise TypeError(f"não sei codificar {t.__name__}")
+
+
+def dumps(data):
+    # dict (ou lista) -> bytes
+    if type(data) is dict:
+        for key in DISCRIMINATORS:
+            value = data.get(key)
+            if value is None:
+                continue
+            schema = SCHEMA_IDS.get((key, value))
+            if schema is not None:
+                opcode, fields = schema
+                if len(data) == len(fields) + 1 and all(field in data for field in fields):
+                    out = bytearray((opcode,))
+                    for field in fields:
+                        _write(out, data[field])
+                    return bytes(out)
+            break
+    out = bytearray((0,))
+    _write(out, data)
+    return bytes(out)
+
+
+def _read_varint(buf, pos):
+    n = buf[pos]
+    pos += 1
+    if n < 0x80:
+        return n, pos
+    n &= 0x7F
+    shift = 7
+    while True:
+        byte = buf[pos]
+        pos += 1
+        n |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return n, pos
+        shift += 7
+
+
+def _read(buf, pos):
+    tag = buf[pos]
+    pos += 1
+    if tag == T_STR:
+        size, pos = _read_varint(buf, pos)
+        end = pos + size
+        if end > len(buf):
+            raise CodecError("texto passa do fim do quadro")
+        return str(buf[pos:end], 'utf-8'), end
+    if tag == T_SYM:
+        symbol, pos = _read_varint(buf, pos)
+        return SYMBOLS[symbol], pos
+    if tag == T_INT:
+        n, pos = _read_varint(buf, pos)
+        return (n >> 1) if not n & 1 else -((n + 1) >> 1), pos
+    if tag == T_TRUE:
+        return True, pos
+    if tag == T_FALSE:
+        return False, pos
+    if tag == T_NONE:
+        return None, pos
+    if tag == T_DICT:
+        count, pos = _read_varint(buf, pos)
+        out = {}
+        for _ in range(count):
+            key_id, pos = _read_varint(buf, pos)
+            if key_id:
+                key = KEYS[key_id - 1]
+            else:
+                size, pos = _read_varint(buf, pos)
+                key = str(buf[pos:pos + size], 'utf-8')
+                pos += size
+            out[key], pos = _read(buf, pos)
+        return out, pos
+    if tag == T_LIST:
+        count, pos = _read_varint(buf, pos)
+        out = []
+        for _ in range(count):
+            item, pos = _read(buf, pos)
+            out.append(item)
+        return out, pos
+    if tag == T_FLOAT:
+        return DOUBLE.unpack_from(buf, pos)[0], pos + DOUBLE.size
+    raise CodecError(f"tipo desconhecido: {tag}")
+
+
+def loads(buf):
+    # bytes -> dict (ou lista)
+    try:
+        opcode = buf[0]
+        if opcode == 0:
+            value, pos = _read(buf, 1)
+        else:
+            key, discriminator, fields = SCHEMAS[opcode - 1]
+            value = {key: discriminator}
+            pos = 1
+            for field in fields:
+                value[field], pos = _read(buf, pos)
+    except (IndexError, UnicodeDecodeError, struct.error) as e:
+        raise CodecError(f"mensagem binária inválida: {e}") from e
+    if pos != len(buf):
+        raise CodecError("sobrou lixo no fim da mensagem binária")
+    return value
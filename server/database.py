@@ -1,134 +1,778 @@
 # sqlite3 pra criar e mexer no banco
 import sqlite3
+import threading
+import queue
+import time
+import functools
+import os
+import zlib
+from concurrent.futures import Future
 
-class Database:
-    def __init__(self, db_path="chat.db"):
-        # precisa do check_same_thread=False pq várias threads vão usar o banco
-        self.conn = sqlite3.connect(db_path, check_same_thread=False)
+from metrics import DISABLED
+from identity import IdentityIndex
+
+# consultas que aparecem em chat_db_query_seconds (rótulo = nome do método)
+TIMED_QUERIES = (
+    'user_in_table', 'create_user', 'get_user_password_hash', 'list_users',
+    'save_message', 'get_offline_batch', 'delete_offline_up_to',
+    'create_group', 'add_group_member', 'get_group_members', 'reload_group',
+    'get_groups_for_user', 'list_groups_for_user',
+    'append_history', 'history_before', 'history_after', 'search_history',
+    'group_backlog', 'set_group_cursor', 'save_group_cursors',
+    'save_file', 'file_conversations',
+    'users_since', 'members_since', 'conversation_head', 'dm_peers',
+)
+
+
+def dm_conversation(user_a, user_b):
+    # id da conversa de DM: mesmo valor nos dois sentidos
+    # (\x1f é o "separador de unidade" do ASCII, ninguém digita isso num nome)
+    first, second = sorted((user_a, user_b))
+    return f"dm:{first}\x1f{second}"
+
+
+def group_conversation(group_name):
+    return f"group:{group_name}"
+
+
+def dm_users(conversation):
+    # os dois users de uma conversa de DM (None se for de grupo)
+    if not conversation.startswith('dm:'):
+        return None
+    return conversation[3:].split('\x1f')
+
+
+def add_column(conn, table, column, definition):
+    # banco de uma versão anterior: cria a coluna nova (devolve se precisou)
+    columns = [row[1] for row in conn.execute(f"PRAGMA table_info({table})")]
+    if column in columns:
+        return False
+    conn.execute(f"ALTER TABLE {table} ADD COLUMN {column} {definition}")
+    return True
+
+
+# msgs offline: a tabela é a mesma no banco principal e em cada shard
+OFFLINE_TABLE = """
+    CREATE TABLE IF NOT EXISTS offline_messages (
+        id INTEGER PRIMARY KEY AUTOINCREMENT,
+        sender TEXT NOT NULL,
+        receiver TEXT NOT NULL,
+        message TEXT NOT NULL,
+        timestamp DATETIME DEFAULT CURRENT_TIMESTAMP,
+        file TEXT
+    )
+"""
+
+
+def create_offline_table(conn):
+    # guarda mensagens enviadas quando o user tá offline
+    conn.execute(OFFLINE_TABLE)
+    # file: referência de anexo (JSON {"id", "name", "size"}, ver files.py), o arquivo não vem junto
+    add_column(conn, 'offline_messages', 'file', 'TEXT')
+    # índice pra achar as msgs de um user em ordem sem varrer a tabela toda
+    conn.execute("CREATE INDEX IF NOT EXISTS idx_offline_receiver ON offline_messages (receiver, id)")
+
+
+def shard_path(db_path, index, count):
+    # o número de shards vai no nome: arquivos de layouts diferentes convivem durante o rebalance
+    return f"{db_path}.offline-{index}-of-{count}"
+
+
+def shard_index(receiver, count):
+    # crc32: o mesmo valor em todo processo e versão do python (o hash() muda a cada execução)
+    return zlib.crc32(receiver.encode('utf-8', 'surrogatepass')) % count
+
+
+def read_layout(conn):
+    # quantos shards de msgs offline o banco usa (0 = tabela no próprio banco principal)
+    conn.execute("CREATE TABLE IF NOT EXISTS storage_layout (name TEXT PRIMARY KEY, value INTEGER NOT NULL)")
+    row = conn.execute("SELECT value FROM storage_layout WHERE name='offline_shards'").fetchone()
+    return row[0] if row else 0
+
+
+def write_layout(conn, count):
+    conn.execute("INSERT OR REPLACE INTO storage_layout (name, value) VALUES ('offline_shards', ?)", (count,))
+
+
+def count_offline(db_path, count):
+    # msgs guardadas no layout 'count' (arquivo que não existe conta zero)
+    paths = [db_path] if count == 0 else [shard_path(db_path, i, count) for i in range(count)]
+    total = 0
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        conn = sqlite3.connect(path)
+        try:
+            total += conn.execute("SELECT COUNT(*) FROM offline_messages").fetchone()[0]
+        except sqlite3.OperationalError:
+            pass  # shard sem a tabela
+        finally:
+            conn.close()
+    return total
+
+
+# seq da última msg do grupo da linha de group_members (parâmetro: group_conversation(''))
+# (ORDER BY + LIMIT 1 lê só a última entrada da chave, o MAX podia percorrer a conversa toda)
+GROUP_HEAD = ("SELECT COALESCE((SELECT seq FROM messages WHERE conversation = ? || group_members.group_name "
+              "ORDER BY seq DESC LIMIT 1), 0)")
+
+# a chave primária de group_members começa pelo grupo; pra achar os grupos de um user precisa desse
+MEMBERS_BY_USER_INDEX = "CREATE INDEX IF NOT EXISTS idx_group_members_user ON group_members (username, group_name)"
+
+
+def fts_query(text):
+    # cada palavra vira um termo entre aspas (todas precisam aparecer), assim o
+    # que o user digita nunca é interpretado como sintaxe do FTS5
+    return " ".join('"' + word.replace('"', '""') + '"' for word in text.split())
+
+
+def timed(metrics, method):
+    # embrulha um método do banco medindo o tempo; se ele devolver um Future
+    # (escrita), mede até o commit
+    name = method.__name__
+
+    @functools.wraps(method)
+    def wrapper(*args, **kwargs):
+        start = time.perf_counter()
+        result = method(*args, **kwargs)
+        if isinstance(result, Future):
+            result.add_done_callback(lambda f: metrics.observe('chat_db_query_seconds', time.perf_counter() - start, name))
+        else:
+            metrics.observe('chat_db_query_seconds', time.perf_counter() - start, name)
+        return result
+    return wrapper
+
+
+def prefix_end(prefix):
+    # menor string maior que todas as que começam com 'prefix' ('ab' -> 'ac')
+    # None se não tiver (prefixo só com o último caractere unicode)
+    while prefix:
+        last = ord(prefix[-1])
+        if last < 0x10FFFF:
+            return prefix[:-1] + chr(last + 1)
+        prefix = prefix[:-1]
+    return None
+
+
+class GroupCommitWriter:
+    # única thread que escreve no banco
+    # em vez de cada insert fazer seu próprio commit (um fsync por mensagem),
+    # ela junta tudo o que chegou dentro da "janela" e faz um commit só.
+    # quem pediu a escrita recebe um Future que completa quando o commit acontece
+    def __init__(self, connect, commit_window=0.005, max_batch=1000, metrics=DISABLED, name="db-writer"):
+        self.connect = connect
+        self.metrics = metrics
+        self.commit_window = commit_window  # quanto tempo segura o commit esperando mais escritas
+        self.max_batch = max_batch
+        self.queue = queue.Queue()
+        self.commits = 0  # quantos commits (fsyncs) já fez
+        self.writes = 0   # quantas escritas foram nesses commits
+        self.thread = threading.Thread(target=self._run, name=name, daemon=True)
+        self.thread.start()
+
+    def submit(self, sql, params=()):
+        # sql pode ser uma string ou uma função que recebe a conexão (várias queries juntas)
+        future = Future()
+        self.queue.put((sql, params, future))
+        return future
+
+    def _collect(self, first):
+        # junta o primeiro pedido com o que mais chegar até fechar a janela
+        batch = [first]
+        deadline = time.monotonic() + self.commit_window
+        while len(batch) < self.max_batch:
+            timeout = deadline - time.monotonic()
+            try:
+                item = self.queue.get(timeout=timeout) if timeout > 0 else self.queue.get_nowait()
+            except queue.Empty:
+                break
+            if item is None:
+                # pedido de parada: devolve pra fila e fecha esse lote
+                self.queue.put(None)
+                break
+            batch.append(item)
+        return batch
+
+    def _run(self):
+        conn = self.connect()
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            batch = self._collect(item)
+            start = time.perf_counter()
+            try:
+                # o lote inteiro numa transação de escrita aberta já no começo: o que uma
+                # escrita lê antes do INSERT (ex: MAX(seq) no append_history) não muda por
+                # baixo dela, nem com outro processo escrevendo no mesmo arquivo (cluster)
+                conn.execute("BEGIN IMMEDIATE")
+            except Exception as e:
+                for _, _, future in batch:
+                    future.set_exception(e)
+                continue
+            results = []
+            for sql, params, future in batch:
+                # cada escrita num savepoint: uma função com várias queries que falha no meio
+                # não deixa a metade que já rodou no commit do lote (quem pediu recebe o erro
+                # e acha que nada foi gravado)
+                conn.execute("SAVEPOINT w")
+                try:
+                    if callable(sql):
+                        results.append((future, sql(conn), None))
+                    else:
+                        results.append((future, conn.execute(sql, params).rowcount, None))
+                except Exception as e:
+                    # erro numa escrita (ex: nome repetido) não derruba as outras do lote
+                    conn.execute("ROLLBACK TO w")
+                    results.append((future, None, e))
+                conn.execute("RELEASE w")
+            try:
+                conn.commit()
+            except Exception as e:
+                conn.rollback()
+                for future, _, _ in results:
+                    future.set_exception(e)
+                continue
+            self.commits += 1
+            self.writes += len(batch)
+            if self.metrics.enabled:
+                self.metrics.observe('chat_db_commit_seconds', time.perf_counter() - start)
+                self.metrics.observe('chat_db_commit_writes', len(batch))
+            # só agora (depois do commit) avisa quem tava esperando
+            for future, result, error in results:
+                if error is not None:
+                    future.set_exception(error)
+                else:
+                    future.set_result(result)
+        conn.close()
+
+    def close(self):
+        # termina o que tiver na fila e para a thread
+        self.queue.put(None)
+        self.thread.join()
+
+
+class SQLiteFile:
+    # um arquivo sqlite: uma thread writer (group commit) e uma conexão de leitura por thread
+    # o Database é um desses (o banco principal); no modo particionado cada shard de
+    # msgs offline é outro, com writer e trava de escrita próprios
+    def __init__(self, db_path, synchronous="NORMAL", cache_size_kb=16384,
+                 commit_window=0.005, max_batch=1000, metrics=DISABLED, name="db-writer"):
+        self.db_path = db_path
+        self.synchronous = synchronous       # FULL = fsync em todo commit, NORMAL = só nos checkpoints do WAL
+        self.cache_size_kb = cache_size_kb   # cache de páginas por conexão
+        # cada thread tem sua própria conexão de leitura (sqlite não gosta de
+        # conexão compartilhada entre threads sem lock)
+        self.local = threading.local()
+        self.connections = []
+        self.connections_lock = threading.Lock()
+
+        # WAL: leitores não bloqueiam o escritor e vice-versa
+        conn = self._connect()
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.close()
+
+        self.writer = GroupCommitWriter(self._connect, commit_window, max_batch, metrics, name)
+
+    def _connect(self):
+        conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        conn.execute(f"PRAGMA synchronous={self.synchronous}")
+        conn.execute(f"PRAGMA cache_size=-{int(self.cache_size_kb)}")
+        return conn
+
+    @property
+    def conn(self):
+        # conexão da thread atual (cria na primeira vez)
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            conn = self._connect()
+            self.local.conn = conn
+            with self.connections_lock:
+                self.connections.append(conn)
+        return conn
+
+    def write(self, sql, params=()):
+        # toda escrita passa pela thread writer; devolve um Future
+        return self.writer.submit(sql, params)
+
+    def release_connection(self):
+        # a thread que vai acabar fecha a conexão dela (no modo thread cada cliente tem a
+        # sua thread: sem isso, cada conexão que já passou deixava um sqlite aberto, com
+        # os fds do WAL, até o servidor parar)
+        conn = getattr(self.local, 'conn', None)
+        if conn is None:
+            return
+        self.local.conn = None
+        with self.connections_lock:
+            self.connections.remove(conn)
+        conn.close()
+
+    def close_connections(self):
+        with self.connections_lock:
+            for conn in self.connections:
+                conn.close()
+            self.connections.clear()
+
+    def close(self):
+        self.writer.close()
+        self.close_connections()
+
+
+class Database(SQLiteFile):
+    def __init__(self, db_path="chat.db", synchronous="NORMAL", cache_size_kb=16384,
+                 commit_window=0.005, max_batch=1000, metrics=DISABLED, identity_snapshot=None,
+                 keep_users=True, offline_shards=None):
+        super().__init__(db_path, synchronous, cache_size_kb, commit_window, max_batch, metrics)
         self.create_user_table()
         self.create_message_table()
+        self.create_history_tables()  # antes dos grupos: o cursor dos membros aponta pro histórico
         self.create_group_tables()
-    
+        self.create_file_tables()
+
+        # msgs offline particionadas (offline_shards = N arquivos, 0 = no banco principal,
+        # None = o que o banco já usa). cada user cai sempre no mesmo shard (hash do nome),
+        # então as consultas de um user vão num arquivo só; users e grupos ficam no principal
+        self.shards = []
+        self.open_shards(offline_shards, commit_window, max_batch, metrics)
+
+        # quem existe (users, grupos, membros) fica em memória (ver identity.py);
+        # identity_snapshot é o arquivo que deixa a próxima subida rápida (None = sem);
+        # keep_users=False guarda só o filtro de Bloom dos users e confirma no banco
+        self.identity_snapshot = identity_snapshot
+        self.identity = IdentityIndex(keep_users=keep_users, user_lookup=self.user_in_table,
+                                      user_names=lambda: (row[0] for row in self.conn.execute("SELECT username FROM users")))
+        conn = self._connect()
+        try:
+            self.identity.load(conn, identity_snapshot)
+        finally:
+            conn.close()
+
+        # com métricas ligadas, troca os métodos por versões que medem o tempo
+        # (desligadas não custa nada: os métodos ficam os originais)
+        if metrics.enabled:
+            for name in TIMED_QUERIES:
+                setattr(self, name, timed(metrics, getattr(self, name)))
+
+    def release_connection(self):
+        super().release_connection()
+        for shard in self.shards:
+            shard.release_connection()
+
+    def close(self):
+        self.writer.close()
+        for shard in self.shards:
+            shard.close()
+        if self.identity_snapshot:
+            # tudo já foi gravado: o snapshot sai com a foto final do banco
+            conn = self._connect()
+            try:
+                self.identity.save_snapshot(self.identity_snapshot, self.identity.fingerprint(conn))
+            finally:
+                conn.close()
+        self.close_connections()
+
+    def _undo_on_failure(self, future, undo):
+        # o índice em memória muda junto com o pedido de escrita (quem perguntar logo
+        # depois já vê); se o INSERT falhar por outro motivo que não "já existe", desfaz
+        def check(done):
+            error = done.exception()
+            if error is not None and not isinstance(error, sqlite3.IntegrityError):
+                undo()
+        future.add_done_callback(check)
+        return future
+
     # funcoes dos usuarios
 
     def create_user_table(self):
-        cursor = self.conn.cursor()
-        cursor.execute("""
+        self.write("""
             CREATE TABLE IF NOT EXISTS users (
                 username TEXT PRIMARY KEY,
-                password_hash TEXT NOT NULL 
+                password_hash TEXT NOT NULL
             )
-        """)
-        self.conn.commit()
-    
+        """).result()
+
     def user_exists(self, username):
-        # ve se tem algum user com esse nome
+        # ve se tem algum user com esse nome (no índice em memória, sem SELECT)
+        return self.identity.user_exists(username)
+
+    def user_in_table(self, username):
+        # a mesma pergunta, direto no banco
         cursor = self.conn.cursor()
         cursor.execute("SELECT 1 FROM users WHERE username=?", (username,))
         return cursor.fetchone() is not None
-    
+
     def create_user(self, username, password_hash):
-        # adiciona um novo user no banco
-        cursor = self.conn.cursor()
-        cursor.execute("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash))
-        self.conn.commit()
-    
+        # adiciona um novo user no banco (Future: completa quando tiver gravado)
+        self.identity.add_user(username)
+        future = self.write("INSERT INTO users (username, password_hash) VALUES (?, ?)", (username, password_hash))
+        future = self._undo_on_failure(future, lambda: self.identity.discard_user(username))
+        future.add_done_callback(lambda _: self.identity.settle_user(username))
+        return future
+
     def get_user_password_hash(self, username):
         # pega o hash da senha pra comparar depois
         cursor = self.conn.cursor()
         cursor.execute("SELECT password_hash FROM users WHERE username=?", (username,))
         result = cursor.fetchone()
         return result[0] if result else None
-    
-    #Lista todos os usuários (para o comando 'list_all')
+
+    def users_since(self, after_rowid=0, limit=1000):
+        # users cadastrados depois do cursor (rowid): o app não apaga users, então o
+        # rowid só cresce e "o que mudou desde X" é um intervalo da chave
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT rowid, username FROM users WHERE rowid>? ORDER BY rowid LIMIT ?", (after_rowid, limit))
+        return cursor.fetchall()
+
+    #Lista todos os usuários (cuidado: com muita gente isso é enorme, prefira list_users)
     def get_all_users(self):
         cursor = self.conn.cursor()
         cursor.execute("SELECT username FROM users")
         return [row[0] for row in cursor.fetchall()]
 
+    def list_users(self, prefix='', after='', limit=50):
+        # uma página de users em ordem alfabética, depois do cursor 'after'
+        # o filtro por prefixo vira um intervalo [prefixo, prefixo_seguinte),
+        # que usa o índice da chave primária em vez de varrer a tabela
+        query = "SELECT username FROM users WHERE username > ?"
+        params = [after]
+        if prefix:
+            query += " AND username >= ?"
+            params.append(prefix)
+            end = prefix_end(prefix)
+            if end:
+                query += " AND username < ?"
+                params.append(end)
+        query += " ORDER BY username LIMIT ?"
+        params.append(limit)
+        cursor = self.conn.cursor()
+        cursor.execute(query, params)
+        return [row[0] for row in cursor.fetchall()]
+
     # mensagens offiline
-    
+
     def create_message_table(self):
-        # guarda mensagens enviadas quando o user tá offline
-        cursor = self.conn.cursor()
-        cursor.execute("""
-            CREATE TABLE IF NOT EXISTS offline_messages (
-                id INTEGER PRIMARY KEY AUTOINCREMENT,
+        # no banco principal sempre (é onde ficam as msgs sem shards)
+        self.write(create_offline_table).result()
+
+    def open_shards(self, count, commit_window, max_batch, metrics):
+        layout = self.write(read_layout).result()
+        if count is None:
+            count = layout
+        if count != layout:
+            # mudar o número de shards com msgs guardadas pede o rebalance (com o servidor parado)
+            if count_offline(self.db_path, layout):
+                raise ValueError(f"o banco usa {layout} shard(s) de msgs offline e foram pedidos {count}: "
+                                 f"rode python3 server/rebalance.py --db {self.db_path} --shards {count}")
+            self.write(lambda conn: write_layout(conn, count)).result()
+        for i in range(count):
+            shard = SQLiteFile(shard_path(self.db_path, i, count), self.synchronous, self.cache_size_kb,
+                               commit_window, max_batch, metrics, name=f"db-writer-{i}")
+            shard.write(create_offline_table).result()
+            self.shards.append(shard)
+
+    def offline_store(self, receiver):
+        # onde ficam as msgs offline de 'receiver' (o próprio banco, sem shards)
+        if not self.shards:
+            return self
+        return self.shards[shard_index(receiver, len(self.shards))]
+
+    def save_message(self, sender, receiver, message, file=None):
+        # salva msg quando o destinatário tá offline
+        # não espera o commit: devolve o Future pra quem quiser saber quando gravou
+        return self.offline_store(receiver).write(
+            "INSERT INTO offline_messages (sender, receiver, message, file) VALUES (?, ?, ?, ?)",
+            (sender, receiver, message, file)
+        )
+
+    def get_offline_batch(self, receiver, after_id=0, limit=200):
+        # pega um lote de msgs offline depois do cursor (id), sem apagar nada
+        # (usa o índice (receiver, id), então não varre a tabela)
+        cursor = self.offline_store(receiver).conn.cursor()
+        cursor.execute(
+            "SELECT id, sender, message, file FROM offline_messages WHERE receiver=? AND id>? ORDER BY id LIMIT ?",
+            (receiver, after_id, limit)
+        )
+        return cursor.fetchall()
+
+    def delete_offline_up_to(self, receiver, last_id):
+        # apaga as msgs que o cliente confirmou que recebeu
+        return self.offline_store(receiver).write("DELETE FROM offline_messages WHERE receiver=? AND id<=?", (receiver, last_id))
+
+    # histórico das conversas
+
+    def create_history_tables(self):
+        # só cresce: cada msg ganha o próximo 'seq' da conversa dela
+        # WITHOUT ROWID guarda as linhas na ordem da chave (conversa, seq), então
+        # "página antes/depois do cursor" lê um pedaço contínuo do disco, sem ir
+        # de um índice pra tabela (a própria tabela é o índice que cobre a consulta)
+        # 'id' é a ordem global, usada pelo índice de busca
+        self.write("""
+            CREATE TABLE IF NOT EXISTS messages (
+                conversation TEXT NOT NULL,
+                seq INTEGER NOT NULL,
+                id INTEGER NOT NULL UNIQUE,
                 sender TEXT NOT NULL,
-                receiver TEXT NOT NULL,
                 message TEXT NOT NULL,
-                timestamp DATETIME DEFAULT CURRENT_TIMESTAMP
+                created_at REAL NOT NULL,
+                file TEXT,
+                PRIMARY KEY (conversation, seq)
+            ) WITHOUT ROWID
+        """).result()
+        # msg com anexo: 'message' é o nome do arquivo (entra na busca) e 'file' a referência
+        self.write(lambda conn: add_column(conn, 'messages', 'file', 'TEXT')).result()
+        # busca por texto: índice FTS5 sem cópia do conteúdo (content=''), só aponta pro id
+        # (se o sqlite não tiver FTS5, o histórico funciona e a busca fica desligada)
+        try:
+            self.write("CREATE VIRTUAL TABLE IF NOT EXISTS messages_fts USING fts5(message, content='')").result()
+            self.fts = True
+        except sqlite3.OperationalError:
+            self.fts = False
+
+        # com quem cada user tem DM: o sync acha as conversas que o cliente ainda não conhece
+        # sem varrer o histórico (a chave da DM começa por um dos dois, não pelo user)
+        def create_peers(conn):
+            exists = conn.execute("SELECT 1 FROM sqlite_master WHERE name='dm_peers'").fetchone()
+            conn.execute("""
+                CREATE TABLE IF NOT EXISTS dm_peers (
+                    username TEXT NOT NULL,
+                    peer TEXT NOT NULL,
+                    PRIMARY KEY (username, peer)
+                ) WITHOUT ROWID
+            """)
+            if exists:
+                return
+            # banco de antes da tabela: monta a partir das DMs que já estão no histórico
+            # (DISTINCT na chave: lê as conversas 'dm:' em ordem, uma vez só)
+            for (conversation,) in conn.execute("SELECT DISTINCT conversation FROM messages WHERE conversation >= 'dm:' AND conversation < 'dm;'").fetchall():
+                a, b = dm_users(conversation)
+                conn.executemany("INSERT OR IGNORE INTO dm_peers (username, peer) VALUES (?, ?)", ((a, b), (b, a)))
+        self.write(create_peers).result()
+
+    def append_history(self, conversation, sender, message, file=None):
+        # guarda uma msg no histórico; vai pro lote do writer, quem entrega não espera
+        # (Future com o seq que ela ganhou)
+        created_at = time.time()
+        fts = self.fts
+        users = dm_users(conversation)
+
+        def insert(conn):
+            message_id = conn.execute("SELECT COALESCE(MAX(id), 0) + 1 FROM messages").fetchone()[0]
+            seq = conn.execute("SELECT COALESCE(MAX(seq), 0) + 1 FROM messages WHERE conversation=?", (conversation,)).fetchone()[0]
+            conn.execute(
+                "INSERT INTO messages (conversation, seq, id, sender, message, created_at, file) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (conversation, seq, message_id, sender, message, created_at, file)
             )
-        """)
-        self.conn.commit()
-    
-    def save_message(self, sender, receiver, message):
-        # salva msg quando o destinatário tá offline
+            if fts:
+                conn.execute("INSERT INTO messages_fts (rowid, message) VALUES (?, ?)", (message_id, message))
+            if users:
+                a, b = users
+                conn.executemany("INSERT OR IGNORE INTO dm_peers (username, peer) VALUES (?, ?)", ((a, b), (b, a)))
+            return seq
+        return self.write(insert)
+
+    def history_before(self, conversation, before_seq=None, limit=50):
+        # as 'limit' msgs anteriores ao cursor (a mais nova primeiro); sem cursor = as últimas
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT seq, sender, message, created_at, file FROM messages WHERE conversation=? AND seq<? ORDER BY seq DESC LIMIT ?",
+            (conversation, before_seq if before_seq is not None else 1 << 62, limit)
+        )
+        return cursor.fetchall()
+
+    def history_after(self, conversation, after_seq=0, limit=50, until_seq=None):
+        # as 'limit' msgs depois do cursor, em ordem (até until_seq, se vier)
         cursor = self.conn.cursor()
         cursor.execute(
-            "INSERT INTO offline_messages (sender, receiver, message) VALUES (?, ?, ?)",
-            (sender, receiver, message)
+            "SELECT seq, sender, message, created_at, file FROM messages WHERE conversation=? AND seq>? AND seq<=? ORDER BY seq LIMIT ?",
+            (conversation, after_seq, until_seq if until_seq is not None else 1 << 62, limit)
         )
-        self.conn.commit()
-    
-    def get_and_delete_messages_for(self, receiver):
-        # pega as msgs offline e já apaga elas do banco
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT sender, message FROM offline_messages WHERE receiver=?", (receiver,))
-        messages = cursor.fetchall()
-        if messages:
-            cursor.execute("DELETE FROM offline_messages WHERE receiver=?", (receiver,))
-            self.conn.commit()
-        return messages
+        return cursor.fetchall()
+
+    def conversation_head(self, conversation):
+        # seq da última msg da conversa (0 = vazia); lê só a última entrada da chave
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT seq FROM messages WHERE conversation=? ORDER BY seq DESC LIMIT 1", (conversation,))
+        row = cursor.fetchone()
+        return row[0] if row else 0
+
+    def dm_peers(self, username):
+        # com quem o user já trocou DM
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT peer FROM dm_peers WHERE username=?", (username,))
+        return [row[0] for row in cursor.fetchall()]
+
+    def search_history(self, conversation, text, before_id=None, limit=50):
+        # msgs da conversa com todas as palavras de 'text', da mais nova pra mais velha
+        # cursor = id da última msg da página anterior
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT m.id, m.seq, m.sender, m.message, m.created_at, m.file FROM messages_fts f "
+            "JOIN messages m ON m.id = f.rowid "
+            "WHERE messages_fts MATCH ? AND f.rowid < ? AND m.conversation = ? "
+            "ORDER BY f.rowid DESC LIMIT ?",
+            (fts_query(text), before_id if before_id is not None else 1 << 62, conversation, limit)
+        )
+        return cursor.fetchall()
+
+    # anexos (o conteúdo fica no disco, ver files.py)
+
+    def create_file_tables(self):
+        # um arquivo por conteúdo (id = sha256) e em quais conversas ele foi mandado:
+        # baixar só pode quem tá numa dessas conversas
+        self.write("""
+            CREATE TABLE IF NOT EXISTS files (
+                id TEXT PRIMARY KEY,
+                size INTEGER NOT NULL,
+                created_at REAL NOT NULL
+            )
+        """)
+        self.write("""
+            CREATE TABLE IF NOT EXISTS file_refs (
+                file TEXT NOT NULL,
+                conversation TEXT NOT NULL,
+                PRIMARY KEY (file, conversation)
+            ) WITHOUT ROWID
+        """).result()
+
+    def save_file(self, file_id, size, conversation):
+        # o arquivo já tá no disco; aqui só o registro e a conversa que pode baixar
+        created_at = time.time()
+
+        def insert(conn):
+            conn.execute("INSERT OR IGNORE INTO files (id, size, created_at) VALUES (?, ?, ?)", (file_id, size, created_at))
+            conn.execute("INSERT OR IGNORE INTO file_refs (file, conversation) VALUES (?, ?)", (file_id, conversation))
+        return self.write(insert)
+
+    def file_conversations(self, file_id):
+        cursor = self.conn.cursor()
+        cursor.execute("SELECT conversation FROM file_refs WHERE file=?", (file_id,))
+        return [row[0] for row in cursor.fetchall()]
 
     # Grupos
 
     def create_group_tables(self):
-        cursor = self.conn.cursor()
         # tabela simples só com nome do grupo
-        cursor.execute("""
+        self.write("""
             CREATE TABLE IF NOT EXISTS groups (
                 name TEXT PRIMARY KEY
             )
         """)
         # tabela que liga users com grupos
-        cursor.execute("""
+        # last_seq: até qual msg do grupo (seq no histórico) o membro já recebeu.
+        # msg de grupo é gravada uma vez só (no histórico); quem tava offline recebe
+        # no login o que passou do cursor dele, em vez de uma cópia por membro
+        self.write("""
             CREATE TABLE IF NOT EXISTS group_members (
                 group_name TEXT,
                 username TEXT,
+                last_seq INTEGER NOT NULL DEFAULT 0,
                 FOREIGN KEY (group_name) REFERENCES groups(name) ON DELETE CASCADE,
                 FOREIGN KEY (username) REFERENCES users(username) ON DELETE CASCADE,
                 PRIMARY KEY (group_name, username)
             )
         """)
-        self.conn.commit()
-    
+        self.write(MEMBERS_BY_USER_INDEX).result()
+
+        # banco de antes do cursor: cria a coluna já marcando tudo o que existe como entregue
+        def add_cursor_column(conn):
+            columns = [row[1] for row in conn.execute("PRAGMA table_info(group_members)")]
+            if 'last_seq' in columns:
+                return False
+            conn.execute("ALTER TABLE group_members ADD COLUMN last_seq INTEGER NOT NULL DEFAULT 0")
+            conn.execute(f"UPDATE group_members SET last_seq = ({GROUP_HEAD})", (group_conversation(''),))
+            return True
+        self.write(add_cursor_column).result()
+
     def group_exists(self, group_name):
-        # checa se tem grupo com esse nome
-        cursor = self.conn.cursor()
-        cursor.execute("SELECT 1 FROM groups WHERE name=?", (group_name,))
-        return cursor.fetchone() is not None
-    
+        # checa se tem grupo com esse nome (no índice em memória)
+        return self.identity.group_exists(group_name)
+
     def create_group(self, group_name):
         # cria um grupo novo
-        cursor = self.conn.cursor()
-        cursor.execute("INSERT INTO groups (name) VALUES (?)", (group_name,))
-        self.conn.commit()
-    
+        self.identity.add_group(group_name)
+        future = self.write("INSERT INTO groups (name) VALUES (?)", (group_name,))
+        return self._undo_on_failure(future, lambda: self.identity.discard_group(group_name))
+
     def add_group_member(self, group_name, username):
         # bota user no grupo (não dá erro se já tiver)
+        # o cursor começa na última msg do grupo: quem entra não recebe o passado como "não lido"
+        self.identity.add_member(group_name, username)
+        future = self.write(
+            "INSERT OR IGNORE INTO group_members (group_name, username, last_seq) "
+            "VALUES (?, ?, COALESCE((SELECT seq FROM messages WHERE conversation=? ORDER BY seq DESC LIMIT 1), 0))",
+            (group_name, username, group_conversation(group_name))
+        )
+        return self._undo_on_failure(future, lambda: self.identity.discard_member(group_name, username))
+
+    def get_members(self, group_name):
+        # membros do grupo (frozenset, do índice em memória)
+        return self.identity.get_members(group_name)
+
+    def reload_group(self, group_name):
+        # o grupo mudou por fora (outro nó do cluster): relê ele do banco pro índice
         cursor = self.conn.cursor()
-        cursor.execute("INSERT OR IGNORE INTO group_members (group_name, username) VALUES (?, ?)", (group_name, username))
-        self.conn.commit()
-    
+        cursor.execute("SELECT 1 FROM groups WHERE name=?", (group_name,))
+        exists = cursor.fetchone() is not None
+        self.identity.set_group(group_name, exists, self.get_group_members(group_name))
+
+    def group_backlog(self, username):
+        # grupos do user com msg depois do cursor: [(grupo, cursor, seq da última msg)]
+        # (a última msg de cada grupo sai da chave (conversation, seq), sem varrer nada)
+        # roda na fila do writer e devolve um Future: conta as msgs pedidas antes dele, mesmo
+        # as que ainda não gravaram, e nenhuma pedida depois (ver ChatServer.complete_login)
+        return self.write(lambda conn: conn.execute(
+            f"SELECT group_name, last_seq, ({GROUP_HEAD}) AS head FROM group_members "
+            "WHERE username=? AND head > last_seq ORDER BY group_name",
+            (group_conversation(''), username)
+        ).fetchall())
+
+    def set_group_cursor(self, username, group_name, seq):
+        # avança o cursor de um grupo (um UPDATE por lote confirmado, não por msg)
+        return self.write(
+            "UPDATE group_members SET last_seq=? WHERE group_name=? AND username=? AND last_seq<?",
+            (seq, group_name, username, seq)
+        )
+
+    def save_group_cursors(self, username, skip=()):
+        # logout: tudo o que já tá no histórico dos grupos dele foi entregue ao vivo,
+        # então os cursores vão pra última msg de cada grupo, num UPDATE só
+        # (menos os grupos em 'skip', que ainda tinham atrasado pra mandar)
+        # roda na fila do writer: conta todas as msgs gravadas antes desse pedido
+        skip = list(skip)
+        return self.write(
+            f"UPDATE group_members SET last_seq = MAX(last_seq, ({GROUP_HEAD})) "
+            f"WHERE username=? AND group_name NOT IN ({','.join('?' * len(skip))})",
+            [group_conversation(''), username] + skip
+        )
+
     def get_group_members(self, group_name):
-        # lista todo mundo do grupo
+        # lista todo mundo do grupo (direto do banco; no dia a dia use get_members)
         cursor = self.conn.cursor()
         cursor.execute("SELECT username FROM group_members WHERE group_name=?", (group_name,))
         return [row[0] for row in cursor.fetchall()]
-    
+
+    def members_since(self, username, after_rowid=0, limit=1000):
+        # entradas em grupos do user depois do cursor (rowid de group_members, que também
+        # só cresce): quem entrou nos grupos dele, e ele mesmo entrando num grupo novo
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT rowid, group_name, username FROM group_members WHERE rowid>? "
+            "AND group_name IN (SELECT group_name FROM group_members WHERE username=?) ORDER BY rowid LIMIT ?",
+            (after_rowid, username, limit)
+        )
+        return cursor.fetchall()
+
     def get_groups_for_user(self, username):
         # mostra os grupos que o user tá
         cursor = self.conn.cursor()
         cursor.execute("SELECT group_name FROM group_members WHERE username=?", (username,))
         return [row[0] for row in cursor.fetchall()]
+
+    def list_groups_for_user(self, username, after='', limit=50):
+        # mesma coisa, mas paginado (usa o índice (username, group_name))
+        cursor = self.conn.cursor()
+        cursor.execute(
+            "SELECT group_name FROM group_members WHERE username=? AND group_name>? ORDER BY group_name LIMIT ?",
+            (username, after, limit)
+        )
+        return [row[0] for row in cursor.fetchall()]
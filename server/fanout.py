@@ -0,0 +1,55 @@
+# entrega de mensagens de grupo (fan-out)
+# - os membros de cada grupo ficam em memória (sem SELECT a cada mensagem, ver identity.py)
+# - o quadro é montado uma vez só (uma vez por formato) e os mesmos bytes vão pra fila de todo mundo
+# - grupo grande é dividido em pedaços entregues por várias threads
+import time
+from concurrent.futures import ThreadPoolExecutor, wait
+
+from metrics import DISABLED
+
+
+class FanoutEngine:
+    def __init__(self, workers=4, parallel_threshold=1000, chunk_size=500, metrics=DISABLED):
+        self.metrics = metrics
+        self.parallel_threshold = parallel_threshold
+        self.chunk_size = chunk_size
+        self.pool = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="fanout") if workers > 1 else None
+
+    def deliver(self, sessions, frame, spill=None):
+        # manda o mesmo quadro (bytes já prontos) pra todas as sessões
+        # devolve quantas receberam
+        # spill(session): guarda a msg de quem tiver a fila estourada (política 'spill', ver
+        # ChatServer.spill_for); sem ele, a política da fila decide (descartar ou derrubar)
+        if self.pool is None or len(sessions) < self.parallel_threshold:
+            self._deliver_chunk(sessions, frame, spill)
+            return len(sessions)
+
+        # grupo grande: divide em pedaços e espera todos terminarem, assim a
+        # próxima msg do mesmo remetente não passa na frente desta
+        chunks = [sessions[i:i + self.chunk_size] for i in range(0, len(sessions), self.chunk_size)]
+        wait([self.pool.submit(self._deliver_chunk, chunk, frame, spill) for chunk in chunks])
+        return len(sessions)
+
+    def deliver_message(self, sessions, data, spill=None):
+        # mesma coisa, mas a partir do dict: cada sessão pode ter combinado um
+        # formato diferente (JSON, binário, com zlib), então monta um quadro por formato
+        if self.metrics.enabled:
+            start = time.perf_counter()
+        by_codec = {}
+        for session in sessions:
+            by_codec.setdefault(session.codec, []).append(session)
+        delivered = 0
+        for codec, group in by_codec.items():
+            delivered += self.deliver(group, codec.encode(data), spill)
+        if self.metrics.enabled:
+            self.metrics.observe('chat_fanout_seconds', time.perf_counter() - start)
+            self.metrics.observe('chat_fanout_recipients', delivered)
+        return delivered
+
+    def _deliver_chunk(self, sessions, frame, spill=None):
+        for session in sessions:
+            session.send(frame, spill and (lambda session=session: spill(session)))
+
+    def shutdown(self):
+        if self.pool is not None:
+            self.pool.shutdown(wait=False)
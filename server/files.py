@@ -0,0 +1,124 @@
+# arquivos (anexos) das conversas
+#
+# o arquivo é guardado em disco uma vez só, com o sha256 do conteúdo como nome
+# (files/ab/abcdef...): mandar o mesmo arquivo pra um grupo de 500 pessoas, ou de
+# novo amanhã, não grava uma cópia a mais. quem recebe ganha só a referência
+# ({"id", "name", "size"}), ao vivo ou pelo offline_messages/histórico.
+#
+# envio: o cliente diz o sha256 e o tamanho antes ('upload_file') e manda os bytes em
+# pedaços (quadros KIND_CHUNK, ver protocol.py). cada pedaço vai direto pro arquivo
+# parcial (tmp/<user>-<sha256>.part) e pro hash, então a memória por transferência é
+# um pedaço, não o arquivo. caiu no meio? o parcial fica e o próximo 'upload_file'
+# continua do tamanho que ele tem. no fim o hash tem que bater com o sha256 dito.
+#
+# download: o writer da sessão manda os pedaços com sendfile, do disco pro socket
+# sem passar pela memória do python (ver session.FileStream)
+import hashlib
+import os
+import time
+
+CHUNK_SIZE = 256 * 1024        # tamanho dos pedaços que o servidor pede e manda
+MAX_CHUNK_SIZE = 1024 * 1024   # pedaço maior que isso derruba a transferência
+PARTIAL_MAX_AGE = 24 * 3600    # parcial parado há mais que isso é apagado na subida
+READ_BLOCK = 1024 * 1024
+
+
+class FileError(Exception):
+    # transferência que não dá pra continuar (offset errado, hash não bateu...)
+    pass
+
+
+def valid_file_id(file_id):
+    return (isinstance(file_id, str) and len(file_id) == 64
+            and all(c in '0123456789abcdef' for c in file_id))
+
+
+def file_ref(file_id, name, size):
+    # o que vai na msg pro destinatário (e no banco, como JSON)
+    return {"id": file_id, "name": name, "size": size}
+
+
+class FileStore:
+    def __init__(self, root, max_size=100 * 1024 * 1024, chunk_size=CHUNK_SIZE):
+        self.root = root
+        self.max_size = max_size
+        self.chunk_size = chunk_size
+        self.tmp = os.path.join(root, 'tmp')
+        os.makedirs(self.tmp, exist_ok=True)
+        self.clean_partials()
+
+    def path(self, file_id):
+        # duas letras de pasta: nenhum diretório fica com milhões de arquivos
+        return os.path.join(self.root, file_id[:2], file_id)
+
+    def size(self, file_id):
+        # tamanho do arquivo guardado (None = não tem)
+        try:
+            return os.path.getsize(self.path(file_id))
+        except OSError:
+            return None
+
+    def clean_partials(self, max_age=PARTIAL_MAX_AGE):
+        limit = time.time() - max_age
+        for entry in os.scandir(self.tmp):
+            try:
+                if entry.stat().st_mtime < limit:
+                    os.remove(entry.path)
+            except OSError:
+                pass
+
+    def open_upload(self, username, file_id, size):
+        # começa ou continua o envio de 'username' (cada user tem seu parcial,
+        # dois mandando o mesmo arquivo ao mesmo tempo não se atropelam)
+        return Upload(self, os.path.join(self.tmp, f"{username.encode('utf-8').hex()}-{file_id}.part"), file_id, size)
+
+
+class Upload:
+    # um envio em andamento: arquivo parcial aberto + hash do que já chegou
+    def __init__(self, store, partial, file_id, size):
+        self.store = store
+        self.partial = partial
+        self.file_id = file_id
+        self.size = size
+        self.hash = hashlib.sha256()
+        self.file = open(partial, 'a+b')
+        self.file.seek(0)
+        # continuação: o hash tem que incluir o que já tá no parcial (lido aos poucos)
+        while block := self.file.read(READ_BLOCK):
+            self.hash.update(block)
+        self.offset = self.file.tell()
+        if self.offset > size:
+            # parcial de outra tentativa que não bate com esse tamanho: recomeça
+            self.file.truncate(0)
+            self.hash = hashlib.sha256()
+            self.offset = 0
+
+    @property
+    def done(self):
+        return self.offset == self.size
+
+    def write(self, offset, data):
+        # pedaço só vem em quadro binário (KIND_CHUNK); um 'data' em JSON chega como str
+        if not isinstance(data, (bytes, bytearray)):
+            raise FileError("pedaço sem dados binários")
+        if offset != self.offset:
+            raise FileError(f"pedaço no offset {offset}, esperado {self.offset}")
+        if len(data) > MAX_CHUNK_SIZE or self.offset + len(data) > self.size:
+            raise FileError("pedaço passa do tamanho do arquivo")
+        self.file.write(data)
+        self.hash.update(data)
+        self.offset += len(data)
+
+    def finish(self):
+        # fecha e põe no lugar definitivo; o mesmo conteúdo já guardado é só trocado por ele mesmo
+        self.file.close()
+        if self.hash.hexdigest() != self.file_id:
+            os.remove(self.partial)
+            raise FileError("o conteúdo não bate com o sha256 informado")
+        path = self.store.path(self.file_id)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        os.replace(self.partial, path)
+
+    def close(self):
+        # conexão caiu: o parcial fica pra continuar depois
+        self.file.close()
@@ -1,6 +1,8 @@
+import sqlite3
+
 class GroupManager:
     def __init__(self, db):
-        # conexão com o banco
+        # conexão com o banco (grupos e membros ficam no índice em memória dele, ver identity.py)
         self.db = db
     
     def create_group(self, group_name, creator_username):
@@ -9,9 +11,12 @@ class GroupManager:
             return False  # já tem grupo com esse nome
         
         # Cria o grupo no banco
-        self.db.create_group(group_name)
+        try:
+            self.db.create_group(group_name).result()
+        except sqlite3.IntegrityError:
+            return False  # outro user criou o mesmo grupo no meio tempo
         # Adiciona o criador como primeiro membro
-        self.db.add_group_member(group_name, creator_username)
+        self.db.add_group_member(group_name, creator_username).result()
         return True
     
     def add_member(self, group_name, username):
@@ -19,9 +24,9 @@ class GroupManager:
         if not self.db.group_exists(group_name) or not self.db.user_exists(username):
             return False  # um dos dois não existe
         
-        self.db.add_group_member(group_name, username)
+        self.db.add_group_member(group_name, username).result()
         return True
     
     def get_members(self, group_name):
-        # retorna a lista de users do grupo
-        return self.db.get_group_members(group_name)
\ No newline at end of file
+        # retorna os users do grupo (da memória, sem ir no banco toda vez)
+        return self.db.get_members(group_name)
@@ -0,0 +1,315 @@
+# índice em memória de quem existe: users, grupos e quem é membro de qual grupo
+#
+# "esse user existe?", "esse grupo existe?" e "quem é do grupo?" aparecem em quase
+# todo comando (select_chat, add_member_to_group, msg de grupo...). em vez de um
+# SELECT cada vez, o Database carrega tudo uma vez no começo e as escritas mantêm
+# o índice em dia (ver Database.create_user/create_group/add_group_member).
+#
+# os users podem ficar de dois jeitos (keep_users):
+#   - True (padrão): todos os nomes num set. é o mais rápido ('in' num set custa
+#     menos que qualquer filtro escrito em python), mas são ~100 bytes por user
+#   - False: só um filtro de Bloom (~2.4 bytes por user). nome que não tá no filtro
+#     com certeza não existe e a resposta sai sem ir no banco; o filtro pode dizer
+#     "talvez" pra quem não existe (~1%), e aí quem confirma é o banco
+# grupos e membros são bem menos e ficam sempre em memória.
+#
+# subir com milhões de users: a carga lê as tabelas em streaming (um SELECT por
+# tabela, sem uma consulta por linha) e depois grava um snapshot (arquivo ao lado
+# do banco: os nomes e, no modo filtro, os bits prontos). na próxima subida, se o
+# banco não mudou desde o snapshot, carrega dele direto.
+import json
+import math
+import os
+import threading
+import time
+import zlib
+
+SNAPSHOT_VERSION = 1
+EMPTY = frozenset()
+
+
+class BloomFilter:
+    def __init__(self, capacity, error_rate=0.01):
+        # tamanho (bits) e número de hashes pra errar ~error_rate com 'capacity' itens
+        self.capacity = max(1, capacity)
+        self.error_rate = error_rate
+        self.size = max(64, math.ceil(-self.capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / self.capacity * math.log(2)))
+        self.bits = bytearray((self.size + 7) // 8)
+        self.count = 0
+
+    def _hashes(self, key):
+        # hash estável entre processos (o hash() do python muda a cada execução e o
+        # snapshot guarda os bits). as k posições saem de dois hashes (h1 + i*h2);
+        # crc32 da chave e da chave de trás pra frente: rápido (é C) e espalha bem
+        data = key.encode('utf-8', 'surrogatepass')
+        return zlib.crc32(data), zlib.crc32(data[::-1]) | 1
+
+    def add(self, key):
+        h1, h2 = self._hashes(key)
+        bits, size = self.bits, self.size
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % size
+            bits[position >> 3] |= 1 << (position & 7)
+        self.count += 1
+
+    def __contains__(self, key):
+        # para no primeiro bit zerado: quem não existe costuma sair em 1 ou 2 testes
+        h1, h2 = self._hashes(key)
+        bits, size = self.bits, self.size
+        for i in range(self.hashes):
+            position = (h1 + i * h2) % size
+            if not bits[position >> 3] & (1 << (position & 7)):
+                return False
+        return True
+
+    @property
+    def full(self):
+        # passou da capacidade: a taxa de erro começa a subir
+        return self.count > self.capacity
+
+
+def build_filter(names, count, error_rate):
+    # filtro com folga (o dobro) pra crescer um tempo sem refazer
+    bloom = BloomFilter(max(1024, 2 * count), error_rate)
+    for name in names:
+        bloom.add(name)
+    return bloom
+
+
+class IdentityIndex:
+    # leitura sem lock: os conjuntos só crescem e cada grupo guarda um frozenset
+    # novo a cada mudança, então quem tá lendo nunca vê um conjunto pela metade.
+    # escrita com lock
+    def __init__(self, keep_users=True, user_lookup=None, user_names=None, error_rate=0.01):
+        # sem o set de users, quem passa no filtro é confirmado com user_lookup(nome)
+        # e o filtro cheio é refeito lendo user_names() (os dois vão no banco)
+        self.keep_users = keep_users
+        self.user_lookup = user_lookup
+        self.user_names = user_names
+        self.error_rate = error_rate
+        self.users = set()
+        self.user_filter = None if keep_users else BloomFilter(1024, error_rate)
+        self.groups = set()
+        self.members = {}  # grupo -> frozenset de users
+        # modo filtro: users que já entraram no filtro mas podem ainda não estar gravados
+        # (INSERT na fila do writer). o filtro refeito lendo o banco não veria eles
+        self.pending = set()
+        self.settled = []  # gravados durante um refazer: saem do pending quando ele acabar
+        self.rebuilding = False
+        self.lock = threading.Lock()
+        self.source = None  # de onde veio a carga ('snapshot' ou 'banco') e quanto demorou
+        self.load_seconds = 0.0
+
+    # consultas
+
+    def user_exists(self, username):
+        if not isinstance(username, str):
+            return False
+        if self.keep_users:
+            return username in self.users
+        return username in self.user_filter and self.user_lookup(username)
+
+    def group_exists(self, group_name):
+        return isinstance(group_name, str) and group_name in self.groups
+
+    def get_members(self, group_name):
+        return self.members.get(group_name, EMPTY) if isinstance(group_name, str) else EMPTY
+
+    def is_member(self, group_name, username):
+        return username in self.get_members(group_name)
+
+    # escritas (o Database chama junto com o INSERT)
+
+    def add_user(self, username, committed=False):
+        # committed: já tá no banco (ex: cadastrado em outro nó do cluster); senão o
+        # Database avisa com settle_user quando o INSERT terminar
+        with self.lock:
+            if self.keep_users:
+                self.users.add(username)
+                return
+            self.user_filter.add(username)
+            if not committed:
+                self.pending.add(username)
+            rebuild = self.user_filter.full and not self.rebuilding
+            if rebuild:
+                self.rebuilding = True
+                count = self.user_filter.count
+        if rebuild:
+            self.rebuild_filter(count)
+
+    def rebuild_filter(self, count):
+        # filtro cheio: refaz lendo o banco, fora do lock (quem pergunta enquanto isso
+        # usa o filtro antigo). no fim entram também os que ainda não estavam gravados
+        # e os que chegaram durante a leitura (todos no pending)
+        try:
+            bloom = build_filter(self.user_names(), count, self.error_rate)
+        except Exception:
+            with self.lock:
+                self.rebuilding = False
+            raise
+        with self.lock:
+            for username in self.pending:
+                bloom.add(username)
+            self.user_filter = bloom
+            self.rebuilding = False
+            self.pending.difference_update(self.settled)
+            self.settled.clear()
+
+    def settle_user(self, username):
+        # o INSERT do user terminou (gravou ou falhou): não precisa mais ser lembrado
+        if self.keep_users:
+            return
+        with self.lock:
+            if self.rebuilding:
+                # a leitura em andamento pode não ter visto ele: espera ela acabar
+                self.settled.append(username)
+            else:
+                self.pending.discard(username)
+
+    def discard_user(self, username):
+        # INSERT que falhou: tira do set (no filtro fica o "talvez", que não faz mal)
+        with self.lock:
+            self.users.discard(username)
+
+    def add_group(self, group_name):
+        with self.lock:
+            self.groups.add(group_name)
+
+    def discard_group(self, group_name):
+        with self.lock:
+            self.groups.discard(group_name)
+            self.members.pop(group_name, None)
+
+    def add_member(self, group_name, username):
+        with self.lock:
+            members = self.members.get(group_name, EMPTY)
+            if username not in members:
+                self.members[group_name] = members | {username}
+
+    def discard_member(self, group_name, username):
+        with self.lock:
+            members = self.members.get(group_name, EMPTY) - {username}
+            if members:
+                self.members[group_name] = members
+            else:
+                self.members.pop(group_name, None)
+
+    def set_group(self, group_name, exists, members):
+        # o grupo mudou em outro processo (cluster): põe o que o banco diz agora
+        with self.lock:
+            if exists:
+                self.groups.add(group_name)
+            else:
+                self.groups.discard(group_name)
+            if exists and members:
+                self.members[group_name] = frozenset(members)
+            else:
+                self.members.pop(group_name, None)
+
+    def stats(self):
+        return {
+            "users": len(self.users) if self.keep_users else self.user_filter.count,
+            "groups": len(self.groups),
+            "memberships": sum(len(members) for members in self.members.values()),
+            "source": self.source,
+            "load_seconds": round(self.load_seconds, 3),
+        }
+
+    # carga
+
+    def load(self, conn, snapshot_path=None):
+        # carrega do snapshot se ele for do banco como tá agora; senão das tabelas
+        # (e grava um snapshot novo pra próxima vez). tudo numa transação de leitura
+        # só, então o que foi lido bate com a "impressão digital" guardada
+        start = time.perf_counter()
+        conn.execute("BEGIN")
+        try:
+            fingerprint = self.fingerprint(conn)
+            if snapshot_path and self.load_snapshot(snapshot_path, fingerprint):
+                self.source = 'snapshot'
+            else:
+                self.load_tables(conn, fingerprint)
+                self.source = 'banco'
+        finally:
+            conn.execute("COMMIT")
+        self.load_seconds = time.perf_counter() - start
+        if snapshot_path and self.source == 'banco':
+            self.save_snapshot(snapshot_path, fingerprint)
+
+    def fingerprint(self, conn):
+        # maior rowid + quantidade de cada tabela: qualquer INSERT muda isso
+        # (o app não apaga users, grupos nem membros, então não tem como voltar pro mesmo número)
+        return [list(conn.execute(f"SELECT COALESCE(MAX(rowid), 0), COUNT(*) FROM {table}").fetchone())
+                for table in ('users', 'groups', 'group_members')]
+
+    def load_tables(self, conn, fingerprint):
+        # um SELECT por tabela, lido em streaming pelo cursor
+        # (sem o set de users, os nomes vão direto pro filtro, dimensionado pelo COUNT)
+        names = (row[0] for row in conn.execute("SELECT username FROM users"))
+        if self.keep_users:
+            users, user_filter = set(names), None
+        else:
+            users, user_filter = set(), build_filter(names, fingerprint[0][1], self.error_rate)
+        groups = {row[0] for row in conn.execute("SELECT name FROM groups")}
+        members = {}
+        for group_name, username in conn.execute("SELECT group_name, username FROM group_members"):
+            members.setdefault(group_name, []).append(username)
+        self._install(users, user_filter, groups, {group_name: frozenset(names) for group_name, names in members.items()})
+
+    def _install(self, users, user_filter, groups, members):
+        with self.lock:
+            self.users = users
+            self.user_filter = user_filter
+            self.groups = groups
+            self.members = members
+
+    # snapshot: uma linha JSON de cabeçalho, os bits do filtro (se tiver) e um JSON com os nomes
+
+    def save_snapshot(self, path, fingerprint):
+        with self.lock:
+            bloom = self.user_filter
+            bits = bytes(bloom.bits) if bloom else b''
+            body = json.dumps({
+                "users": list(self.users),
+                "groups": list(self.groups),
+                "members": {group_name: list(names) for group_name, names in self.members.items()},
+            }, ensure_ascii=False).encode('utf-8', 'surrogatepass')
+        header = {
+            "version": SNAPSHOT_VERSION,
+            "fingerprint": fingerprint,
+            "filter": [bloom.capacity, bloom.error_rate, bloom.count, len(bits)] if bloom else None,
+            "body": len(body),
+        }
+        tmp = f"{path}.{os.getpid()}.tmp"  # cada nó do cluster com o seu
+        try:
+            with open(tmp, 'wb') as f:
+                f.write(json.dumps(header).encode('utf-8') + b'\n')
+                f.write(bits)
+                f.write(body)
+            os.replace(tmp, path)  # troca de uma vez: ninguém lê um snapshot pela metade
+        except OSError as e:
+            print(f"[Aviso] Não deu pra gravar o snapshot do índice ({path}): {e}")
+
+    def load_snapshot(self, path, fingerprint):
+        # devolve False se não tem snapshot, se ele é de outro estado do banco ou do outro modo
+        try:
+            with open(path, 'rb') as f:
+                header = json.loads(f.readline())
+                if (header.get('version') != SNAPSHOT_VERSION or header.get('fingerprint') != fingerprint
+                        or (header.get('filter') is None) != self.keep_users):
+                    return False
+                bloom = None
+                if header['filter']:
+                    capacity, error_rate, count, length = header['filter']
+                    bloom = BloomFilter(capacity, error_rate)
+                    bloom.bits = bytearray(f.read(length))
+                    bloom.count = count
+                    if len(bloom.bits) != (bloom.size + 7) // 8:
+                        return False
+                body = json.loads(f.read(header['body']).decode('utf-8', 'surrogatepass'))
+        except (OSError, ValueError, KeyError, TypeError):
+            return False
+        self._install(set(body['users']), bloom, set(body['groups']),
+                      {group_name: frozenset(names) for group_name, names in body['members'].items()})
+        return True
@@ -1,9 +1,177 @@
+import argparse
+import multiprocessing
+import os
+import signal
+import time
+
 # pega a classe ChatServer do server.py
 from server import ChatServer
+from async_server import AsyncChatServer
+from database import Database
+from user import UserManager
+from cluster import BusBroker, UnixSocketBus, ClusterRouter
+from metrics import Metrics
+from ratelimit import parse_limit
+from files import FileStore
+
+
+def stop(*_):
+    # Ctrl+C ou SIGTERM (kill, ou o processo principal do cluster parando os nós): o
+    # primeiro sinal para o servidor, os outros são ignorados pra parada terminar
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    signal.signal(signal.SIGTERM, signal.SIG_IGN)
+    raise KeyboardInterrupt
+
+
+def run_node(args, node_id=None, index=0):
+    # monta e liga um servidor (no modo cluster, cada processo roda um desses)
+    metrics = Metrics(enabled=args.metrics)
+    if args.metrics and args.metrics_port:
+        # no cluster cada nó usa a porta seguinte
+        metrics.serve_http(args.metrics_host, args.metrics_port + index)
+    db = Database(args.db, synchronous=args.synchronous, cache_size_kb=args.cache_kb, commit_window=args.commit_window,
+                  identity_snapshot=f"{args.db}.identity" if args.identity_snapshot is None else args.identity_snapshot or None,
+                  keep_users=args.identity_users == "memory", offline_shards=args.offline_shards, metrics=metrics)
+    user_manager = UserManager(db, iterations=args.pbkdf2_iterations, pool_size=args.auth_pool, max_pending=args.auth_max_pending,
+                               use_processes=args.auth_processes, token_ttl=args.token_ttl, metrics=metrics)
+    cluster = ClusterRouter(UnixSocketBus(args.broker), node_id) if node_id is not None else None
+
+    # opções que valem pros dois motores
+    options = dict(queue_high_watermark=args.queue_high, queue_low_watermark=args.queue_low, overflow_policy=args.overflow,
+                   fanout_workers=args.fanout_workers, fanout_threshold=args.fanout_threshold, db=db,
+                   offline_batch_size=args.offline_batch, user_manager=user_manager,
+                   cluster=cluster, reuse_port=node_id is not None and args.workers > 1,
+                   metrics=metrics, admins=[name for name in args.admins.split(",") if name],
+                   max_inflight=args.max_inflight, heartbeat_interval=args.heartbeat,
+                   idle_timeout=args.idle_timeout, auth_timeout=args.auth_timeout,
+                   command_limit=parse_limit(args.rate_commands), dm_limit=parse_limit(args.rate_dm),
+                   fanout_limit=parse_limit(args.rate_fanout), group_limit=parse_limit(args.rate_group),
+                   login_limit=parse_limit(args.rate_login), resume_limit=parse_limit(args.rate_resume),
+                   flush_delay=args.flush_delay_us / 1e6, flush_bytes=args.flush_bytes,
+                   files=FileStore(args.files_dir or f"{args.db}.files", int(args.max_file_mb * 1024 * 1024)),
+                   max_uploads=args.max_uploads)
 
-if __name__ == "__main__":
     # cria o servidor (usa host/port padrão se não passar nada)
-    server = ChatServer()
-    
+    if args.mode == "async":
+        server = AsyncChatServer(args.host, args.port, args.backlog, loops=args.loops, db_workers=args.db_workers, **options)
+    else:
+        server = ChatServer(args.host, args.port, args.backlog, **options)
+
+    signal.signal(signal.SIGINT, stop)
+    signal.signal(signal.SIGTERM, stop)
+
     # liga o servidor — o método start() entra no loop principal
-    server.start()
\ No newline at end of file
+    try:
+        server.start()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        # parada limpa: o writer grava o que tá na fila e o snapshot do índice sai com
+        # a foto final do banco (sem isso a próxima subida sempre relê as tabelas)
+        db.close()
+        print("[Servidor] Banco fechado.")
+
+
+if __name__ == "__main__":
+    # dá pra escolher o motor na linha de comando, pra comparar os dois
+    parser = argparse.ArgumentParser(description="Servidor do chat")
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=12345)
+    parser.add_argument("--mode", choices=["thread", "async"], default="thread",
+                        help="thread = uma thread por cliente (original), async = event loop")
+    parser.add_argument("--backlog", type=int, default=128, help="fila de conexões pendentes do listen()")
+    parser.add_argument("--loops", type=int, default=None, help="quantos event loops no modo async (padrão: nº de núcleos)")
+    parser.add_argument("--db-workers", type=int, default=None, help="threads pro banco no modo async")
+    parser.add_argument("--queue-high", type=int, default=1024 * 1024, help="bytes na fila de saída de um cliente pra considerar congestionado")
+    parser.add_argument("--queue-low", type=int, default=256 * 1024, help="bytes pra sair do congestionamento")
+    parser.add_argument("--overflow", choices=["drop_oldest", "spill", "disconnect"], default="drop_oldest",
+                        help="o que fazer quando a fila de um cliente lerdo estoura")
+    parser.add_argument("--fanout-workers", type=int, default=4, help="threads pra entregar msg em grupo grande")
+    parser.add_argument("--fanout-threshold", type=int, default=1000, help="a partir de quantos destinatários divide entre threads")
+    parser.add_argument("--db", default="chat.db", help="arquivo do banco")
+    parser.add_argument("--synchronous", choices=["OFF", "NORMAL", "FULL"], default="NORMAL", help="PRAGMA synchronous do sqlite")
+    parser.add_argument("--cache-kb", type=int, default=16384, help="cache de páginas do sqlite por conexão (KB)")
+    parser.add_argument("--identity-snapshot", default=None,
+                        help="arquivo do snapshot do índice de users/grupos (padrão: <db>.identity, \"\" = sem snapshot)")
+    parser.add_argument("--identity-users", choices=["memory", "bloom"], default="memory",
+                        help="memory = nomes dos users num conjunto (mais rápido), bloom = só o filtro de Bloom, "
+                             "quem passa nele é confirmado no banco (bem menos memória com milhões de users)")
+    parser.add_argument("--offline-shards", type=int, default=None,
+                        help="msgs offline divididas em N arquivos sqlite, cada um com seu writer (0 = no banco principal; "
+                             "padrão: o que o banco já usa; pra mudar com msgs guardadas, server/rebalance.py)")
+    parser.add_argument("--commit-window", type=float, default=0.005, help="segundos que o writer segura o commit juntando escritas")
+    parser.add_argument("--offline-batch", type=int, default=200, help="quantas msgs offline por lote no login")
+    parser.add_argument("--pbkdf2-iterations", type=int, default=100000, help="iterações do PBKDF2 pra senhas novas")
+    parser.add_argument("--auth-pool", type=int, default=None, help="threads/processos pro PBKDF2 (padrão: nº de núcleos)")
+    parser.add_argument("--auth-max-pending", type=int, default=64, help="quantos hashes podem esperar no pool antes de recusar login")
+    parser.add_argument("--auth-processes", action="store_true", help="usa processos em vez de threads pro PBKDF2")
+    parser.add_argument("--token-ttl", type=int, default=3600, help="segundos que o token de sessão vale pra reconectar")
+    parser.add_argument("--workers", type=int, default=1,
+                        help="quantos processos servidor (mais de 1 = cluster na mesma porta com SO_REUSEPORT)")
+    parser.add_argument("--broker", default=None, help="socket unix do broker do cluster (padrão: /tmp/chatinho-<porta>.sock)")
+    parser.add_argument("--broker-only", action="store_true", help="roda só o broker (os nós sobem com --node-id)")
+    parser.add_argument("--node-id", default=None, help="entra como esse nó num broker que já tá rodando")
+    parser.add_argument("--heartbeat", type=float, default=30,
+                        help="segundos sem receber nada até mandar um ping pro cliente (0 = sem ping)")
+    parser.add_argument("--idle-timeout", type=float, default=90,
+                        help="segundos sem receber nada (nem pong) até derrubar a conexão (0 = nunca)")
+    parser.add_argument("--auth-timeout", type=float, default=30,
+                        help="segundos pra cumprimentar e logar depois de conectar (0 = sem limite)")
+    # limites de taxa: "taxa por segundo[:rajada]", taxa 0 desliga
+    parser.add_argument("--rate-commands", default="20:40", help="comandos por user")
+    parser.add_argument("--rate-dm", default="5:10", help="DMs por user")
+    parser.add_argument("--rate-fanout", default="1000:5000", help="destinatários de msgs de grupo por user")
+    parser.add_argument("--rate-group", default="2000:10000", help="destinatários de msgs por grupo (somando todo mundo)")
+    parser.add_argument("--rate-login", default="0.1:5", help="logins que falharam por IP e user")
+    parser.add_argument("--rate-resume", default="1:20", help="resumes que falharam por IP")
+    parser.add_argument("--max-inflight", type=int, default=8,
+                        help="comandos de leitura de uma mesma conexão rodando ao mesmo tempo")
+    parser.add_argument("--flush-delay-us", type=float, default=0,
+                        help="microssegundos que o writer espera pra juntar mais quadros numa escrita (0 = só o que já tá na fila)")
+    parser.add_argument("--flush-bytes", type=int, default=64 * 1024,
+                        help="bytes juntados que fazem o writer escrever sem esperar o flush delay")
+    parser.add_argument("--files-dir", default=None, help="onde ficam os anexos (padrão: <db>.files)")
+    parser.add_argument("--max-file-mb", type=float, default=100, help="tamanho máximo de um anexo (MB)")
+    parser.add_argument("--max-uploads", type=int, default=4, help="envios de arquivo ao mesmo tempo por conexão")
+    parser.add_argument("--metrics", action="store_true", help="liga as métricas (comando 'stats' e /metrics)")
+    parser.add_argument("--metrics-host", default="127.0.0.1", help="onde o /metrics escuta")
+    parser.add_argument("--metrics-port", type=int, default=9100, help="porta HTTP do /metrics (0 = sem HTTP)")
+    parser.add_argument("--admins", default="", help="users que podem pedir 'stats', separados por vírgula")
+    args = parser.parse_args()
+    args.broker = args.broker or f"/tmp/chatinho-{args.port}.sock"
+
+    if args.broker_only:
+        broker = BusBroker(args.broker)
+        broker.start()
+        while True:
+            time.sleep(3600)
+    elif args.node_id is not None:
+        # nó avulso (ex: outra porta, atrás de um balanceador); o token só vale
+        # entre nós se todos tiverem o mesmo CHAT_TOKEN_SECRET
+        run_node(args, args.node_id)
+    elif args.workers > 1:
+        # todo mundo precisa do mesmo segredo, senão o token de um nó não vale no outro
+        os.environ.setdefault('CHAT_TOKEN_SECRET', os.urandom(32).hex())
+        broker = BusBroker(args.broker)
+        broker.start()
+        # kill no processo principal para o cluster inteiro (pelo mesmo caminho do Ctrl+C)
+        signal.signal(signal.SIGTERM, stop)
+        workers = [multiprocessing.Process(target=run_node, args=(args, f"node-{i}", i), name=f"node-{i}")
+                   for i in range(args.workers)]
+        for worker in workers:
+            worker.start()
+        try:
+            for worker in workers:
+                worker.join()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            # cada nó para com o SIGTERM (ou já tá parando com o Ctrl+C) e fecha o banco
+            for worker in workers:
+                if worker.is_alive():
+                    worker.terminate()
+            for worker in workers:
+                worker.join(timeout=10)
+            broker.close()
+    else:
+        run_node(args)
@@ -0,0 +1,204 @@
+# métricas do servidor (contadores e histogramas), no formato de texto do Prometheus
+#
+# - desligado (enabled=False) cada chamada volta na primeira linha; os lugares mais
+#   quentes ainda checam metrics.enabled antes de medir o tempo
+# - ligado, ninguém disputa um lock global: os valores ficam em "listras" (stripes),
+#   cada thread sempre escreve na mesma listra e só a leitura (/metrics, 'stats')
+#   passa por todas somando
+import bisect
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+LATENCY_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (1, 2, 5, 10, 50, 100, 500, 1000, 5000, 10000, 50000)
+
+# nome -> (tipo, descrição, nome do rótulo ou None, buckets do histograma)
+DEFINITIONS = {
+    'chat_commands_total': ('counter', 'comandos recebidos', 'command', None),
+    'chat_command_seconds': ('histogram', 'tempo pra tratar um comando', 'command', LATENCY_BUCKETS),
+    'chat_db_query_seconds': ('histogram', 'tempo das consultas no banco (escrita: até o commit)', 'query', LATENCY_BUCKETS),
+    'chat_db_commit_seconds': ('histogram', 'tempo de cada commit do writer', None, LATENCY_BUCKETS),
+    'chat_db_commit_writes': ('histogram', 'escritas juntadas em cada commit', None, SIZE_BUCKETS),
+    'chat_pbkdf2_seconds': ('histogram', 'tempo calculando PBKDF2', None, LATENCY_BUCKETS),
+    'chat_pbkdf2_queue_seconds': ('histogram', 'tempo esperando vaga no pool do PBKDF2', None, LATENCY_BUCKETS),
+    'chat_fanout_recipients': ('histogram', 'destinatários por entrega em grupo', None, SIZE_BUCKETS),
+    'chat_fanout_seconds': ('histogram', 'tempo de uma entrega em grupo', None, LATENCY_BUCKETS),
+    'chat_bytes_in_total': ('counter', 'bytes recebidos dos clientes', None, None),
+    'chat_bytes_out_total': ('counter', 'bytes mandados pros clientes', None, None),
+    'chat_socket_writes_total': ('counter', 'escritas nos sockets dos clientes (cada uma leva um lote de quadros)', None, None),
+    'chat_connections_total': ('counter', 'conexões aceitas', None, None),
+    'chat_connections_active': ('gauge', 'conexões abertas agora', None, None),
+    'chat_sessions_reaped_total': ('counter', 'conexões derrubadas por prazo (auth ou inatividade)', 'reason', None),
+    'chat_rate_limited_total': ('counter', 'ações recusadas por limite de taxa', 'budget', None),
+}
+
+
+class _Stripe:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}    # (nome, rótulo) -> valor
+        self.histograms = {}  # (nome, rótulo) -> [contagem por bucket..., +Inf], soma
+
+
+class Metrics:
+    def __init__(self, enabled=True, stripes=32):
+        self.enabled = enabled
+        self.stripes = [_Stripe() for _ in range(stripes)]
+        self.local = threading.local()
+        self.gauges = {}  # nome -> (descrição, função que lê o valor na hora)
+
+    def _stripe(self):
+        stripe = getattr(self.local, 'stripe', None)
+        if stripe is None:
+            # o id nativo da thread é sequencial, então as threads se espalham bem
+            stripe = self.stripes[threading.get_native_id() % len(self.stripes)]
+            self.local.stripe = stripe
+        return stripe
+
+    def inc(self, name, value=1, label=None):
+        if not self.enabled:
+            return
+        stripe = self._stripe()
+        key = (name, label)
+        with stripe.lock:
+            stripe.counters[key] = stripe.counters.get(key, 0) + value
+
+    def observe(self, name, value, label=None):
+        if not self.enabled:
+            return
+        buckets = DEFINITIONS[name][3]
+        stripe = self._stripe()
+        key = (name, label)
+        with stripe.lock:
+            histogram = stripe.histograms.get(key)
+            if histogram is None:
+                histogram = stripe.histograms[key] = [[0] * (len(buckets) + 1), 0.0]
+            histogram[0][bisect.bisect_left(buckets, value)] += 1
+            histogram[1] += value
+
+    def gauge(self, name, description, read):
+        # valor calculado na hora da leitura (ex: quantas threads existem)
+        if not self.enabled:
+            return
+        self.gauges[name] = (description, read)
+
+    # leitura
+
+    def collect(self):
+        # soma todas as listras: ({(nome, rótulo): valor}, {(nome, rótulo): [buckets, soma]})
+        counters, histograms = {}, {}
+        for stripe in self.stripes:
+            with stripe.lock:
+                for key, value in stripe.counters.items():
+                    counters[key] = counters.get(key, 0) + value
+                for key, (counts, total) in stripe.histograms.items():
+                    merged = histograms.setdefault(key, [[0] * len(counts), 0.0])
+                    for i, count in enumerate(counts):
+                        merged[0][i] += count
+                    merged[1] += total
+        return counters, histograms
+
+    def render(self):
+        # texto no formato do Prometheus
+        counters, histograms = self.collect()
+        lines = []
+        for name, (kind, description, label_name, buckets) in DEFINITIONS.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} {kind}")
+            if kind == 'histogram':
+                for (metric, label), (counts, total) in sorted(histograms.items(), key=_sort_key):
+                    if metric != name:
+                        continue
+                    labels = _labels(label_name, label)
+                    cumulative = 0
+                    for bound, count in zip(buckets + ('+Inf',), counts):
+                        cumulative += count
+                        lines.append(f'{name}_bucket{_labels(label_name, label, le=bound)} {cumulative}')
+                    lines.append(f"{name}_sum{labels} {total}")
+                    lines.append(f"{name}_count{labels} {cumulative}")
+            else:
+                for (metric, label), value in sorted(counters.items(), key=_sort_key):
+                    if metric == name:
+                        lines.append(f"{name}{_labels(label_name, label)} {value}")
+        for name, (description, read) in self.gauges.items():
+            lines.append(f"# HELP {name} {description}")
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {read()}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self):
+        # a mesma coisa em dict (pro comando 'stats'): histogramas viram contagem, média e percentis
+        counters, histograms = self.collect()
+        out = {}
+        for (name, label), value in counters.items():
+            out[_key(name, label)] = value
+        for (name, label), (counts, total) in histograms.items():
+            buckets = DEFINITIONS[name][3]
+            count = sum(counts)
+            out[_key(name, label)] = {
+                "count": count,
+                "avg": total / count if count else 0.0,
+                "p50": _bucket_percentile(buckets, counts, 0.50),
+                "p99": _bucket_percentile(buckets, counts, 0.99),
+            }
+        for name, (_, read) in self.gauges.items():
+            out[name] = read()
+        return out
+
+    def serve_http(self, host='127.0.0.1', port=9100):
+        # GET /metrics numa thread separada
+        metrics = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] != '/metrics':
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass  # sem um print por scrape
+
+        server = ThreadingHTTPServer((host, port), Handler)
+        thread = threading.Thread(target=server.serve_forever, name="metrics-http", daemon=True)
+        thread.start()
+        print(f"[Métricas] http://{host}:{port}/metrics")
+        return server
+
+
+def _sort_key(item):
+    name, label = item[0]
+    return name, label or ''
+
+
+def _labels(label_name, label, le=None):
+    parts = []
+    if label_name and label is not None:
+        parts.append(f'{label_name}="{label}"')
+    if le is not None:
+        parts.append(f'le="{le}"')
+    return "{" + ",".join(parts) + "}" if parts else ""
+
+
+def _key(name, label):
+    return f"{name}[{label}]" if label is not None else name
+
+
+def _bucket_percentile(buckets, counts, fraction):
+    # limite superior do bucket onde cai o percentil (None = passou do último)
+    target = fraction * sum(counts)
+    cumulative = 0
+    for bound, count in zip(buckets + (None,), counts):
+        cumulative += count
+        if count and cumulative >= target:
+            return bound
+    return 0.0
+
+
+# instância desligada, pra quem não recebe uma (custo: um if por chamada)
+DISABLED = Metrics(enabled=False, stripes=1)
@@ -0,0 +1,108 @@
+# quem tá online (user -> sessão) e quem quer saber disso
+# os dicts antigos eram mexidos por todas as threads sem lock nenhum; aqui o
+# registro é dividido em "listras" (stripes), cada uma com seu lock, então
+# dois logins só disputam lock se caírem na mesma listra
+import threading
+import zlib
+
+MAX_WATCHED = 1000  # quantos users/grupos uma sessão pode acompanhar
+
+
+class PresenceRegistry:
+    def __init__(self, stripes=16):
+        self.stripes = [({}, threading.Lock()) for _ in range(stripes)]
+        # assinaturas: alvo -> sessões interessadas
+        self.user_watchers = {}
+        self.group_watchers = {}
+        self.watch_lock = threading.Lock()
+
+    def _stripe(self, username):
+        # crc32 em vez de hash() pra listra ser a mesma em qualquer processo
+        return self.stripes[zlib.crc32(username.encode('utf-8')) % len(self.stripes)]
+
+    # registro de sessões
+
+    def add(self, username, session):
+        # marca online; False se já tinha alguém logado com esse nome
+        # (checar e guardar é uma coisa só, então dois logins juntos não passam os dois)
+        sessions, lock = self._stripe(username)
+        with lock:
+            if username in sessions:
+                return False
+            sessions[username] = session
+            return True
+
+    def remove(self, username, session):
+        # só tira se ainda for a mesma sessão (pode já ter logado de novo)
+        sessions, lock = self._stripe(username)
+        with lock:
+            if sessions.get(username) is session:
+                del sessions[username]
+                return True
+            return False
+
+    def get(self, username, default=None):
+        sessions, lock = self._stripe(username)
+        with lock:
+            return sessions.get(username, default)
+
+    def __contains__(self, username):
+        return self.get(username) is not None
+
+    def items(self):
+        # foto de quem tá online agora
+        out = []
+        for sessions, lock in self.stripes:
+            with lock:
+                out.extend(sessions.items())
+        return out
+
+    def __iter__(self):
+        return iter([username for username, _ in self.items()])
+
+    def __len__(self):
+        return sum(len(sessions) for sessions, _ in self.stripes)
+
+    # assinaturas de presença
+
+    def subscribe(self, session, users=(), groups=()):
+        # a sessão passa a receber entrou/saiu desses users e dos membros desses grupos
+        with self.watch_lock:
+            for username in users:
+                if len(session.watching_users) >= MAX_WATCHED:
+                    break
+                session.watching_users.add(username)
+                self.user_watchers.setdefault(username, set()).add(session)
+            for group_name in groups:
+                if len(session.watching_groups) >= MAX_WATCHED:
+                    break
+                session.watching_groups.add(group_name)
+                self.group_watchers.setdefault(group_name, set()).add(session)
+
+    def unsubscribe(self, session, users=(), groups=()):
+        with self.watch_lock:
+            for username in users:
+                session.watching_users.discard(username)
+                self._discard(self.user_watchers, username, session)
+            for group_name in groups:
+                session.watching_groups.discard(group_name)
+                self._discard(self.group_watchers, group_name, session)
+
+    def drop_session(self, session):
+        # sessão caiu: tira todas as assinaturas dela
+        self.unsubscribe(session, list(session.watching_users), list(session.watching_groups))
+
+    def _discard(self, watchers, key, session):
+        sessions = watchers.get(key)
+        if sessions is not None:
+            sessions.discard(session)
+            if not sessions:
+                del watchers[key]
+
+    def watchers(self, username, groups=()):
+        # sessões que querem saber quando 'username' entra/sai
+        with self.watch_lock:
+            out = set(self.user_watchers.get(username, ()))
+            for group_name in groups:
+                out.update(self.group_watchers.get(group_name, ()))
+        return out
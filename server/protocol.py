@@ -0,0 +1,244 @@
+# camada de enquadramento (framing) do chat
+# o TCP é um fluxo de bytes: duas mensagens podem chegar grudadas num recv só,
+# ou uma mensagem grande pode chegar picada. por isso cada mensagem vai
+# dentro de um "quadro" com o tamanho na frente:
+#
+#   [tamanho do payload: 4 bytes big-endian][tipo: 1 byte][payload]
+#
+# esse arquivo é usado pelo servidor e pelo cliente (client/protocol.py aponta pra cá)
+import json
+import struct
+import zlib
+
+import codec
+
+# cumprimento que o cliente manda logo que conecta: 'CR' + versão
+# a partir da versão 2 vem mais 1 byte com os recursos que ele quer (FEATURE_*)
+# e o servidor responde com os que aceitou
+MAGIC = b'CR'
+PROTOCOL_VERSION = 2
+
+FEATURE_BINARY = 0x01  # mensagens no formato binário (codec.py) em vez de JSON
+FEATURE_ZLIB = 0x02    # payload grande vai comprimido
+FEATURE_HEARTBEAT = 0x04  # cliente responde {"type": "ping"} com {"command": "pong"}
+CODEC_FEATURES = FEATURE_BINARY | FEATURE_ZLIB  # os recursos que mudam o formato dos quadros
+SUPPORTED_FEATURES = CODEC_FEATURES | FEATURE_HEARTBEAT
+
+HEADER = struct.Struct('!IB')
+KIND_JSON = 0          # payload é um objeto JSON
+KIND_BATCH = 1         # payload é uma lista JSON de objetos (várias msgs num quadro só)
+KIND_BINARY = 2        # payload é um objeto no formato binário
+KIND_BINARY_BATCH = 3  # payload é uma lista no formato binário
+KIND_CHUNK = 4         # pedaço de arquivo: [transferência: 4 bytes][offset: 8 bytes][bytes crus]
+FLAG_ZLIB = 0x80       # bit no tipo: payload comprimido com zlib
+
+MAX_FRAME_SIZE = 16 * 1024 * 1024  # ninguém manda 16MB de texto, isso é lixo/ataque
+RECV_SIZE = 64 * 1024
+COMPRESS_THRESHOLD = 512  # abaixo disso o zlib mais atrapalha do que ajuda
+CHUNK_HEADER = struct.Struct('!IQ')
+
+
+class ProtocolError(Exception):
+    # quadro zoado, versão desconhecida, tamanho absurdo...
+    pass
+
+
+def hello(version=PROTOCOL_VERSION, features=0):
+    # bytes do cumprimento (o servidor responde com o mesmo formato)
+    if version >= 2:
+        return MAGIC + bytes([version, features])
+    return MAGIC + bytes([version])
+
+
+class Codec:
+    # como uma sessão codifica o que manda (combinado no cumprimento)
+    # decodificar não depende disso: o tipo do quadro já diz o formato
+    def __init__(self, binary=False, compress=False, threshold=COMPRESS_THRESHOLD):
+        self.binary = binary
+        self.compress = compress
+        self.threshold = threshold
+        self.features = (FEATURE_BINARY if binary else 0) | (FEATURE_ZLIB if compress else 0)
+
+    def encode(self, data):
+        # dict -> quadro pronto pra mandar
+        if self.binary:
+            return self._frame(codec.dumps(data), KIND_BINARY)
+        return self._frame(json.dumps(data).encode('utf-8'), KIND_JSON)
+
+    def encode_batch(self, items):
+        # vários dicts num quadro só (ex: as msgs offline no login)
+        if self.binary:
+            return self._frame(codec.dumps(items), KIND_BINARY_BATCH)
+        return self._frame(json.dumps(items).encode('utf-8'), KIND_BATCH)
+
+    def _frame(self, payload, kind):
+        if self.compress and len(payload) > self.threshold:
+            compressed = zlib.compress(payload, 1)
+            if len(compressed) < len(payload):
+                payload = compressed
+                kind |= FLAG_ZLIB
+        return HEADER.pack(len(payload), kind) + payload
+
+
+# um objeto por combinação de recursos, compartilhado por todas as sessões
+# (o fan-out agrupa as sessões por codec pra montar cada quadro uma vez só)
+CODECS = {features: Codec(bool(features & FEATURE_BINARY), bool(features & FEATURE_ZLIB))
+          for features in range(CODEC_FEATURES + 1)}
+JSON_CODEC = CODECS[0]
+
+
+def codec_for(features):
+    return CODECS[features & CODEC_FEATURES]
+
+
+def encode(data):
+    # quadro JSON (o formato que todo mundo entende)
+    return JSON_CODEC.encode(data)
+
+
+def encode_batch(items):
+    return JSON_CODEC.encode_batch(items)
+
+
+def chunk_header(transfer, offset, size):
+    # começo do quadro de um pedaço de arquivo com 'size' bytes; os bytes vêm logo
+    # depois, do jeito que quem manda quiser (no mesmo buffer ou por sendfile)
+    # pedaço de arquivo não passa pelo codec: vai cru, sem JSON e sem zlib
+    return HEADER.pack(CHUNK_HEADER.size + size, KIND_CHUNK) + CHUNK_HEADER.pack(transfer, offset)
+
+
+def encode_chunk(transfer, offset, data):
+    return chunk_header(transfer, offset, len(data)) + data
+
+
+class FrameDecoder:
+    # decodificador incremental: vai recebendo pedaços de bytes e
+    # devolve as mensagens inteiras que já deu pra montar
+    def __init__(self, max_frame_size=MAX_FRAME_SIZE, on_receive=None):
+        self.max_frame_size = max_frame_size
+        self.on_receive = on_receive  # chamada com quantos bytes chegaram (métricas)
+        self.pending = bytearray()  # bytes que ainda não formaram um quadro
+        # buffer fixo reaproveitado em todo recv (evita alocar um bytes novo por leitura);
+        # só é criado no primeiro recv_from, quem usa feed() (asyncio) não paga os 64KB
+        self.recv_buffer = None
+        self.recv_view = None
+
+    def feed(self, data):
+        self.pending += data
+        if self.on_receive:
+            self.on_receive(len(data))
+
+    def recv_from(self, sock):
+        # lê direto pro buffer fixo; devolve quantos bytes vieram (0 = fechou)
+        if self.recv_buffer is None:
+            self.recv_buffer = bytearray(RECV_SIZE)
+            self.recv_view = memoryview(self.recv_buffer)
+        n = sock.recv_into(self.recv_buffer)
+        if n:
+            self.pending += self.recv_view[:n]
+            if self.on_receive:
+                self.on_receive(n)
+        return n
+
+    def read_handshake(self):
+        # devolve (versão, recursos) do outro lado, ou None se ainda não chegou tudo
+        if len(self.pending) < len(MAGIC) + 1:
+            return None
+        if self.pending[:len(MAGIC)] != MAGIC:
+            raise ProtocolError("cumprimento inválido (cliente antigo ou outro protocolo?)")
+        version = self.pending[len(MAGIC)]
+        size = len(MAGIC) + (2 if version >= 2 else 1)
+        if len(self.pending) < size:
+            return None
+        features = self.pending[size - 1] if version >= 2 else 0
+        del self.pending[:size]
+        return version, features
+
+    def _decompress(self, payload):
+        # descomprime sem deixar passar do tamanho máximo (bomba de zlib)
+        inflater = zlib.decompressobj()
+        try:
+            data = inflater.decompress(payload, self.max_frame_size)
+        except zlib.error as e:
+            raise ProtocolError(f"quadro comprimido inválido: {e}") from e
+        if inflater.unconsumed_tail:
+            raise ProtocolError("quadro comprimido grande demais")
+        return data
+
+    def messages(self):
+        # tira do buffer todos os quadros completos
+        offset = 0
+        out = []
+        while len(self.pending) - offset >= HEADER.size:
+            size, kind = HEADER.unpack_from(self.pending, offset)
+            if size > self.max_frame_size:
+                raise ProtocolError(f"quadro de {size} bytes passa do limite")
+            end = offset + HEADER.size + size
+            if len(self.pending) < end:
+                break  # quadro ainda incompleto, espera mais bytes
+            payload = bytes(self.pending[offset + HEADER.size:end])
+            offset = end
+            if kind & FLAG_ZLIB:
+                payload = self._decompress(payload)
+                kind &= ~FLAG_ZLIB
+            if kind == KIND_JSON:
+                out.append(self._loads_json(payload))
+            elif kind == KIND_BATCH:
+                out.extend(self._loads_json(payload))
+            elif kind == KIND_BINARY:
+                out.append(self._loads_binary(payload))
+            elif kind == KIND_BINARY_BATCH:
+                out.extend(self._loads_binary(payload))
+            elif kind == KIND_CHUNK:
+                if len(payload) < CHUNK_HEADER.size:
+                    raise ProtocolError("pedaço de arquivo sem cabeçalho")
+                transfer, chunk_offset = CHUNK_HEADER.unpack_from(payload)
+                out.append({"file_chunk": transfer, "offset": chunk_offset, "data": payload[CHUNK_HEADER.size:]})
+            else:
+                raise ProtocolError(f"tipo de quadro desconhecido: {kind}")
+        # descarta de uma vez só o que já foi consumido
+        if offset:
+            del self.pending[:offset]
+        return out
+
+    def _loads_json(self, payload):
+        # JSON quebrado (ou UTF-8 inválido) é erro do protocolo como qualquer outro quadro ruim
+        try:
+            return json.loads(payload.decode('utf-8'))
+        except (UnicodeDecodeError, ValueError) as e:
+            raise ProtocolError(f"JSON inválido: {e}") from e
+
+    def _loads_binary(self, payload):
+        try:
+            return codec.loads(payload)
+        except codec.CodecError as e:
+            raise ProtocolError(str(e)) from e
+
+
+def accept_handshake(sock, decoder):
+    # lado do servidor: espera o cumprimento e devolve (versão, recursos) combinados
+    while True:
+        greeting = decoder.read_handshake()
+        if greeting is not None:
+            break
+        if not decoder.recv_from(sock):
+            return None  # fechou antes de cumprimentar
+    return negotiate(*greeting)
+
+
+def negotiate(version, features):
+    # o que o servidor aceita do que o cliente pediu
+    if version < 1:
+        raise ProtocolError(f"versão {version} não suportada")
+    version = min(version, PROTOCOL_VERSION)
+    return version, (features & SUPPORTED_FEATURES if version >= 2 else 0)
+
+
+def read_messages(sock, decoder):
+    # gerador que vai devolvendo as mensagens de um socket bloqueante
+    # até o outro lado fechar a conexão
+    while True:
+        for message in decoder.messages():
+            yield message
+        if not decoder.recv_from(sock):
+            return
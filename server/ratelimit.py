@@ -0,0 +1,86 @@
+# limite de taxa por "balde de fichas" (token bucket)
+#
+# cada chave (user, grupo, IP) tem um balde com até 'burst' fichas que enche a
+# 'rate' fichas por segundo; cada ação gasta 'cost' fichas. balde sem ficha
+# suficiente = ação recusada, com quanto tempo falta pra ter (retry_after).
+#
+# memória: chave que não aparece no dicionário = balde cheio. então quem ficou
+# parado tempo suficiente pra encher o balde pode sair do dicionário sem mudar
+# nada; os baldes ficam numa OrderedDict em ordem de último uso e a cada acesso
+# o mais antigo é descartado se já encheu (O(1)). além disso tem um teto de chaves
+import math
+import threading
+import time
+from collections import OrderedDict
+
+
+def parse_limit(text):
+    # "taxa[:rajada]" da linha de comando, ex: "20:40" ou "0.2:5" (taxa 0 = sem limite)
+    rate, _, burst = str(text).partition(':')
+    rate = float(rate)
+    return rate, float(burst) if burst else max(1.0, rate)
+
+
+class RateLimiter:
+    def __init__(self, rate, burst=None, max_keys=100000):
+        self.rate = rate
+        self.burst = burst if burst is not None else max(1.0, rate)
+        self.max_keys = max_keys
+        self.buckets = OrderedDict()  # chave -> [fichas, hora da última conta]
+        self.lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return self.rate > 0
+
+    def _refill(self, key, now):
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = [self.burst, now]
+        else:
+            bucket[0] = min(self.burst, bucket[0] + (now - bucket[1]) * self.rate)
+            bucket[1] = now
+            self.buckets.move_to_end(key)
+        # o mais antigo já encheu de novo? então ele não precisa mais estar aqui
+        oldest_key, oldest = next(iter(self.buckets.items()))
+        if oldest_key != key and (len(self.buckets) > self.max_keys or
+                                  oldest[0] + (now - oldest[1]) * self.rate >= self.burst):
+            del self.buckets[oldest_key]
+        return bucket
+
+    def _wait(self, bucket, cost):
+        # quanto falta pra ter as fichas (custo maior que o balde: basta o balde cheio)
+        missing = min(cost, self.burst) - bucket[0]
+        return math.ceil(missing / self.rate * 100) / 100 if missing > 0 else 0
+
+    def take(self, key, cost=1):
+        # gasta 'cost' fichas; devolve 0 se pôde ou quantos segundos esperar
+        # (custo maior que o balde passa com o balde cheio e deixa ele "devendo":
+        # a próxima ação espera a dívida ser paga)
+        if not self.enabled:
+            return 0
+        with self.lock:
+            bucket = self._refill(key, time.monotonic())
+            wait = self._wait(bucket, cost)
+            if not wait:
+                bucket[0] -= cost
+            return wait
+
+    def check(self, key, cost=1):
+        # como take, mas sem gastar (ex: ainda dá pra tentar login desse IP?)
+        if not self.enabled:
+            return 0
+        with self.lock:
+            return self._wait(self._refill(key, time.monotonic()), cost)
+
+    def give_back(self, key, cost=1):
+        # devolve fichas de um take que acabou não valendo
+        if not self.enabled:
+            return
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is not None:
+                bucket[0] = min(self.burst, bucket[0] + cost)
+
+    def __len__(self):
+        return len(self.buckets)
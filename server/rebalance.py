@@ -0,0 +1,152 @@
+# muda o número de shards das msgs offline (ferramenta de admin, com o servidor parado)
+#
+#   python3 server/rebalance.py --db chat.db --shards 8   # 0 = tudo de volta pro banco principal
+#
+# - os arquivos do layout novo têm o número de shards no nome (chat.db.offline-3-of-8),
+#   então são montados do lado dos antigos, sem mexer neles
+# - as msgs são copiadas em streaming, na ordem de id de cada arquivo de origem (a ordem
+#   de cada user se mantém: todas as msgs dele estão num arquivo só), em lotes por transação
+# - a troca é um UPDATE no banco principal (storage_layout); só depois os arquivos antigos
+#   são apagados. se parar antes da troca, o layout antigo continua valendo e rodar de novo
+#   recomeça a cópia do zero (o que tinha sido copiado é descartado)
+import argparse
+import os
+import sqlite3
+import time
+
+from database import (OFFLINE_TABLE, count_offline, create_offline_table, read_layout, shard_index,
+                      shard_path, write_layout)
+
+COLUMNS = "sender, receiver, message, timestamp, file"
+
+
+def connect(path, synchronous):
+    conn = sqlite3.connect(path)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute(f"PRAGMA synchronous={synchronous}")
+    return conn
+
+
+def remove_files(path):
+    for suffix in ('', '-wal', '-shm'):
+        try:
+            os.remove(path + suffix)
+        except FileNotFoundError:
+            pass
+
+
+def layout_paths(db_path, count):
+    return [db_path] if count == 0 else [shard_path(db_path, i, count) for i in range(count)]
+
+
+def open_targets(db_path, primary, count, synchronous):
+    # conexões do layout novo, vazias (sobra de uma tentativa anterior é jogada fora)
+    if count == 0:
+        # o principal não é o layout atual, então o que tiver na tabela dele é sobra
+        primary.execute("DELETE FROM offline_messages")
+        primary.commit()
+        return [primary]
+    targets = []
+    for path in layout_paths(db_path, count):
+        remove_files(path)
+        conn = connect(path, synchronous)
+        create_offline_table(conn)
+        conn.commit()
+        targets.append(conn)
+    return targets
+
+
+def copy_rows(source, targets, batch_size, progress):
+    # lê um arquivo de origem em ordem de id e distribui as linhas pelos shards novos
+    pending = [[] for _ in targets]
+    buffered = 0
+
+    def flush():
+        for conn, rows in zip(targets, pending):
+            if rows:
+                conn.executemany(f"INSERT INTO offline_messages ({COLUMNS}) VALUES (?, ?, ?, ?, ?)", rows)
+                conn.commit()
+                progress.add(len(rows))
+                rows.clear()
+
+    for row in source.execute(f"SELECT {COLUMNS} FROM offline_messages ORDER BY id"):
+        pending[shard_index(row[1], len(targets))].append(row)
+        buffered += 1
+        if buffered >= batch_size:
+            flush()
+            buffered = 0
+    flush()
+
+
+class Progress:
+    def __init__(self, total):
+        self.total = total
+        self.rows = 0
+        self.started = self.last = time.perf_counter()
+
+    def add(self, rows, force=False):
+        self.rows += rows
+        now = time.perf_counter()
+        if force or now - self.last >= 2:
+            self.last = now
+            rate = self.rows / max(now - self.started, 1e-9)
+            print(f"[rebalance] {self.rows}/{self.total} msgs ({rate:.0f}/s)", flush=True)
+
+
+def rebalance(db_path, count, batch_size, synchronous):
+    primary = connect(db_path, synchronous)
+    try:
+        primary.execute(OFFLINE_TABLE)
+        current = read_layout(primary)
+        primary.commit()
+        if current == count:
+            print(f"[rebalance] o banco já usa {count} shard(s); nada a fazer")
+            return
+        total = count_offline(db_path, current)
+        print(f"[rebalance] {total} msgs offline: {current} -> {count} shard(s)")
+        targets = open_targets(db_path, primary, count, synchronous)
+        progress = Progress(total)
+        for path in layout_paths(db_path, current):
+            if not os.path.exists(path):
+                continue
+            source = primary if path == db_path else connect(path, synchronous)
+            try:
+                copy_rows(source, targets, batch_size, progress)
+            finally:
+                if source is not primary:
+                    source.close()
+        progress.add(0, force=True)
+
+        # a troca: daqui pra frente o servidor lê o layout novo
+        write_layout(primary, count)
+        primary.commit()
+        for conn in targets:
+            if conn is not primary:
+                conn.close()
+
+        # só agora some o antigo
+        if current == 0:
+            primary.execute("DELETE FROM offline_messages")
+            primary.commit()
+        else:
+            for path in layout_paths(db_path, current):
+                remove_files(path)
+        print(f"[rebalance] pronto em {time.perf_counter() - progress.started:.1f}s")
+    finally:
+        primary.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Redistribui as msgs offline num novo número de shards")
+    parser.add_argument("--db", default="chat.db", help="arquivo do banco principal")
+    parser.add_argument("--shards", type=int, required=True, help="quantos shards no layout novo (0 = sem shards)")
+    parser.add_argument("--batch", type=int, default=50000, help="linhas lidas por lote")
+    parser.add_argument("--synchronous", choices=["OFF", "NORMAL", "FULL"], default="NORMAL", help="PRAGMA synchronous do sqlite")
+    args = parser.parse_args()
+    if args.shards < 0:
+        parser.error("--shards não pode ser negativo")
+    rebalance(args.db, args.shards, args.batch, args.synchronous)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,36 +1,207 @@
 import socket
 import threading
 import json
+import heapq
+import os
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # módulos que a gente criou
-from database import Database
-from user import UserManager
+import protocol
+from database import Database, dm_conversation, group_conversation
+from user import UserManager, ServerBusy
 from group import GroupManager
+from session import SocketSession, OutboundQueue, FileStream, SPILL, FLUSH_BYTES
+from files import FileStore, FileError, file_ref, valid_file_id
+from fanout import FanoutEngine
+from presence import PresenceRegistry
+from metrics import DISABLED
+from timers import TimerWheel
+from ratelimit import RateLimiter
+
+# comandos conhecidos (nas métricas, o resto vira 'other' pra ninguém inventar rótulos)
+AUTH_COMMANDS = frozenset(['register', 'login', 'resume'])
+COMMANDS = frozenset(['list_all', 'list_users', 'list_groups', 'send_message', 'select_chat', 'create_group',
+                      'add_member_to_group', 'queue_stats', 'ack_offline', 'ack_group', 'subscribe', 'unsubscribe',
+                      'leave_chat', 'stats', 'history', 'search', 'upload_file', 'download_file', 'sync'])
+# confirmações do protocolo: não gastam ficha do balde de comandos (um ack recusado
+# deixaria o resto do lote offline parado até o próximo login, o cliente não manda de novo)
+UNMETERED_COMMANDS = frozenset(['ack_offline', 'ack_group', 'pong'])
+# comandos que só leem: podem rodar em paralelo com os outros da mesma conexão
+# (o resto roda na ordem em que chegou: select_chat antes do send_message, etc.)
+CONCURRENT_COMMANDS = frozenset(['list_all', 'list_users', 'list_groups', 'history', 'search', 'queue_stats', 'stats', 'sync'])
+
+
+class RequestContext(threading.local):
+    # o comando que a thread tá tratando agora: as respostas pra essa sessão
+    # levam o mesmo req_id que veio no comando
+    session = None
+    req_id = None
+
+
+def request_id(data):
+    # req_id é opcional; só aceita número ou texto curto
+    req_id = data.get('req_id')
+    if isinstance(req_id, bool) or not isinstance(req_id, (int, str)):
+        return None
+    if isinstance(req_id, str) and len(req_id) > 64:
+        return None
+    return req_id
+
+def valid_cursor(cursor):
+    # cursor de sync mandado pelo cliente (rowid ou seq): inteiro >= 0
+    return isinstance(cursor, int) and not isinstance(cursor, bool) and cursor >= 0
+
+def valid_transfer(transfer):
+    # número da transferência (quem escolhe é o cliente): cabe nos 4 bytes do quadro
+    return isinstance(transfer, int) and not isinstance(transfer, bool) and 0 <= transfer < 1 << 32
+
+def login_key(session, username):
+    # balde dos logins errados: IP + nome tentado (nome que não é texto vira '')
+    return session.addr[0], username if isinstance(username, str) else ''
+
+def stored_file(data):
+    # referência de anexo como vai pro banco
+    return json.dumps(data['file']) if data.get('file') else None
+
+def offline_item(sender, text, file):
+    # uma msg guardada como vai pro cliente (com o anexo, se tiver)
+    item = {"sender": sender, "message": text}
+    if file:
+        item["file"] = json.loads(file)
+    return item
+
+def message_item(seq, sender, text, created_at, file):
+    # uma linha do histórico
+    item = {"seq": seq, "sender": sender, "message": text, "time": created_at}
+    if file:
+        item["file"] = json.loads(file)
+    return item
+
+def keepalive(sock, idle):
+    # keepalive do TCP: depois de 'idle' segundos quieta, a conexão é testada pelo kernel
+    try:
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        if hasattr(socket, 'TCP_KEEPIDLE'):
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPIDLE, max(1, int(idle)))
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPINTVL, 10)
+            sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_KEEPCNT, 3)
+    except OSError:
+        pass
+
+def no_delay(sock):
+    # desliga o Nagle: quem decide quando juntar quadros é o writer da sessão (flush_delay)
+    try:
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+    except OSError:
+        pass
 
 class ChatServer:
     # prepara o servidor com o IP e a porta local
-    def __init__(self, host='0.0.0.0', port=12345):
+    def __init__(self, host='0.0.0.0', port=12345, backlog=5,
+                 queue_high_watermark=1024 * 1024, queue_low_watermark=256 * 1024, overflow_policy='drop_oldest',
+                 fanout_workers=4, fanout_threshold=1000, db=None, offline_batch_size=200, user_manager=None,
+                 cluster=None, reuse_port=False, metrics=DISABLED, admins=(), max_inflight=8, query_workers=8,
+                 heartbeat_interval=30, idle_timeout=90, auth_timeout=30,
+                 command_limit=(20, 40), dm_limit=(5, 10), fanout_limit=(1000, 5000), group_limit=(2000, 10000),
+                 login_limit=(0.1, 5), resume_limit=(1, 20), flush_delay=0.0, flush_bytes=FLUSH_BYTES, files=None, max_uploads=4):
         self.host = host
         self.port = port
+        self.backlog = backlog # tamanho da fila de conexões pendentes do listen()
+        # limites da fila de saída de cada cliente (ver session.OutboundQueue)
+        self.queue_high_watermark = queue_high_watermark
+        self.queue_low_watermark = queue_low_watermark
+        self.overflow_policy = overflow_policy
+        # o writer de cada sessão junta o que tiver na fila numa escrita só; com flush_delay
+        # (segundos) espera mais um pouco pra juntar, até flush_bytes (ver session.send_frames)
+        self.flush_delay = flush_delay
+        self.flush_bytes = flush_bytes
+        # msgs offline vão em lotes desse tamanho, um lote por vez
+        self.offline_batch_size = offline_batch_size
+        # páginas do diretório (list_users/list_groups)
+        self.directory_page_size = 50
+        self.directory_max_page = 200
+        # sync do cache do cliente: nomes (users, membros) por resposta e conversas com novidade por resposta
+        self.sync_page_size = 1000
+        self.sync_conversations = 50
         self.server_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        
-        # dicionários pra controlar quem tá online e conversando
-        self.clients = {}         # socket
-        self.users_online = {}    # nome do user
-        self.chat_context = {}    # nome do user
-        
-        # inicializa o banco de dados (o arquivo chat.db)
-        self.db = Database() 
+
+        # quem tá online (nome do user -> sessão) e quem assina a presença de quem
+        # (a conversa aberta de cada um fica na própria sessão: session.chat_context)
+        self.presence = PresenceRegistry()
+        # modo cluster (ver cluster.py): quem tá online pode estar em outro processo,
+        # então "tá online?" pergunta pro cluster; sessões continuam só as locais
+        self.cluster = cluster
+        self.online = cluster if cluster is not None else self.presence
+        # SO_REUSEPORT: vários processos escutando na mesma porta
+        self.reuse_port = reuse_port
+
+        # inicializa o banco de dados (o arquivo chat.db, se não vier um pronto)
+        self.db = db or Database()
+        # anexos: guardados uma vez por conteúdo, do lado do banco (ver files.py);
+        # cada conexão manda até max_uploads arquivos ao mesmo tempo
+        self.files = files or FileStore(f"{self.db.db_path}.files")
+        self.max_uploads = max_uploads
+
+        # heartbeat: quem fica heartbeat_interval segundos sem mandar nada recebe um ping;
+        # quem passa de idle_timeout sem mandar nada (nem o pong) é derrubado, e quem não
+        # loga em auth_timeout também (0 desliga cada um). todos os prazos ficam numa
+        # roda de timers só (timers.py), não um timer por conexão
+        self.heartbeat_interval = heartbeat_interval
+        self.idle_timeout = idle_timeout
+        self.auth_timeout = auth_timeout
+        self.timers = TimerWheel()
+
+        # limites de taxa, cada um um (taxa por segundo, rajada); ver ratelimit.py
+        # - comandos e DMs: por user
+        # - msg de grupo: custa uma ficha por destinatário, no balde do user e no do grupo
+        # - login que falhou: por IP e user (o PBKDF2 é caro e senha não se chuta à vontade;
+        #   só o IP não serve, atrás do ngrok todo mundo vem do mesmo endereço)
+        # - resume que falhou: por IP, em separado (token expirado é normal e não se chuta)
+        self.command_limiter = RateLimiter(*command_limit)
+        self.dm_limiter = RateLimiter(*dm_limit)
+        self.fanout_limiter = RateLimiter(*fanout_limit)
+        self.group_limiter = RateLimiter(*group_limit)
+        self.login_limiter = RateLimiter(*login_limit)
+        self.resume_limiter = RateLimiter(*resume_limit)
+
+        # comandos de leitura de uma mesma conexão rodam em paralelo, até max_inflight de cada vez
+        self.max_inflight = max_inflight
+        self.query_pool = ThreadPoolExecutor(max_workers=query_workers, thread_name_prefix="query")
+        self.request = RequestContext()
+
+        # métricas (ver metrics.py) e quem pode pedir o comando 'stats'
+        self.metrics = metrics
+        self.admins = frozenset(admins)
+        self.count_bytes_in = (lambda n: metrics.inc('chat_bytes_in_total', n)) if metrics.enabled else None
+        self.count_bytes_out = self.count_flush if metrics.enabled else None
+        metrics.gauge('chat_threads', 'threads do processo', threading.active_count)
+        metrics.gauge('chat_users_online', 'users logados neste processo', lambda: len(self.presence))
 
         # passa o banco pros "ajudantes" de user e grupo
-        self.user_manager = UserManager(self.db)
+        self.user_manager = user_manager or UserManager(self.db)
         self.group_manager = GroupManager(self.db)
+        # entrega das msgs de grupo (grupo grande é dividido entre threads)
+        self.fanout = FanoutEngine(workers=fanout_workers, parallel_threshold=fanout_threshold, metrics=metrics)
+        metrics.gauge('chat_pbkdf2_pending', 'hashes esperando no pool do PBKDF2', lambda: self.user_manager.pending)
         print("[Servidor] Banco de dados (SQLite) e gerenciadores prontos.")
+        identity = self.db.identity.stats()
+        print(f"[Servidor] Índice em memória: {identity['users']} users, {identity['groups']} grupos, "
+              f"{identity['memberships']} membros (do {identity['source']}, {identity['load_seconds']}s).")
 
-    def start(self):
+    def listen(self):
         # amarra o server no IP/porta e fica de ouvido
+        if self.reuse_port:
+            self.server_socket.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.server_socket.bind((self.host, self.port))
-        self.server_socket.listen(5)
+        self.server_socket.listen(self.backlog)
+        self.timers.start()
+        if self.cluster is not None:
+            self.cluster.start(self)
+
+    def start(self):
+        self.listen()
         print(f"[Servidor] Escutando em {self.host}:{self.port}")
 
         # loop infinito pra aceitar conexões
@@ -38,230 +209,908 @@ class ChatServer:
             # trava aqui até alguém conectar
             client_socket, addr = self.server_socket.accept()
             print(f"[Nova Conexão] Conexão de {addr} estabelecida.")
-            
+
             # cria uma thread nova só pra cuidar desse cliente
             # e volta pro loop pra aceitar mais gente
             thread = threading.Thread(target=self.handle_client, args=(client_socket, addr))
             thread.daemon = True # morre se o server principal fechar
             thread.start()
 
-    def send_json(self, sock, data):
-        # função rápida pra transformar dict em JSON e mandar
-        try:
-            sock.send(json.dumps(data).encode('utf-8'))
-        except (ConnectionResetError, BrokenPipeError):
-            # se o cliente já caiu, só ignora
-            pass 
+    def count_flush(self, size):
+        # cada chamada é uma escrita do writer (um lote de quadros)
+        self.metrics.inc('chat_bytes_out_total', size)
+        self.metrics.inc('chat_socket_writes_total')
+
+    def new_queue(self):
+        # fila de saída de uma sessão nova, com os limites do servidor
+        return OutboundQueue(self.queue_high_watermark, self.queue_low_watermark, self.overflow_policy)
+
+    def send_json(self, session, data, req_id=None):
+        # função rápida pra transformar dict em quadro e mandar
+        # (só enfileira; quem escreve no socket é o writer da sessão)
+        # resposta pra quem mandou o comando leva o req_id dele
+        if req_id is None and self.request.session is session:
+            req_id = self.request.req_id
+        if req_id is not None:
+            data = dict(data, req_id=req_id)
+        spill = self.spill_for(data)
+        session.send(session.codec.encode(data), spill and (lambda: spill(session)))
+
+    def send_batch(self, session, items):
+        # manda várias mensagens num quadro só (entregas em massa)
+        session.send(session.codec.encode_batch(items))
+
+    def spill_for(self, data):
+        # política 'spill': se a fila de quem recebe estourar, a DM vai pro banco em vez de
+        # sumir. devolve a função que guarda ela pra uma sessão (None: não dá pra guardar)
+        # vale pra todo caminho de entrega: send_json, fan-out e o que vem de outro nó
+        if self.overflow_policy == SPILL and data.get('type') == 'chat_message':
+            return lambda session: self.spill_message(session, data)
+        return None
+
+    def spill_message(self, session, data):
+        # guarda no offline_messages uma DM que não coube na fila do destinatário
+        if not session.username:
+            return False
+        self.db.save_message(data['sender'], session.username, data['message'], stored_file(data))
+        return True
+
+    def open_session(self, session):
+        # conexão nova (os dois motores chamam); a faxina é no disconnect
+        session.on_sent = self.count_bytes_out
+        first_check = self.auth_timeout or self.heartbeat_interval
+        if first_check:
+            session.timer = self.timers.schedule(first_check, lambda: self.check_session(session))
+        self.metrics.inc('chat_connections_total')
+        self.metrics.inc('chat_connections_active')
+        return session
+
+    def queue_stats(self):
+        # profundidade e contadores da fila de saída de cada user online
+        return {username: session.queue.stats() for username, session in self.presence.items()}
 
     def handle_client(self, client_socket, addr):
         # essa função roda na thread de cada cliente
+        no_delay(client_socket)
+        session = self.open_session(SocketSession(client_socket, addr, self.new_queue(),
+                                                  self.flush_delay, self.flush_bytes))
         username = None # começa deslogado
         try:
+            # antes de tudo o cliente manda 'CR' + versão do protocolo (+ recursos, da v2 em diante)
+            decoder = protocol.FrameDecoder(on_receive=self.count_bytes_in)
+            greeting = protocol.accept_handshake(client_socket, decoder)
+            if greeting is None:
+                print(f"[{addr}] Cliente desconectou antes de autenticar.")
+                return
+            self.start_session(session, *greeting)
+
+            # a partir daqui tudo chega em quadros, uma mensagem de cada vez
+            messages = protocol.read_messages(client_socket, decoder)
+
             #loop login/registro
             # o cliente fica preso aqui até logar
-            while True:
-                # espera receber o JSON de auth (1kb tá de boa)
-                auth_data_raw = client_socket.recv(1024).decode('utf-8')
+            for auth_data in messages:
+                if self.heartbeat(session, auth_data):
+                    continue
+                username = self.handle_auth(session, auth_data)
+                if username:
+                    break # QUEBRA o loop de auth e vai pro menu
+            else:
                 # se não vier nada, o cara fechou a janela
-                if not auth_data_raw:
-                    print(f"[{addr}] Cliente desconectou antes de autenticar.")
-                    return # mata a thread
-                
-                auth_data = json.loads(auth_data_raw)
-                user = auth_data.get('username')
-                pwd = auth_data.get('password')
-                command = auth_data.get('command')
-
-                # se o comando for 'register'
-                if command == 'register':
-                    # tenta registrar o usuário no banco
-                    if user and pwd and self.user_manager.register(user, pwd):
-                        self.send_json(client_socket, {"status": "success", "message": "Cadastro realizado com sucesso! Faça o login."})
-                    else:
-                        # ou o user já existe, ou veio dado zoado
-                        self.send_json(client_socket, {"status": "error", "message": "Nome de usuário já existe ou dados inválidos."})
-                
-                # se o comando for 'login'
-                elif command == 'login':
-                    # bate a senha com o hash salvo no banco
-                    if user and pwd and self.user_manager.authenticate(user, pwd):
-                        
-                        # checa se ele já não tá logado em outro terminal
-                        if user in self.users_online:
-                            self.send_json(client_socket, {"status": "error", "message": "Este usuário já está logado."})
-                            continue # volta pro começo do loop
-                        
-                        # login com sucesso
-                        username = user # agora sim, ele tem nome
-                        self.clients[client_socket] = username # guarda no dict 1
-                        self.users_online[username] = client_socket # guarda no dict 2
-                        
-                        self.send_json(client_socket, {"status": "success", "message": f"Login realizado com sucesso! Bem-vindo, {username}."})
-                        print(f"[Autenticação] Usuário '{username}' logado de {addr}.")
-                        
-                        break  # QUEBRA o loop de auth e vai pro menu
-                    else:
-                        self.send_json(client_socket, {"status": "error", "message": "Nome de usuário ou senha inválidos."})
-                else:
-                    self.send_json(client_socket, {"status": "error", "message": "Comando de autenticação inválido."})
+                print(f"[{addr}] Cliente desconectou antes de autenticar.")
+                return # mata a thread
 
             #  fim do loop de autenticacao
             # (se chegou aqui, tá logado)
+            self.deliver_offline(session, username)
 
-            # 1. busca no banco se tem msg offline pra ele
-            offline_msgs = self.db.get_and_delete_messages_for(username)
-            if offline_msgs:
-                # avisa que tem coisa nova
-                self.send_json(client_socket, {"status": "info", "message": "Você tem novas mensagens!"})
-                # manda as mensagens uma por uma
-                for sender, msg_text in offline_msgs:
-                    self.send_json(client_socket, {"type": "chat_message", "sender": sender, "message": msg_text})
-            
             # loop menu
             # agora fica aqui ouvindo os comandos do menu
-            while True:
-                message_raw = client_socket.recv(4096).decode('utf-8')
-                # se não vier nada, o cliente fechou o app
-                if not message_raw:
-                    break # vai pro 'finally' limpar tudo
-
-                data = json.loads(message_raw)
-                command = data.get('command')
-
-                # comando: 'list_all' (ver users e grupos)
-                if command == 'list_all':
-                    users = self.db.get_all_users()
-                    # puxa só os grupos que o *esse* user tá
-                    groups = self.db.get_groups_for_user(username)
-                    
-                    # monta a string de users (vendo quem tá online)
-                    user_list_str = "\n".join(f"- {u} {'(online)' if u in self.users_online else '(offline)'}" for u in users)
-                    # monta a string de grupos
-                    group_list_str = "\n".join(f"- {g}" for g in groups) if groups else "Você não está em nenhum grupo."
-                    
-                    # manda o textão pro cliente
-                    full_message = f"--- USUÁRIOS ---\n{user_list_str}\n\n--- MEUS GRUPOS ---\n{group_list_str}"
-                    self.send_json(client_socket, {"status": "info", "message": full_message})
-
-                # comando: 'send_message' (mandar DM ou msg em grupo)
-                elif command == 'send_message':
-                    # vê com quem o user tá falando (o "contexto")
-                    context = self.chat_context.get(username)
-                    
-                    # se ele não selecionou ninguém, tá no menu
-                    if not context:
-                        self.send_json(client_socket, {"status": "error", "message": "Você não está em uma conversa. Use o menu para selecionar um chat."})
-                        continue
-                    
-                    target_type = context['type'] # 'user' ou 'group'
-                    target_name = context['target'] # nome do alvo
-                    message_text = data['message']
-                    
-                    # se o alvo for 'user' (DM)
-                    if target_type == 'user':
-                        # o cara tá online?
-                        if target_name in self.users_online:
-                            # tá. acha o socket dele
-                            target_socket = self.users_online[target_name]
-                            # e manda a msg direto
-                            self.send_json(target_socket, {"type": "chat_message", "sender": username, "message": message_text})
-                        else:
-                            # tá offline. salva no banco
-                            self.db.save_message(username, target_name, message_text)
-                            self.send_json(client_socket, {"status": "info", "message": f"'{target_name}' está offline. A mensagem será entregue quando ele(a) se conectar."})
-                    
-                    # se o alvo for 'group'
-                    elif target_type == 'group':
-                        members = self.group_manager.get_members(target_name)
-                        # manda pra todo mundo do grupo
-                        for member in members:
-                            # que esteja online E não seja o próprio remetente
-                            if member != username and member in self.users_online:
-                                target_socket = self.users_online[member]
-                                self.send_json(target_socket, {"type": "group_message", "group": target_name, "sender": username, "message": message_text})
-                
-                # comando: 'select_chat' (entrar numa DM ou grupo)
-                elif command == 'select_chat':
-                    target_user = data.get('target_user')
-                    target_group = data.get('target_group')
-
-                    # se for DM
-                    if target_user:
-                        if self.db.user_exists(target_user):
-                            # define o "contexto" dele pra DM
-                            self.chat_context[username] = {'type': 'user', 'target': target_user}
-                            self.send_json(client_socket, {"status": "success", "message": f"Conversa privada com '{target_user}' iniciada. Use /menu para sair."})
-                        else:
-                            self.send_json(client_socket, {"status": "error", "message": f"Usuário '{target_user}' não encontrado."})
-                    
-                    # se for grupo
-                    elif target_group:
-                        if self.db.group_exists(target_group):
-                            # checa se o user é membro do grupo
-                            if username in self.group_manager.get_members(target_group):
-                                # define o "contexto" dele pro grupo
-                                self.chat_context[username] = {'type': 'group', 'target': target_group}
-                                self.send_json(client_socket, {"status": "success", "message": f"Conversa no grupo '{target_group}' iniciada. Use /menu para sair."})
-                            else:
-                                # se não for membro, barra
-                                self.send_json(client_socket, {"status": "error", "message": f"Você não é membro do grupo '{target_group}'."})
-                        else:
-                            self.send_json(client_socket, {"status": "error", "message": f"Grupo '{target_group}' não encontrado."})
-                
-                # comando: 'create_group'
-                elif command == 'create_group':
-                    group_name = data.get('group_name')
-                    if group_name:
-                        # group_manager já bota o criador no grupo
-                        if self.group_manager.create_group(group_name, username):
-                             self.send_json(client_socket, {"status": "success", "message": f"Grupo '{group_name}' criado! Você foi adicionado."})
-                        else:
-                             self.send_json(client_socket, {"status": "error", "message": f"Grupo '{group_name}' já existe."})
-                    else:
-                        self.send_json(client_socket, {"status": "error", "message": "Nome do grupo não fornecido."})
-
-                # comando: 'add_member_to_group'
-                elif command == 'add_member_to_group':
-                    group_name = data.get('group_name')
-                    user_to_add = data.get('user_to_add')
-
-                    # checagens de segurança
-                    if not group_name or not user_to_add:
-                        self.send_json(client_socket, {"status": "error", "message": "Nome do grupo e do usuário são obrigatórios."})
-                    elif not self.db.group_exists(group_name):
-                        self.send_json(client_socket, {"status": "error", "message": f"O grupo '{group_name}' não existe."})
-                    elif not self.db.user_exists(user_to_add):
-                        self.send_json(client_socket, {"status": "error", "message": f"O usuário '{user_to_add}' não existe."})
-                    # só pode adicionar se for membro
-                    elif username not in self.group_manager.get_members(group_name):
-                        self.send_json(client_socket, {"status": "error", "message": "Você não é membro deste grupo e não pode adicionar novos usuários."})
-                    else:
-                        # se passou, adiciona
-                        self.group_manager.add_member(group_name, user_to_add)
-                        self.send_json(client_socket, {"status": "success", "message": f"Usuário '{user_to_add}' adicionado ao grupo '{group_name}'."})
-                
-                # comando: 'leave_chat' (o /menu do cliente)
-                elif command == 'leave_chat':
-                    # limpa o contexto do usuário
-                    if username in self.chat_context:
-                        del self.chat_context[username]
-
-        # se der pau em qualquer lugar (JSON mal feito, cliente caiu, etc.)
-        except (ConnectionResetError, json.JSONDecodeError, UnicodeDecodeError) as e:
+            # (o for acaba quando o cliente fecha o app e vai pro 'finally')
+            # comandos de leitura vão pro pool e não seguram os próximos
+            inflight = threading.BoundedSemaphore(self.max_inflight)
+            for data in messages:
+                if self.heartbeat(session, data):
+                    continue
+                if data.get('command') in CONCURRENT_COMMANDS:
+                    inflight.acquire()
+                    future = self.query_pool.submit(self.handle_concurrent, session, username, data)
+                    future.add_done_callback(lambda _: inflight.release())
+                else:
+                    self.handle_command(session, username, data)
+
+        # se der pau em qualquer lugar (quadro mal feito, cliente caiu, etc.)
+        except (ConnectionResetError, json.JSONDecodeError, UnicodeDecodeError, protocol.ProtocolError) as e:
             print(f"[Aviso] Conexão com '{username or addr}' foi perdida. Causa: {e}")
         except Exception as e:
             print(f"[ERRO] Ocorreu um erro com o cliente '{username or addr}': {e}")
-        
+
         # 'finally' roda sempre, dando erro ou não
         finally:
-            # faz a "faxina" do usuário que saiu
-            if username:
-                print(f"[Desconexão] Usuário '{username}' desconectado.")
-                # tira ele dos dicts de "online"
-                if username in self.users_online: del self.users_online[username]
-                if username in self.chat_context: del self.chat_context[username]
-            
-            if client_socket in self.clients: del self.clients[client_socket]
-            
-            client_socket.close()
-            # a thread morre aqui
+            self.disconnect(session, username)
+            # a thread morre aqui (e a conexão dela com o banco junto)
+            self.db.release_connection()
+
+    def start_session(self, session, version, features):
+        # responde o cumprimento e passa a usar o formato combinado
+        session.send(protocol.hello(version, features))
+        session.codec = protocol.codec_for(features)
+        session.heartbeat = bool(features & protocol.FEATURE_HEARTBEAT)
+        if not session.heartbeat and self.idle_timeout:
+            # cliente que não responde ping (ex: v1): pelo menos o TCP descobre quem sumiu
+            keepalive(session.sock, self.idle_timeout)
+
+    def heartbeat(self, session, data):
+        # todo quadro que chega conta como sinal de vida; devolve True se era só heartbeat
+        session.last_seen = time.monotonic()
+        command = data.get('command')
+        if command == 'pong':
+            return True
+        if command == 'ping':
+            # o cliente também pode testar a conexão
+            self.send_json(session, {"type": "pong"}, request_id(data))
+            return True
+        return False
+
+    def check_session(self, session):
+        # prazo de uma sessão venceu (roda na thread da roda de timers): derruba,
+        # manda ping ou agenda a próxima checagem
+        if session.closed:
+            return
+        now = time.monotonic()
+        if session.username is None:
+            if self.auth_timeout and now - session.opened_at >= self.auth_timeout:
+                self.reap(session, f"não autenticou em {self.auth_timeout}s")
+                return
+            wait = self.auth_timeout - (now - session.opened_at) if self.auth_timeout else self.heartbeat_interval
+        elif not (session.heartbeat and self.heartbeat_interval):
+            return  # sem heartbeat não dá pra saber se tá só quieto; fica com o keepalive do TCP
+        else:
+            idle = now - session.last_seen
+            if self.idle_timeout and idle >= self.idle_timeout:
+                self.reap(session, f"{idle:.0f}s sem sinal de vida")
+                return
+            if idle >= self.heartbeat_interval:
+                self.send_json(session, {"type": "ping"})
+                wait = self.heartbeat_interval
+            else:
+                wait = self.heartbeat_interval - idle
+            if self.idle_timeout:
+                wait = min(wait, self.idle_timeout - idle)
+        session.timer = self.timers.schedule(wait, lambda: self.check_session(session))
+
+    def reap(self, session, reason):
+        # fecha o socket: o loop de leitura da conexão acorda, sai e cai no
+        # 'finally' de sempre (disconnect), igual a um cliente que fechou
+        print(f"[Aviso] Derrubando '{session.username or session.addr}': {reason}.")
+        self.metrics.inc('chat_sessions_reaped_total', 1, 'auth' if session.username is None else 'idle')
+        session.close()
+
+    # as funções abaixo não sabem se estão numa thread por cliente ou no
+    # event loop (async_server.py), só conversam com a sessão
+
+    def handle_auth(self, session, auth_data):
+        # trata um comando do loop de login/registro
+        # devolve o nome do user se logou, senão None
+        self.request.session, self.request.req_id = session, request_id(auth_data)
+        start = time.perf_counter() if self.metrics.enabled else None
+        try:
+            return self.run_auth(session, auth_data)
+        finally:
+            self.request.session = self.request.req_id = None
+            if start is not None:
+                self.count_command(auth_data.get('command'), AUTH_COMMANDS, start)
+
+    def count_command(self, command, known, start):
+        label = command if command in known else 'other'
+        self.metrics.inc('chat_commands_total', 1, label)
+        self.metrics.observe('chat_command_seconds', time.perf_counter() - start, label)
+
+    def run_auth(self, session, auth_data):
+        user = auth_data.get('username')
+        pwd = auth_data.get('password')
+        command = auth_data.get('command')
+
+        try:
+            # se o comando for 'register'
+            if command == 'register':
+                # tenta registrar o usuário no banco
+                if user and pwd and self.user_manager.register(user, pwd):
+                    self.user_registered(user)
+                    self.send_json(session, {"status": "success", "message": "Cadastro realizado com sucesso! Faça o login."})
+                else:
+                    # ou o user já existe, ou veio dado zoado
+                    self.send_json(session, {"status": "error", "message": "Nome de usuário já existe ou dados inválidos."})
+
+            # login de um IP+user que errou demais: recusa antes de gastar PBKDF2
+            elif command == 'login' and (wait := self.login_limiter.check(login_key(session, user))):
+                self.throttled(session, 'login', wait, "Tentativas de login demais.")
+            elif command == 'resume' and (wait := self.resume_limiter.check(session.addr[0])):
+                self.throttled(session, 'resume', wait, "Tentativas de resume demais.")
+
+            # se o comando for 'login'
+            elif command == 'login':
+                # bate a senha com o hash salvo no banco
+                if user and pwd and self.user_manager.authenticate(user, pwd):
+                    return self.complete_login(session, user)
+                else:
+                    self.login_limiter.take(login_key(session, user))
+                    self.send_json(session, {"status": "error", "message": "Nome de usuário ou senha inválidos."})
+
+            # se o comando for 'resume' (volta com o token do último login, sem PBKDF2)
+            elif command == 'resume':
+                token_user = self.user_manager.verify_token(auth_data.get('token') or '')
+                if token_user:
+                    return self.complete_login(session, token_user)
+                self.resume_limiter.take(session.addr[0])
+                self.send_json(session, {"status": "error", "message": "Sessão expirada ou inválida. Faça o login de novo."})
+            else:
+                self.send_json(session, {"status": "error", "message": "Comando de autenticação inválido."})
+        except ServerBusy:
+            # pool de hash lotado: melhor recusar rápido do que travar todo mundo
+            self.send_json(session, {"status": "error", "message": "Servidor ocupado, tente de novo em instantes.", "retry_after": 1})
+        return None
+
+    def complete_login(self, session, user):
+        # até onde vai o atrasado de cada grupo: pedido antes de ele ficar online, na fila do
+        # writer. msg de grupo que chegar ao vivo depois disso grava com seq maior que essa
+        # última e não vem de novo no group_batch
+        backlog = self.db.group_backlog(user)
+        # marca online, a não ser que ele já esteja logado em outro terminal
+        if not self.presence.add(user, session):
+            self.send_json(session, {"status": "error", "message": "Este usuário já está logado."})
+            return None # volta pro começo do loop
+        # e também não pode estar logado em outro nó do cluster
+        if self.cluster is not None and not self.cluster.claim(user):
+            self.presence.remove(user, session)
+            self.send_json(session, {"status": "error", "message": "Este usuário já está logado."})
+            return None
+
+        # login com sucesso
+        session.username = user # agora sim, ele tem nome
+        session.group_backlog = deque([group_name, last_seq, head] for group_name, last_seq, head in backlog.result())
+
+        # o token deixa o cliente reconectar sem mandar a senha de novo
+        self.send_json(session, {"status": "success", "message": f"Login realizado com sucesso! Bem-vindo, {user}.",
+                                 "username": user, "token": self.user_manager.issue_token(user), "token_ttl": self.user_manager.token_ttl})
+        print(f"[Autenticação] Usuário '{user}' logado de {session.addr}.")
+        # avisa quem assina a presença dele
+        self.notify_presence(session, user, True)
+        return user
+
+    def notify_presence(self, session, username, online):
+        # manda o "entrou/saiu" só pra quem pediu (subscribe), não pra todo mundo
+        watchers = self.presence.watchers(username, self.db.get_groups_for_user(username))
+        watchers.discard(session)
+        if watchers:
+            self.fanout.deliver_message(watchers, {"type": "presence", "user": username, "online": online})
+
+    def deliver_offline(self, session, username):
+        # 1. busca no banco se tem msg offline pra ele (só o primeiro lote)
+        # e, se tiver, avisa antes que tem coisa nova
+        session.offline_cursor = 0
+        self.send_offline_batch(session, username, notice={"status": "info", "message": "Você tem novas mensagens!"})
+        # 2. msgs dos grupos que chegaram enquanto ele tava fora (depois do cursor de cada
+        # grupo até a última msg no login, ver complete_login)
+        self.send_group_batch(session)
+
+    def send_group_batch(self, session):
+        # manda o próximo lote atrasado de um grupo (do cursor até a msg que era a
+        # última no login; as novas chegam ao vivo). o cliente responde 'ack_group'
+        # e aí o cursor avança no banco e vem o próximo lote, de um grupo por vez
+        while session.group_backlog:
+            group_name, last_seq, head = session.group_backlog[0]
+            rows = self.db.history_after(group_conversation(group_name), last_seq, self.offline_batch_size, until_seq=head)
+            if not rows:
+                session.group_backlog.popleft()
+                continue
+            self.send_json(session, {
+                "type": "group_batch", "group": group_name,
+                "messages": [message_item(*row) for row in rows],
+                "cursor": rows[-1][0],
+                "more": rows[-1][0] < head,
+            })
+            return True
+        return False
+
+    def send_offline_batch(self, session, username, notice=None):
+        # manda o próximo lote depois do cursor; o cliente responde com
+        # 'ack_offline' e só aí o lote é apagado e o próximo é mandado.
+        # assim a memória fica do tamanho de um lote, não importa o tamanho do atraso
+        rows = self.db.get_offline_batch(username, session.offline_cursor, self.offline_batch_size)
+        if not rows:
+            return False
+        session.offline_cursor = rows[-1][0]
+        if notice:
+            self.send_json(session, notice)
+        self.send_json(session, {
+            "type": "offline_batch",
+            "messages": [offline_item(*row[1:]) for row in rows],
+            "cursor": session.offline_cursor,
+            "more": len(rows) == self.offline_batch_size,
+        })
+        return True
+
+    def page_limit(self, limit):
+        # tamanho de página pedido pelo cliente, dentro do limite do servidor
+        if not isinstance(limit, int) or limit <= 0:
+            return self.directory_page_size
+        return min(limit, self.directory_max_page)
+
+    def directory_page(self, username, prefix='', after='', limit=50, online_only=False):
+        # uma página do diretório: [{"username": ..., "online": ...}]
+        if online_only:
+            # quem tá online já tá na memória; pega os 'limit' menores depois do
+            # cursor sem ordenar a lista inteira
+            online = (u for u in self.online if u > after and u.startswith(prefix))
+            return [{"username": u, "online": True} for u in heapq.nsmallest(limit, online)]
+        return [{"username": u, "online": u in self.online} for u in self.db.list_users(prefix, after, limit)]
+
+    def handle_command(self, session, username, data):
+        # trata um comando do menu de quem já tá logado
+        if 'file_chunk' in data:
+            # pedaço de arquivo não é comando: não gasta ficha (quem limita é o próprio TCP)
+            return self.receive_chunk(session, username, data)
+        self.request.session, self.request.req_id = session, request_id(data)
+        start = time.perf_counter() if self.metrics.enabled else None
+        try:
+            # o balde de comandos é olhado antes de qualquer trabalho (menos pros acks)
+            wait = 0 if data.get('command') in UNMETERED_COMMANDS else self.command_limiter.take(username)
+            if wait:
+                self.throttled(session, 'commands', wait, "Comandos demais de uma vez.")
+                return
+            return self.run_command(session, username, data)
+        finally:
+            self.request.session = self.request.req_id = None
+            if start is not None:
+                self.count_command(data.get('command'), COMMANDS, start)
+
+    def throttled(self, session, budget, wait, message):
+        # recusa por limite de taxa: erro com o balde que estourou e quanto esperar
+        self.metrics.inc('chat_rate_limited_total', 1, budget)
+        self.send_json(session, {"status": "error", "message": f"{message} Tente de novo em {wait:g}s.",
+                                 "throttled": budget, "retry_after": wait})
+
+    def handle_concurrent(self, session, username, data):
+        # comando rodando fora da thread/ordem da conexão: erro aqui não derruba ninguém
+        try:
+            self.handle_command(session, username, data)
+        except Exception as e:
+            print(f"[ERRO] Comando '{data.get('command')}' de '{username}' falhou: {e}")
+            self.send_json(session, {"status": "error", "message": "Erro ao processar o comando."}, request_id(data))
+
+    def run_command(self, session, username, data):
+        command = data.get('command')
+
+        # comando: 'list_all' (ver users e grupos)
+        # antigo: agora só mostra a primeira página de cada; o resto é pelo list_users/list_groups
+        if command == 'list_all':
+            users = self.directory_page(username, limit=self.directory_page_size)
+            # puxa só os grupos que o *esse* user tá
+            groups = self.db.list_groups_for_user(username, limit=self.directory_page_size)
+
+            # monta a string de users (vendo quem tá online)
+            user_list_str = "\n".join(f"- {u['username']} {'(online)' if u['online'] else '(offline)'}" for u in users)
+            # monta a string de grupos
+            group_list_str = "\n".join(f"- {g}" for g in groups) if groups else "Você não está em nenhum grupo."
+
+            # manda o textão pro cliente
+            full_message = f"--- USUÁRIOS ---\n{user_list_str}\n\n--- MEUS GRUPOS ---\n{group_list_str}"
+            if len(users) == self.directory_page_size or len(groups) == self.directory_page_size:
+                full_message += "\n\n(tem mais: use list_users/list_groups pra paginar)"
+            self.send_json(session, {"status": "info", "message": full_message})
+
+        # comando: 'list_users' (diretório paginado, com filtro por prefixo e só-online)
+        elif command == 'list_users':
+            limit = self.page_limit(data.get('limit'))
+            users = self.directory_page(username, data.get('prefix') or '', data.get('cursor') or '', limit, bool(data.get('online_only')))
+            self.send_json(session, {
+                "type": "directory",
+                "users": users,
+                "next_cursor": users[-1]['username'] if len(users) == limit else None,
+            })
+
+        # comando: 'list_groups' (grupos do user, paginado)
+        elif command == 'list_groups':
+            limit = self.page_limit(data.get('limit'))
+            groups = self.db.list_groups_for_user(username, data.get('cursor') or '', limit)
+            self.send_json(session, {
+                "type": "group_list",
+                "groups": groups,
+                "next_cursor": groups[-1] if len(groups) == limit else None,
+            })
+
+        # comando: 'send_message' (mandar DM ou msg em grupo)
+        elif command == 'send_message':
+            # vê com quem o user tá falando (o "contexto")
+            context = session.chat_context
+
+            # se ele não selecionou ninguém, tá no menu
+            if not context:
+                self.send_json(session, {"status": "error", "message": "Você não está em uma conversa. Use o menu para selecionar um chat."})
+                return
+
+            self.deliver_chat(session, username, context['type'], context['target'], data['message'])
+
+        # comando: 'history' (rolar a conversa pra trás ou pra frente, uma página por vez)
+        elif command == 'history':
+            conversation, target = self.resolve_conversation(session, username, data)
+            if conversation is None:
+                return
+            limit = self.page_limit(data.get('limit'))
+            after = data.get('after')
+            if isinstance(after, int):
+                rows = self.db.history_after(conversation, after, limit)
+                next_cursor = rows[-1][0] if len(rows) == limit else None
+            else:
+                before = data.get('before')
+                rows = self.db.history_before(conversation, before if isinstance(before, int) else None, limit)
+                next_cursor = rows[-1][0] if len(rows) == limit else None
+                rows.reverse()  # a página vai sempre da mais velha pra mais nova
+            self.send_json(session, {
+                "type": "history", "conversation": target,
+                "messages": [message_item(*row) for row in rows],
+                "next_cursor": next_cursor,
+            })
+
+        # comando: 'search' (busca por palavras no histórico de uma conversa)
+        elif command == 'search':
+            text = data.get('query')
+            if not isinstance(text, str) or not text.split():
+                self.send_json(session, {"status": "error", "message": "Diga o que buscar."})
+                return
+            if not self.db.fts:
+                self.send_json(session, {"status": "error", "message": "Busca indisponível (o SQLite do servidor não tem FTS5)."})
+                return
+            conversation, target = self.resolve_conversation(session, username, data)
+            if conversation is None:
+                return
+            limit = self.page_limit(data.get('limit'))
+            cursor = data.get('cursor')
+            rows = self.db.search_history(conversation, text, cursor if isinstance(cursor, int) else None, limit)
+            self.send_json(session, {
+                "type": "search_results", "conversation": target, "query": text,
+                "messages": [message_item(*row[1:]) for row in rows],
+                "next_cursor": rows[-1][0] if len(rows) == limit else None,
+            })
+
+        # comando: 'sync' (o que mudou desde os cursores do cache local do cliente)
+        elif command == 'sync':
+            self.sync(session, username, data)
+
+        # comando: 'select_chat' (entrar numa DM ou grupo)
+        elif command == 'select_chat':
+            target_user = data.get('target_user')
+            target_group = data.get('target_group')
+
+            # se for DM
+            if target_user:
+                if self.db.user_exists(target_user):
+                    # define o "contexto" dele pra DM
+                    session.chat_context = {'type': 'user', 'target': target_user}
+                    self.send_json(session, {"status": "success", "message": f"Conversa privada com '{target_user}' iniciada. Use /menu para sair."})
+                else:
+                    self.send_json(session, {"status": "error", "message": f"Usuário '{target_user}' não encontrado."})
+
+            # se for grupo
+            elif target_group:
+                if self.db.group_exists(target_group):
+                    # checa se o user é membro do grupo
+                    if username in self.group_manager.get_members(target_group):
+                        # define o "contexto" dele pro grupo
+                        session.chat_context = {'type': 'group', 'target': target_group}
+                        self.send_json(session, {"status": "success", "message": f"Conversa no grupo '{target_group}' iniciada. Use /menu para sair."})
+                    else:
+                        # se não for membro, barra
+                        self.send_json(session, {"status": "error", "message": f"Você não é membro do grupo '{target_group}'."})
+                else:
+                    self.send_json(session, {"status": "error", "message": f"Grupo '{target_group}' não encontrado."})
+
+        # comando: 'create_group'
+        elif command == 'create_group':
+            group_name = data.get('group_name')
+            if group_name:
+                # group_manager já bota o criador no grupo
+                if self.group_manager.create_group(group_name, username):
+                     self.group_changed(group_name)
+                     self.send_json(session, {"status": "success", "message": f"Grupo '{group_name}' criado! Você foi adicionado."})
+                else:
+                     self.send_json(session, {"status": "error", "message": f"Grupo '{group_name}' já existe."})
+            else:
+                self.send_json(session, {"status": "error", "message": "Nome do grupo não fornecido."})
+
+        # comando: 'add_member_to_group'
+        elif command == 'add_member_to_group':
+            group_name = data.get('group_name')
+            user_to_add = data.get('user_to_add')
+
+            # checagens de segurança
+            if not group_name or not user_to_add:
+                self.send_json(session, {"status": "error", "message": "Nome do grupo e do usuário são obrigatórios."})
+            elif not self.db.group_exists(group_name):
+                self.send_json(session, {"status": "error", "message": f"O grupo '{group_name}' não existe."})
+            elif not self.db.user_exists(user_to_add):
+                self.send_json(session, {"status": "error", "message": f"O usuário '{user_to_add}' não existe."})
+            # só pode adicionar se for membro
+            elif username not in self.group_manager.get_members(group_name):
+                self.send_json(session, {"status": "error", "message": "Você não é membro deste grupo e não pode adicionar novos usuários."})
+            else:
+                # se passou, adiciona
+                self.group_manager.add_member(group_name, user_to_add)
+                self.group_changed(group_name)
+                self.send_json(session, {"status": "success", "message": f"Usuário '{user_to_add}' adicionado ao grupo '{group_name}'."})
+
+        # comando: 'queue_stats' (como tá a fila de saída do próprio user)
+        elif command == 'queue_stats':
+            stats = session.queue.stats()
+            summary = ", ".join(f"{k}={v}" for k, v in stats.items())
+            self.send_json(session, {"status": "info", "message": f"Fila de saída: {summary}", "stats": stats})
+
+        # comando: 'ack_offline' (cliente confirmou um lote de msgs offline)
+        elif command == 'ack_offline':
+            cursor = data.get('cursor')
+            # só aceita confirmar o que foi mandado mesmo
+            if isinstance(cursor, int) and 0 < cursor <= session.offline_cursor:
+                self.db.delete_offline_up_to(username, cursor)
+                self.send_offline_batch(session, username)
+
+        # comando: 'ack_group' (cliente confirmou um lote atrasado de um grupo)
+        elif command == 'ack_group':
+            cursor = data.get('cursor')
+            backlog = session.group_backlog
+            # só vale pro lote que tá pendente agora
+            if backlog and data.get('group') == backlog[0][0] and isinstance(cursor, int) and backlog[0][1] < cursor <= backlog[0][2]:
+                group_name = backlog[0][0]
+                backlog[0][1] = cursor
+                if cursor >= backlog[0][2]:
+                    backlog.popleft()
+                self.db.set_group_cursor(username, group_name, cursor)
+                self.send_group_batch(session)
+
+        # comando: 'subscribe' / 'unsubscribe' (acompanhar quem entra e sai)
+        elif command == 'subscribe':
+            users = [u for u in data.get('users') or [] if isinstance(u, str)]
+            # só dá pra acompanhar grupo de que se é membro
+            groups = [g for g in data.get('groups') or [] if isinstance(g, str) and username in self.group_manager.get_members(g)]
+            self.presence.subscribe(session, users, groups)
+            # responde com a foto atual; depois disso só chegam as mudanças
+            watched = set(users)
+            for group_name in groups:
+                watched.update(self.group_manager.get_members(group_name))
+            watched.discard(username)
+            self.send_json(session, {"type": "presence_snapshot", "online": sorted(u for u in watched if u in self.online),
+                                     "offline": sorted(u for u in watched if u not in self.online)})
+
+        elif command == 'unsubscribe':
+            self.presence.unsubscribe(session, data.get('users') or [], data.get('groups') or [])
+
+        # comando: 'stats' (métricas do servidor, só pra admin)
+        elif command == 'stats':
+            if username not in self.admins:
+                self.send_json(session, {"status": "error", "message": "Comando restrito a administradores."})
+            elif not self.metrics.enabled:
+                self.send_json(session, {"status": "error", "message": "Métricas desligadas (suba o servidor com --metrics)."})
+            else:
+                self.send_json(session, {"type": "stats", "stats": self.metrics.snapshot()})
+
+        # comando: 'upload_file' (começa ou continua o envio de um anexo; os bytes vêm
+        # depois em quadros de pedaço, ver receive_chunk)
+        elif command == 'upload_file':
+            self.start_upload(session, username, data)
+
+        # comando: 'download_file' (baixar um anexo a partir de um offset)
+        elif command == 'download_file':
+            self.start_download(session, username, data)
+
+        # comando: 'leave_chat' (o /menu do cliente)
+        elif command == 'leave_chat':
+            # limpa o contexto do usuário
+            session.chat_context = None
+
+    def deliver_chat(self, session, username, target_type, target_name, message_text, file=None):
+        # entrega uma msg (ou a referência de um anexo) pra conversa: 'user' (DM) ou 'group'
+        # devolve False se o limite de taxa recusou
+        extra = {"file": file} if file else {}
+
+        # se o alvo for 'user' (DM)
+        if target_type == 'user':
+            wait = self.dm_limiter.take(username)
+            if wait:
+                self.throttled(session, 'dm', wait, "DMs demais de uma vez.")
+                return False
+            # o cara tá online?
+            target_session = self.presence.get(target_name)
+            if target_session:
+                # tá. manda a msg direto pra sessão dele
+                self.send_json(target_session, {"type": "chat_message", "sender": username, "message": message_text, **extra})
+            elif self.cluster is not None and target_name in self.cluster:
+                # tá online, mas em outro nó do cluster: o broker leva até lá
+                self.cluster.route([target_name], {"type": "chat_message", "sender": username, "message": message_text, **extra})
+            else:
+                # tá offline. salva no banco e só avisa quando tiver gravado mesmo
+                # (o aviso sai na thread do writer, então o req_id vai explícito)
+                future = self.db.save_message(username, target_name, message_text, stored_file(extra))
+                req_id = self.request.req_id
+                future.add_done_callback(lambda f: self.send_json(session, {"status": "info", "message": f"'{target_name}' está offline. A mensagem será entregue quando ele(a) se conectar."}
+                                                                  if f.exception() is None else
+                                                                  {"status": "error", "message": f"Não deu pra guardar a mensagem pra '{target_name}'."}, req_id))
+            # entrega primeiro; o histórico vai no próximo lote do writer
+            self.save_history(dm_conversation(username, target_name), username, message_text, stored_file(extra))
+
+        # se o alvo for 'group'
+        elif target_type == 'group':
+            members = self.group_manager.get_members(target_name)
+            # cada destinatário custa uma ficha: no balde de quem manda e no do grupo
+            # (se o do grupo recusar, o user recebe as dele de volta)
+            cost = max(1, len(members) - 1)
+            wait = self.fanout_limiter.take(username, cost)
+            if not wait:
+                wait = self.group_limiter.take(target_name, cost)
+                if wait:
+                    self.fanout_limiter.give_back(username, cost)
+            if wait:
+                self.throttled(session, 'group', wait, f"Msgs demais pro grupo '{target_name}'.")
+                return False
+            # manda pra todo mundo do grupo que esteja online E não seja o próprio remetente
+            payload = {"type": "group_message", "group": target_name, "sender": username, "message": message_text, **extra}
+            targets = []
+            remote = []
+            for member in members:
+                if member == username:
+                    continue
+                target_session = self.presence.get(member)
+                if target_session:
+                    targets.append(target_session)
+                elif self.cluster is not None:
+                    remote.append(member)
+            # monta o quadro uma vez só (por formato); todo mundo recebe os mesmos bytes
+            self.fanout.deliver_message(targets, payload)
+            # quem tá em outro nó recebe por lá (um pacote por nó, não por membro)
+            if remote:
+                self.cluster.route(remote, payload)
+            self.save_history(group_conversation(target_name), username, message_text, stored_file(extra))
+        return True
+
+    def sync(self, session, username, data):
+        # o cliente guarda users, grupos e msgs num cache local (client/cache.py) e, ao
+        # (re)conectar, manda até onde já tem: o rowid do último user e da última entrada
+        # em grupo que viu e o último seq de cada conversa. a resposta traz só o que veio
+        # depois, uma página de cada coisa; com "more", ele pede de novo com os cursores novos
+        users_cursor = data.get('users_cursor') if valid_cursor(data.get('users_cursor')) else 0
+        members_cursor = data.get('members_cursor') if valid_cursor(data.get('members_cursor')) else 0
+        limit = self.page_limit(data.get('limit'))
+
+        users = self.db.users_since(users_cursor, self.sync_page_size)
+        rows = self.db.members_since(username, members_cursor, self.sync_page_size)
+        more = len(users) == self.sync_page_size or len(rows) == self.sync_page_size
+        members = {}
+        for _, group_name, member in rows:
+            if member == username:
+                # ele entrou nesse grupo depois do cursor: vai a lista inteira (os de antes
+                # têm rowid menor e não viriam)
+                members[group_name] = {"group": group_name, "members": sorted(self.group_manager.get_members(group_name)), "full": True}
+            elif not members.get(group_name, {}).get('full'):
+                members.setdefault(group_name, {"group": group_name, "members": [], "full": False})['members'].append(member)
+
+        # conversas: as que o cliente conhece (com o seq dele) + as que ele ainda não
+        # tem (DMs e grupos dele), que vêm só com a última página; o resto é pelo 'history'
+        known = {}
+        for item in data.get('conversations') or []:
+            if not isinstance(item, dict):
+                continue
+            seq = item.get('seq') if valid_cursor(item.get('seq')) else None
+            if isinstance(item.get('target_user'), str):
+                known['user', item['target_user']] = seq
+            elif isinstance(item.get('target_group'), str):
+                known['group', item['target_group']] = seq
+        groups = set(self.db.get_groups_for_user(username))
+        targets = {key for key in known if key[0] == 'user' or key[1] in groups}
+        targets.update(('user', peer) for peer in self.db.dm_peers(username))
+        targets.update(('group', group_name) for group_name in groups)
+
+        conversations = []
+        for kind, name in sorted(targets):
+            conversation = dm_conversation(username, name) if kind == 'user' else group_conversation(name)
+            seq = known.get((kind, name))
+            # a última msg da conversa é uma leitura só da chave: sem novidade, nem busca
+            head = self.db.conversation_head(conversation)
+            if head == 0 or (seq is not None and head <= seq):
+                continue
+            if len(conversations) == self.sync_conversations:
+                more = True
+                break
+            if seq is None:
+                page = self.db.history_before(conversation, None, limit)
+                page.reverse()
+            else:
+                page = self.db.history_after(conversation, seq, limit)
+            pending = page[-1][0] < head
+            more = more or pending
+            conversations.append({
+                "target_user" if kind == 'user' else "target_group": name,
+                "messages": [message_item(*row) for row in page],
+                "cursor": page[-1][0],
+                "more": pending,
+            })
+
+        self.send_json(session, {
+            "type": "sync",
+            "users": [name for _, name in users],
+            "users_cursor": users[-1][0] if users else users_cursor,
+            "members": list(members.values()),
+            "members_cursor": rows[-1][0] if rows else members_cursor,
+            "conversations": conversations,
+            "more": more,
+        })
+
+    def save_history(self, conversation, username, message_text, file):
+        # a msg já foi entregue; se o histórico não gravar, pelo menos fica no log
+        # (senão ela some do histórico sem ninguém saber)
+        def check(future):
+            if future.exception() is not None:
+                print(f"[ERRO] Msg de '{username}' não entrou no histórico de {conversation!r}: {future.exception()}")
+        self.db.append_history(conversation, username, message_text, file).add_done_callback(check)
+
+    def start_upload(self, session, username, data):
+        file_id, size, name, transfer = data.get('sha256'), data.get('size'), data.get('name'), data.get('transfer')
+        if (not valid_file_id(file_id) or not isinstance(size, int) or isinstance(size, bool) or size < 0
+                or not isinstance(name, str) or not name or not valid_transfer(transfer)):
+            self.send_json(session, {"status": "error", "message": "Envio inválido: precisa de name, size, sha256 (hex) e transfer."})
+            return
+        if size > self.files.max_size:
+            self.send_json(session, {"status": "error", "message": f"Arquivo grande demais (máximo {self.files.max_size} bytes)."})
+            return
+        conversation, target = self.resolve_conversation(session, username, data)
+        if conversation is None:
+            return
+        if target['type'] == 'user' and not self.db.user_exists(target['target']):
+            self.send_json(session, {"status": "error", "message": f"O usuário '{target['target']}' não existe."})
+            return
+        ref = file_ref(file_id, os.path.basename(name)[:255] or file_id, size)
+        if self.files.size(file_id) == size:
+            # esse conteúdo já tá guardado (mandado antes, por ele ou outro): nem precisa subir
+            self.file_uploaded(session, username, conversation, target, ref, transfer)
+            return
+        if transfer in session.uploads or len(session.uploads) >= self.max_uploads:
+            self.send_json(session, {"status": "error", "message": f"Envios demais ao mesmo tempo (máximo {self.max_uploads})."})
+            return
+        upload = self.files.open_upload(username, file_id, size)
+        session.uploads[transfer] = (upload, conversation, target, ref, self.request.req_id)
+        if upload.done:
+            # arquivo vazio, ou a tentativa anterior caiu depois do último pedaço
+            self.finish_upload(session, username, transfer)
+            return
+        # offset = quanto já chegou numa tentativa anterior: o cliente continua dali
+        self.send_json(session, {"type": "upload_ready", "transfer": transfer, "offset": upload.offset,
+                                 "chunk_size": self.files.chunk_size})
+
+    def receive_chunk(self, session, username, data):
+        # um pedaço de um envio: vai direto pro arquivo parcial
+        transfer = data['file_chunk']
+        entry = session.uploads.get(transfer)
+        if entry is None:
+            return  # envio que já deu erro ou acabou: o resto que tava no caminho é ignorado
+        upload, req_id = entry[0], entry[4]
+        # o que sair daqui é resposta do 'upload_file' (mesmo req_id)
+        self.request.session, self.request.req_id = session, req_id
+        try:
+            upload.write(data.get('offset'), data.get('data'))
+            if upload.done:
+                self.finish_upload(session, username, transfer)
+        except (FileError, OSError) as e:
+            session.uploads.pop(transfer, None)
+            upload.close()
+            self.send_json(session, {"status": "error", "message": f"Envio interrompido: {e}", "transfer": transfer})
+        finally:
+            self.request.session = self.request.req_id = None
+
+    def finish_upload(self, session, username, transfer):
+        upload, conversation, target, ref, _ = session.uploads.pop(transfer)
+        try:
+            upload.finish()
+        except (FileError, OSError) as e:
+            self.send_json(session, {"status": "error", "message": f"Envio recusado: {e}", "transfer": transfer})
+            return
+        self.file_uploaded(session, username, conversation, target, ref, transfer)
+
+    def file_uploaded(self, session, username, conversation, target, ref, transfer):
+        # o arquivo tá no disco: registra, entrega a referência e confirma pra quem mandou
+        # (espera o commit: quem recebe pode pedir o download logo em seguida)
+        self.db.save_file(ref['id'], ref['size'], conversation).result()
+        if self.deliver_chat(session, username, target['type'], target['target'], ref['name'], ref):
+            self.send_json(session, {"type": "upload_done", "transfer": transfer, "file": ref})
+
+    def can_download(self, username, file_id):
+        # só quem tá numa conversa em que o arquivo foi mandado
+        for conversation in self.db.file_conversations(file_id):
+            kind, _, name = conversation.partition(':')
+            if kind == 'dm' and username in name.split('\x1f'):
+                return True
+            if kind == 'group' and username in self.group_manager.get_members(name):
+                return True
+        return False
+
+    def start_download(self, session, username, data):
+        file_id, offset, transfer = data.get('file'), data.get('offset', 0), data.get('transfer')
+        if not valid_transfer(transfer) or not isinstance(offset, int) or isinstance(offset, bool):
+            self.send_json(session, {"status": "error", "message": "Download inválido: precisa de file, transfer e offset."})
+            return
+        size = self.files.size(file_id) if valid_file_id(file_id) else None
+        if size is None or not self.can_download(username, file_id):
+            self.send_json(session, {"status": "error", "message": "Arquivo não encontrado."})
+            return
+        if not 0 <= offset <= size:
+            self.send_json(session, {"status": "error", "message": f"Offset fora do arquivo ({size} bytes)."})
+            return
+        self.send_json(session, {"type": "download_ready", "transfer": transfer, "file": file_id, "size": size, "offset": offset})
+        if offset < size:
+            # os bytes saem do disco pelo writer da sessão, um pedaço por vez (sendfile)
+            session.send(FileStream(self.files.path(file_id), transfer, offset, size, self.files.chunk_size))
+
+    def group_changed(self, group_name):
+        # os outros nós do cluster também têm o índice de grupos e membros
+        if self.cluster is not None:
+            self.cluster.invalidate_group(group_name)
+
+    def user_registered(self, username):
+        # e o de users
+        if self.cluster is not None:
+            self.cluster.user_registered(username)
+
+    def deliver_routed(self, usernames, data):
+        # msg que veio de outro nó pra users que (pelo broker) estão logados aqui
+        sessions = []
+        for username in usernames:
+            session = self.presence.get(username)
+            if session:
+                sessions.append(session)
+            elif data.get('type') == 'chat_message':
+                # saiu no meio do caminho: a DM vira msg offline, como se já estivesse offline
+                self.db.save_message(data['sender'], username, data['message'], stored_file(data))
+        self.fanout.deliver_message(sessions, data, self.spill_for(data))
+
+    def resolve_conversation(self, session, username, data):
+        # conversa pedida no comando (target_user/target_group) ou a aberta agora;
+        # devolve (id da conversa, {'type', 'target'}) ou (None, None) depois de mandar o erro
+        if data.get('target_user'):
+            target = {'type': 'user', 'target': data['target_user']}
+        elif data.get('target_group'):
+            target = {'type': 'group', 'target': data['target_group']}
+        elif session.chat_context:
+            target = dict(session.chat_context)
+        else:
+            self.send_json(session, {"status": "error", "message": "Diga de qual conversa (target_user ou target_group)."})
+            return None, None
+        if target['type'] == 'user':
+            return dm_conversation(username, target['target']), target
+        # histórico de grupo só pra quem é membro
+        if username not in self.group_manager.get_members(target['target']):
+            self.send_json(session, {"status": "error", "message": f"Você não é membro do grupo '{target['target']}'."})
+            return None, None
+        return group_conversation(target['target']), target
+
+    def disconnect(self, session, username):
+        # faz a "faxina" do usuário que saiu
+        self.metrics.inc('chat_connections_active', -1)
+        if username:
+            print(f"[Desconexão] Usuário '{username}' desconectado.")
+            # cursores dos grupos: tudo o que já tá no histórico foi entregue ao vivo (ou no
+            # login). vai pra fila do writer ANTES de sair do online, então conta só as msgs
+            # de quem ainda via ele online; as que chegarem depois ficam pro próximo login
+            if session.group_backlog is not None:
+                self.db.save_group_cursors(username, skip=[group_name for group_name, _, _ in session.group_backlog])
+            # tira ele do registro de "online" e avisa quem acompanha
+            if self.presence.remove(username, session):
+                if self.cluster is not None:
+                    self.cluster.release(username)
+                self.notify_presence(session, username, False)
+
+        self.presence.drop_session(session)
+        # envios pela metade: o parcial fica no disco pra continuar na próxima conexão
+        for upload, *_ in session.uploads.values():
+            upload.close()
+        session.uploads.clear()
+
+        if session.timer is not None:
+            session.timer.cancel()
+        session.close()
@@ -0,0 +1,364 @@
+# a "sessão" é o que o servidor enxerga de cada cliente conectado
+# o resto do código só chama send/close, sem saber se é thread ou asyncio
+import asyncio
+import socket
+import threading
+import time
+from collections import deque
+
+import protocol
+
+# o que fazer quando a fila de saída de alguém estoura
+DROP_OLDEST = 'drop_oldest'  # joga fora as msgs mais antigas
+SPILL = 'spill'              # manda pro offline_messages (entrega no próximo login)
+DISCONNECT = 'disconnect'    # derruba o cliente lerdo
+POLICIES = (DROP_OLDEST, SPILL, DISCONNECT)
+
+# escrita junta: o writer pega tudo o que tá na fila e manda numa chamada só
+# (sendmsg = scatter/gather: o kernel lê os quadros direto de onde estão, sem juntar
+# num buffer antes). flush_delay segura a escrita uns microssegundos esperando mais
+# quadros, até juntar flush_bytes; é a nossa regra, separada do Nagle (que fica
+# desligado com TCP_NODELAY pra não somar outro atraso por baixo)
+FLUSH_BYTES = 64 * 1024
+IOV_MAX = 1024  # máximo de pedaços por sendmsg (limite do sistema)
+
+
+def send_frames(sock, frames):
+    # manda os quadros com o mínimo de chamadas; devolve quantas chamadas fez
+    if not hasattr(sock, 'sendmsg'):
+        sock.sendall(b''.join(frames))  # windows não tem sendmsg
+        return 1
+    views = [memoryview(frame) for frame in frames]
+    first = 0
+    calls = 0
+    while first < len(views):
+        # o socket é bloqueante: sendmsg espera ter espaço, mas pode mandar só um pedaço
+        sent = sock.sendmsg(views[first:first + IOV_MAX])
+        calls += 1
+        while first < len(views) and sent >= len(views[first]):
+            sent -= len(views[first])
+            first += 1
+        if sent:
+            views[first] = views[first][sent:]
+    return calls
+
+
+class FileStream:
+    # download na fila de saída: não carrega os bytes, só de onde tirar. o writer manda
+    # um pedaço por vez com sendfile (do disco direto pro socket) e devolve o resto pro
+    # fim da fila, então as msgs do chat passam no meio de um arquivo grande
+    def __init__(self, path, transfer, offset, size, chunk_size):
+        self.path = path
+        self.transfer = transfer
+        self.offset = offset
+        self.size = size
+        self.chunk_size = chunk_size
+
+    def __len__(self):
+        # na conta da fila só entra o cabeçalho: o arquivo não tá na memória
+        return protocol.HEADER.size + protocol.CHUNK_HEADER.size
+
+    def next_chunk(self):
+        # (cabeçalho do quadro, offset, quantos bytes) do próximo pedaço
+        count = min(self.chunk_size, self.size - self.offset)
+        offset = self.offset
+        self.offset += count
+        return protocol.chunk_header(self.transfer, offset, count), offset, count
+
+    @property
+    def done(self):
+        return self.offset >= self.size
+
+
+def split_frames(items):
+    # separa os quadros prontos dos downloads: [(quadros, None), ([], FileStream), ...]
+    frames = []
+    for item in items:
+        if isinstance(item, FileStream):
+            yield frames, item
+            frames = []
+        else:
+            frames.append(item)
+    if frames:
+        yield frames, None
+
+
+class OutboundQueue:
+    # fila de saída limitada de uma sessão
+    # quem manda msg só enfileira e volta; quem escreve no socket é o "writer"
+    # da sessão. assim um cliente lerdo não trava quem tá mandando pra ele.
+    # passou do high_watermark (em bytes) a sessão fica "congestionada" e a
+    # política entra em ação; só volta ao normal quando a fila baixa do low_watermark
+    def __init__(self, high_watermark=1024 * 1024, low_watermark=256 * 1024, policy=DROP_OLDEST):
+        if policy not in POLICIES:
+            raise ValueError(f"política de fila desconhecida: {policy}")
+        self.high_watermark = high_watermark
+        self.low_watermark = min(low_watermark, high_watermark)
+        self.policy = policy
+        self.items = deque()
+        self.size = 0  # bytes esperando na fila
+        self.cond = threading.Condition()
+        self.congested = False
+        self.closed = False
+        # contadores
+        self.sent = 0
+        self.dropped = 0
+        self.spilled = 0
+
+    def put(self, frame, spill=None):
+        # devolve False se a sessão tem que ser derrubada
+        # spill é uma função que salva a msg no banco (só vem pra msgs que dá pra salvar)
+        with self.cond:
+            if self.closed:
+                return True
+            # fila vazia aceita sempre, senão um quadro grande nunca passaria
+            if self.items and self.size + len(frame) > self.high_watermark:
+                self.congested = True
+            if not self.congested or self.policy == DROP_OLDEST:
+                self.items.append(frame)
+                self.size += len(frame)
+                # abre espaço descartando as mais antigas
+                while self.congested and self.size > self.high_watermark and len(self.items) > 1:
+                    dropped = self.items.popleft()
+                    if isinstance(dropped, FileStream):
+                        # download não é descartado (quase não ocupa nada): vai pro fim
+                        self.items.append(dropped)
+                        continue
+                    self.size -= len(dropped)
+                    self.dropped += 1
+                self.cond.notify()
+                return True
+            if self.policy == DISCONNECT:
+                self.dropped += 1
+                self.closed = True
+                self.cond.notify()
+                return False
+
+        # política SPILL: salva fora do lock (é escrita no banco)
+        saved = spill is not None and spill()
+        with self.cond:
+            if saved:
+                self.spilled += 1
+            else:
+                self.dropped += 1
+        return True
+
+    def _taken(self, frames):
+        # atualiza as contas depois que o writer tirou quadros da fila
+        for frame in frames:
+            self.size -= len(frame)
+        self.sent += len(frames)
+        if self.congested and self.size <= self.low_watermark:
+            self.congested = False
+
+    def get_batch(self, delay=0.0, flush_bytes=FLUSH_BYTES, max_frames=IOV_MAX):
+        # usado pela thread writer: espera ter algo e devolve tudo o que der pra mandar
+        # junto (None = fila fechada). com delay, segura mais um pouco (até juntar flush_bytes) antes de devolver
+        with self.cond:
+            while not self.items and not self.closed:
+                self.cond.wait()
+            if delay and self.size < flush_bytes:
+                deadline = time.monotonic() + delay
+                while not self.closed and self.size < flush_bytes:
+                    remaining = deadline - time.monotonic()
+                    if remaining <= 0:
+                        break
+                    self.cond.wait(remaining)
+            if self.closed:
+                return None
+            frames = [self.items.popleft() for _ in range(min(len(self.items), max_frames))]
+            self._taken(frames)
+            return frames
+
+    def requeue(self, stream):
+        # o resto de um download volta pro fim da fila (o writer mandou um pedaço)
+        with self.cond:
+            if self.closed:
+                return False
+            self.items.append(stream)
+            self.size += len(stream)
+            self.cond.notify()
+            return True
+
+    def take_all(self):
+        # usado pelo writer async: pega tudo o que tiver sem esperar
+        with self.cond:
+            if self.closed:
+                return None
+            frames = list(self.items)
+            self.items.clear()
+            self._taken(frames)
+            return frames
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.items.clear()
+            self.size = 0
+            self.cond.notify_all()
+
+    def stats(self):
+        with self.cond:
+            return {
+                "depth": len(self.items),
+                "bytes": self.size,
+                "congested": self.congested,
+                "sent": self.sent,
+                "dropped": self.dropped,
+                "spilled": self.spilled,
+            }
+
+
+class SocketSession:
+    # sessão do modo clássico (uma thread por cliente, socket bloqueante)
+    # cada sessão tem uma thread writer que esvazia a fila de saída
+    def __init__(self, sock, addr, queue, flush_delay=0.0, flush_bytes=FLUSH_BYTES):
+        self.sock = sock
+        self.addr = addr
+        self.username = None # preenchido quando loga
+        self.offline_cursor = 0 # último id de msg offline mandado (ver ChatServer.send_offline_batch)
+        self.group_backlog = None # grupos com msgs atrasadas pra mandar ([grupo, cursor, última seq])
+        self.chat_context = None # com quem tá conversando ({'type': 'user'/'group', 'target': ...})
+        self.uploads = {} # envios de arquivo em andamento (transferência -> Upload e destino)
+        # presença que essa sessão acompanha (ver presence.PresenceRegistry)
+        self.watching_users = set()
+        self.watching_groups = set()
+        # formato combinado no cumprimento (JSON até o cliente pedir outro)
+        self.codec = protocol.JSON_CODEC
+        self.on_sent = None # chamada com quantos bytes foram pro socket (métricas)
+        # heartbeat e prazos (ver ChatServer.check_session)
+        self.heartbeat = False # o cliente responde ping?
+        self.opened_at = self.last_seen = time.monotonic()
+        self.timer = None
+        self.closed = False
+        self.queue = queue
+        self.flush_delay = flush_delay
+        self.flush_bytes = flush_bytes
+        self.writer_thread = threading.Thread(target=self._writer, daemon=True)
+        self.writer_thread.start()
+
+    def send(self, data, spill=None):
+        if not self.queue.put(data, spill):
+            self.close()
+
+    def _writer(self):
+        while True:
+            frames = self.queue.get_batch(self.flush_delay, self.flush_bytes)
+            if frames is None:
+                break
+            try:
+                for ready, stream in split_frames(frames):
+                    if ready:
+                        # tudo o que juntou vai numa chamada só (ou poucas, se o socket encher)
+                        send_frames(self.sock, ready)
+                        if self.on_sent:
+                            self.on_sent(sum(len(frame) for frame in ready))
+                    if stream is not None:
+                        self._send_chunk(stream)
+            except OSError:
+                self.queue.close()
+                break
+
+    def _send_chunk(self, stream):
+        header, offset, count = stream.next_chunk()
+        self.sock.sendall(header)
+        with open(stream.path, 'rb') as f:
+            # socket.sendfile usa os.sendfile: o kernel copia do arquivo pro socket
+            if self.sock.sendfile(f, offset, count) != count:
+                raise OSError("arquivo encolheu no meio do download")
+        if self.on_sent:
+            self.on_sent(len(header) + count)
+        if not stream.done:
+            self.queue.requeue(stream)
+
+    def close(self):
+        self.closed = True
+        self.queue.close()
+        try:
+            # shutdown acorda quem tiver travado num recv/sendall desse socket
+            self.sock.shutdown(socket.SHUT_RDWR)
+        except OSError:
+            pass
+        self.sock.close()
+
+
+class AsyncSession:
+    # sessão do modo event loop: quem escreve no socket é o loop,
+    # mas os comandos rodam numa thread do executor, então o writer
+    # é acordado pelo call_soon_threadsafe
+    def __init__(self, loop, writer, addr, queue, flush_delay=0.0, flush_bytes=FLUSH_BYTES):
+        self.loop = loop
+        self.writer = writer
+        self.sock = writer.get_extra_info('socket')
+        self.addr = addr
+        self.username = None
+        self.offline_cursor = 0
+        self.group_backlog = None
+        self.chat_context = None
+        self.uploads = {}
+        self.watching_users = set()
+        self.watching_groups = set()
+        self.codec = protocol.JSON_CODEC
+        self.on_sent = None
+        self.heartbeat = False
+        self.opened_at = self.last_seen = time.monotonic()
+        self.timer = None
+        self.closed = False
+        self.queue = queue
+        self.flush_delay = flush_delay
+        self.flush_bytes = flush_bytes
+        self.wake = asyncio.Event()
+        self.writer_task = loop.create_task(self._writer())
+
+    def send(self, data, spill=None):
+        if not self.queue.put(data, spill):
+            self.close()
+            return
+        self.loop.call_soon_threadsafe(self.wake.set)
+
+    async def _writer(self):
+        while True:
+            await self.wake.wait()
+            if self.flush_delay and self.queue.size < self.flush_bytes:
+                # segura um pouco pra juntar mais quadros no mesmo write
+                await asyncio.sleep(self.flush_delay)
+            self.wake.clear()
+            frames = self.queue.take_all()
+            if frames is None:
+                break
+            try:
+                for ready, stream in split_frames(frames):
+                    if ready:
+                        # um write só pro lote (writelines usa sendmsg quando o python tem)
+                        self.writer.writelines(ready)
+                        if self.on_sent:
+                            self.on_sent(sum(len(frame) for frame in ready))
+                    # drain segura o writer enquanto o buffer do socket tá cheio;
+                    # nesse meio tempo as msgs novas se acumulam na fila (e nos watermarks)
+                    await self.writer.drain()
+                    if stream is not None:
+                        await self._send_chunk(stream)
+            except (ConnectionError, OSError):
+                self.queue.close()
+                break
+
+    async def _send_chunk(self, stream):
+        header, offset, count = stream.next_chunk()
+        self.writer.write(header)
+        with open(stream.path, 'rb') as f:
+            # loop.sendfile espera o buffer esvaziar e usa os.sendfile quando dá
+            if await self.loop.sendfile(self.writer.transport, f, offset, count) != count:
+                raise OSError("arquivo encolheu no meio do download")
+        if self.on_sent:
+            self.on_sent(len(header) + count)
+        if not stream.done and self.queue.requeue(stream):
+            self.wake.set()
+
+    def _close(self):
+        self.wake.set()
+        self.writer.close()
+
+    def close(self):
+        self.closed = True
+        self.queue.close()
+        self.loop.call_soon_threadsafe(self._close)
@@ -0,0 +1,81 @@
+# roda de timers (hashed timer wheel): muitos prazos com uma thread só
+#
+# a roda tem 'slots' posições e o ponteiro anda uma posição a cada 'tick' segundos.
+# um timer vai pra posição (atual + ticks até vencer) e, se o prazo for maior que
+# uma volta inteira, guarda quantas voltas ainda faltam (rounds). então:
+#   - agendar e cancelar custam O(1) (cancelar só marca; o timer sai quando o ponteiro passa)
+#   - a cada tick só a lista de uma posição é olhada
+# a precisão é de um tick, o que sobra pra prazos de heartbeat/inatividade (segundos)
+import math
+import threading
+import time
+
+
+class Timer:
+    __slots__ = ('callback', 'rounds', 'cancelled')
+
+    def __init__(self, callback, rounds):
+        self.callback = callback
+        self.rounds = rounds
+        self.cancelled = False
+
+    def cancel(self):
+        self.cancelled = True
+
+
+class TimerWheel:
+    def __init__(self, tick=1.0, slots=512):
+        self.tick = tick
+        self.wheel = [[] for _ in range(slots)]
+        self.position = 0
+        self.lock = threading.Lock()
+        self.thread = None
+
+    def schedule(self, delay, callback):
+        # chama callback() daqui a ~delay segundos (na thread da roda); devolve o Timer
+        ticks = max(1, math.ceil(delay / self.tick))
+        slots = len(self.wheel)
+        timer = Timer(callback, (ticks - 1) // slots)
+        with self.lock:
+            self.wheel[(self.position + ticks) % slots].append(timer)
+        return timer
+
+    def advance(self):
+        # anda uma posição e dispara o que venceu nela
+        with self.lock:
+            self.position = (self.position + 1) % len(self.wheel)
+            due, waiting = [], []
+            for timer in self.wheel[self.position]:
+                if timer.cancelled:
+                    continue
+                if timer.rounds:
+                    timer.rounds -= 1
+                    waiting.append(timer)
+                else:
+                    due.append(timer)
+            self.wheel[self.position] = waiting
+        # os callbacks rodam fora do lock (podem agendar de novo)
+        for timer in due:
+            try:
+                timer.callback()
+            except Exception as e:
+                print(f"[ERRO] Timer falhou: {e}")
+
+    def __len__(self):
+        with self.lock:
+            return sum(1 for slot in self.wheel for timer in slot if not timer.cancelled)
+
+    def start(self):
+        self.thread = threading.Thread(target=self._run, name="timers", daemon=True)
+        self.thread.start()
+
+    def _run(self):
+        # o próximo tick é contado a partir do relógio, não do fim do anterior:
+        # se atrasar (GIL, máquina ocupada), os ticks perdidos são compensados em seguida
+        next_tick = time.monotonic()
+        while True:
+            next_tick += self.tick
+            delay = next_tick - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+            self.advance()
@@ -2,11 +2,121 @@
 import hashlib  # faz o hash da senha
 import hmac
 import os
+import sqlite3
+import base64
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor
+
+from metrics import DISABLED
+
+# iterações do PBKDF2 usadas desde o começo; hash salvo só como 'sal:hash' usa esse valor
+DEFAULT_ITERATIONS = 100000
+
+
+class ServerBusy(Exception):
+    # muita gente logando ao mesmo tempo, o pool de hash tá cheio
+    pass
+
+
+def _pbkdf2(password_bytes, salt, iterations, submitted_at):
+    # roda dentro do pool (thread ou processo); devolve o hash e quanto tempo esperou na fila
+    queued = time.time() - submitted_at
+    hashed = hashlib.pbkdf2_hmac(
+        'sha256',        # tipo de hash
+        password_bytes,  # senha do user
+        salt,           # sal aleatório
+        iterations     # quanto maior, mais difícil de quebrar
+    )
+    return hashed, queued
+
+
+def format_hash(salt, hashed, iterations=DEFAULT_ITERATIONS):
+    # texto salvo no banco: sal:hash, e as iterações no fim (sal:hash:iterações)
+    # só se não forem as de sempre
+    text = f"{salt.hex()}:{hashed.hex()}"
+    if iterations != DEFAULT_ITERATIONS:
+        text += f":{iterations}"
+    return text
+
+
+def parse_hash(text):
+    # o contrário: (sal, hash, iterações); ValueError se o texto não tiver o formato
+    parts = text.split(':')
+    if len(parts) not in (2, 3):
+        raise ValueError("hash fora do formato sal:hash[:iterações]")
+    iterations = int(parts[2]) if len(parts) > 2 else DEFAULT_ITERATIONS
+    if iterations < 1:
+        raise ValueError("iterações inválidas")
+    return bytes.fromhex(parts[0]), bytes.fromhex(parts[1]), iterations
+
+
+def hash_password(password, iterations=DEFAULT_ITERATIONS):
+    # hash completo de uma senha, com sal novo (usado pela importação em massa, num pool de processos)
+    salt = os.urandom(16)
+    return format_hash(salt, hashlib.pbkdf2_hmac('sha256', password.encode('utf-8'), salt, iterations), iterations)
+
 
 class UserManager:
-    def __init__(self, db):
+    # o PBKDF2 é caro de propósito. pra uma avalanche de logins (todo mundo
+    # reconectando depois de uma queda) não travar o servidor inteiro:
+    # - o hash roda num pool limitado (pool_size), não na thread do cliente
+    # - se já tiver max_pending hashes esperando, recusa na hora (ServerBusy)
+    # - quem já logou ganha um token assinado e pode voltar sem senha por token_ttl segundos
+    def __init__(self, db, iterations=DEFAULT_ITERATIONS, pool_size=None, max_pending=64,
+                 use_processes=False, token_ttl=3600, token_secret=None, metrics=DISABLED):
         self.db = db  # pega a conexão com o banco
-    
+        self.metrics = metrics
+        self.iterations = iterations
+        self.max_pending = max_pending
+        pool_size = pool_size or os.cpu_count() or 1
+        # o pbkdf2_hmac solta o GIL, então thread já usa vários núcleos;
+        # processo é opção pra quando o resto do servidor tá disputando o GIL
+        self.pool = ProcessPoolExecutor(pool_size) if use_processes else ThreadPoolExecutor(pool_size, thread_name_prefix="pbkdf2")
+        self.pending = 0
+        self.lock = threading.Lock()
+        # métricas do pool
+        self.jobs = 0
+        self.rejected = 0
+        self.queue_time_total = 0.0
+        self.queue_time_max = 0.0
+        # tokens de sessão
+        self.token_ttl = token_ttl
+        secret = token_secret or os.environ.get('CHAT_TOKEN_SECRET')
+        self.token_secret = secret.encode('utf-8') if secret else os.urandom(32)
+
+    def _hash(self, password, salt, iterations):
+        # manda o hash pro pool respeitando o limite de admissão
+        with self.lock:
+            if self.pending >= self.max_pending:
+                self.rejected += 1
+                raise ServerBusy()
+            self.pending += 1
+        try:
+            start = time.time()
+            hashed, queued = self.pool.submit(_pbkdf2, password.encode('utf-8'), salt, iterations, start).result()
+        finally:
+            with self.lock:
+                self.pending -= 1
+        if self.metrics.enabled:
+            self.metrics.observe('chat_pbkdf2_queue_seconds', queued)
+            self.metrics.observe('chat_pbkdf2_seconds', time.time() - start - queued)
+        with self.lock:
+            self.jobs += 1
+            self.queue_time_total += queued
+            self.queue_time_max = max(self.queue_time_max, queued)
+        return hashed
+
+    def stats(self):
+        with self.lock:
+            return {
+                "pending": self.pending,
+                "jobs": self.jobs,
+                "rejected": self.rejected,
+                "avg_queue_ms": round(1000 * self.queue_time_total / self.jobs, 3) if self.jobs else 0.0,
+                "max_queue_ms": round(1000 * self.queue_time_max, 3),
+            }
+
     def register(self, username, password):
         # primeiro vê se já tem alguém com esse nome
         if self.db.user_exists(username):
@@ -14,24 +124,18 @@ class UserManager:
 
         # gera 16 bytes aleatórios pro sal
         salt = os.urandom(16)
-        
+
         # cria o hash da senha com PBKDF2 (mais seguro que MD5/SHA)
-        password_bytes = password.encode('utf-8')
-        hashed_password = hashlib.pbkdf2_hmac(
-            'sha256',        # tipo de hash
-            password_bytes,  # senha do user
-            salt,           # sal aleatório
-            100000         # quanto maior, mais difícil de quebrar
-        )
-        
-        # transforma em texto pra salvar no banco (sal:hash)
-        salt_hex = salt.hex()
-        hashed_password_hex = hashed_password.hex()
-        
-        # junta o sal e o hash com : no meio
-        full_hash_string = f"{salt_hex}:{hashed_password_hex}"
-        
-        self.db.create_user(username, full_hash_string)
+        hashed_password = self._hash(password, salt, self.iterations)
+
+        # transforma em texto pra salvar no banco (sal:hash[:iterações])
+        full_hash_string = format_hash(salt, hashed_password, self.iterations)
+
+        try:
+            # espera o commit: o cara vai tentar logar logo em seguida
+            self.db.create_user(username, full_hash_string).result()
+        except sqlite3.IntegrityError:
+            return False  # alguém registrou o mesmo nome no meio tempo
         return True
 
     def authenticate(self, username, password):
@@ -42,22 +146,38 @@ class UserManager:
             return False
 
         try:
-            # Separa o sal e o hash armazenados
-            salt_hex, stored_hash_hex = full_hash_string.split(':')
-            salt = bytes.fromhex(salt_hex)
-            stored_hash = bytes.fromhex(stored_hash_hex)
-            # Codifica a senha informada pelo usuário
-            password_bytes = password.encode('utf-8')
+            # Separa o sal, o hash e (se tiver) as iterações
+            salt, stored_hash, iterations = parse_hash(full_hash_string)
             # Gera o hash da senha informada usando o mesmo sal e parâmetros
-            new_hashed_password = hashlib.pbkdf2_hmac(
-                'sha256',
-                password_bytes,
-                salt,
-                100000
-            )
+            new_hashed_password = self._hash(password, salt, iterations)
             # Compara o hash gerado com o hash armazenado de forma segura
             return hmac.compare_digest(stored_hash, new_hashed_password)
+        except ServerBusy:
+            raise
         except Exception as e:
             # Em caso de erro, imprime mensagem e retorna False
             print(f"Erro ao autenticar {username}: {e}")
-            return False
\ No newline at end of file
+            return False
+
+    # tokens de sessão: "base64(user:expira).assinatura"
+    # a assinatura é um HMAC com o segredo do servidor, então não dá pra forjar
+
+    def issue_token(self, username):
+        expires = int(time.time()) + self.token_ttl
+        payload = base64.urlsafe_b64encode(f"{username}:{expires}".encode('utf-8')).decode('ascii')
+        signature = hmac.new(self.token_secret, payload.encode('ascii'), hashlib.sha256).hexdigest()
+        return f"{payload}.{signature}"
+
+    def verify_token(self, token):
+        # devolve o nome do user se o token for válido e não tiver expirado
+        try:
+            payload, signature = token.split('.')
+            expected = hmac.new(self.token_secret, payload.encode('ascii'), hashlib.sha256).hexdigest()
+            if not hmac.compare_digest(expected, signature):
+                return None
+            username, expires = base64.urlsafe_b64decode(payload.encode('ascii')).decode('utf-8').rsplit(':', 1)
+        except (ValueError, UnicodeError, AttributeError):
+            return None
+        if int(expires) < time.time():
+            return None
+        return username